@@ -1,40 +1,113 @@
 import asyncio
 import logging
 import os
+import time
 
 import aiohttp
-from dotenv import load_dotenv
 
-# Получение пользовательского логгера и установка уровня логирования
+from .config import settings
+from .files import remove_file, temp_path
+from .metrics import zamzar_polls, zamzar_stage_seconds
+
+# Логгер модуля; обработчики настраиваются один раз при старте (logging_setup)
 wav_to_mp3_logger = logging.getLogger(__name__)
-wav_to_mp3_logger.setLevel(logging.INFO)
 
-# Настройка обработчика и форматировщика
-wav_to_mp3_handler = logging.FileHandler(f"{__name__}.log", mode='w')
-wav_to_mp3_formatter = logging.Formatter("%(name)s %(asctime)s %(levelname)s %(message)s")
+# Статусы ответа, при которых запрос стоит повторить
+RETRY_STATUSES = (429, 500, 502, 503, 504)
 
-# добавление форматировщика к обработчику
-wav_to_mp3_handler.setFormatter(wav_to_mp3_formatter)
+# Размер куска при скачивании результата
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
-# добавление обработчика к логгеру
-wav_to_mp3_logger.addHandler(wav_to_mp3_handler)
+# Общая на все приложение сессия с пулом соединений к zamzar.com
+client_session = None
 
 
-async def convert_file(source_file: str, target_format: str, folder: str, converting_errors=None):
-    # Получаем API_KEY
-    dotenv_path = os.path.join(os.path.dirname(__file__), '..', '.env')
-    load_dotenv(dotenv_path)
-    api_key = os.getenv('API_KEY')
-    endpoint = "https://sandbox.zamzar.com/v1/jobs"
+async def start_session():
+    global client_session
+    if client_session is None or client_session.closed:
+        connector = aiohttp.TCPConnector(limit=settings.zamzar_connections,
+                                         limit_per_host=settings.zamzar_connections,
+                                         keepalive_timeout=settings.zamzar_keepalive)
+        client_session = aiohttp.ClientSession(
+            connector=connector,
+            auth=aiohttp.BasicAuth(login=settings.api_key, password=''),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60))
+        wav_to_mp3_logger.info(f'Open client session, {settings.zamzar_connections} connections')
+    return client_session
+
+
+async def close_session():
+    global client_session
+    if client_session is not None:
+        await client_session.close()
+        client_session = None
+        wav_to_mp3_logger.info('Close client session')
+
+
+# Пауза перед повтором: из Retry-After, если сервер его прислал, иначе экспоненциальная
+def retry_delay(attempt: int, response=None):
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), settings.zamzar_retry_max_delay)
+    return min(settings.zamzar_retry_delay * 2 ** attempt, settings.zamzar_retry_max_delay)
+
+
+# Запрос к API с повтором при 429/5xx и сетевых ошибках.
+# make_data вызывается на каждую попытку, чтобы тело запроса можно было отправить заново
+async def request(method: str, url: str, make_data=None):
+    session = await start_session()
+
+    for attempt in range(settings.zamzar_retries + 1):
+        last_attempt = attempt == settings.zamzar_retries
+        try:
+            if make_data is None:
+                response = await session.request(method, url)
+            else:
+                with make_data() as data:
+                    response = await session.request(method, url, data=data.form)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if last_attempt:
+                raise
+            delay = retry_delay(attempt)
+            wav_to_mp3_logger.error(f'{method} {url}: {e}, retry in {delay}s')
+            await asyncio.sleep(delay)
+            continue
+
+        if response.status in RETRY_STATUSES and not last_attempt:
+            delay = retry_delay(attempt, response)
+            response.release()
+            wav_to_mp3_logger.error(f'{method} {url}: {response.status} {response.reason}, retry in {delay}s')
+            await asyncio.sleep(delay)
+            continue
+
+        return response
+
+
+# Тело запроса на создание задачи: файл передается потоком и закрывается после отправки
+class JobForm:
+
+    def __init__(self, wav_file_path: str, target_format: str):
+        self.wav_file_path = wav_file_path
+        self.target_format = target_format
+        self.source = None
+        self.form = None
+
+    def __enter__(self):
+        self.source = open(self.wav_file_path, 'rb')
+        self.form = aiohttp.FormData()
+        self.form.add_field('target_format', self.target_format)
+        self.form.add_field('source_file', self.source, filename=os.path.basename(self.wav_file_path))
+        return self
+
+    def __exit__(self, *exc):
+        self.source.close()
 
-    # Настраиваем подключение к zamzar.com
-    data = aiohttp.FormData()
-    data.add_field('target_format', target_format)
 
+async def convert_file(source_file: str, target_format: str, folder: str, converting_errors=None):
+    endpoint = f'{settings.zamzar_url}/jobs'
     wav_file_path = os.path.join(folder, source_file)
-    data.add_field('source_file', open(wav_file_path, 'rb'))
-    check_status_auth = aiohttp.BasicAuth(login=api_key, password='')
-    wav_to_mp3_logger.info(f'Status: {check_status_auth} for file:{wav_file_path}')
+    wav_to_mp3_logger.info(f'Start convert file:{wav_file_path}')
 
     # cписок для ошибок
     if converting_errors is None:
@@ -44,102 +117,135 @@ async def convert_file(source_file: str, target_format: str, folder: str, conver
 
     converting_file = ''
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(endpoint, data=data, auth=check_status_auth) as create_response:
+    try:
+        started = time.perf_counter()
+        create_response = await request('POST', endpoint, lambda: JobForm(wav_file_path, target_format))
+        zamzar_stage_seconds.labels('create').observe(time.perf_counter() - started)
+        async with create_response:
 
             # Проверяем, что задача создана
-            if create_response.status == 201:
+            if create_response.status != 201:
+                wav_to_mp3_logger.error(f'{source_file}: Error creating job:'
+                                        f'{create_response.status} {create_response.reason}')
+                converting_errors.append(
+                    {source_file: f"Error creating job: {create_response.status} {create_response.reason}"})
+                return converting_file, converting_errors
 
-                # Получем id задачи
-                job_id = (await create_response.json())['id']
-                wav_to_mp3_logger.info(f'Task to convert created, id:{job_id}')
+            # Получем id задачи
+            job_id = (await create_response.json())['id']
+            wav_to_mp3_logger.info(f'Task to convert created, id:{job_id}')
 
-                # Эндпоинт задачи
-                check_status_url = f'https://sandbox.zamzar.com/v1/jobs/{job_id}'
+        with zamzar_stage_seconds.labels('wait').time():
+            job = await wait_job(job_id, source_file, converting_errors)
 
-                wav_to_mp3_logger.info('Starting waiting for completed task')
+        if job is not None:
+            file_id = job['target_files'][0]['id']
+            mp3_filename = source_file.replace('.wav', f'.{target_format}')
+            mp3_file_path = os.path.join(folder, mp3_filename)
 
-                # Ожидаем окончания обработки файла
-                while True:
+            wav_to_mp3_logger.info(f'Task complete, file_id:{file_id}')
 
-                    # Асинхронный sleep на 1 секунду
-                    await asyncio.sleep(1)
+            # Пытаемся скачать файл
+            with zamzar_stage_seconds.labels('download').time():
+                result = await download_file(file_id, mp3_file_path)
 
-                    async with session.get(check_status_url, auth=check_status_auth) as check_status:
-                        if check_status.status == 200:
+            if result == 'OK':
+                converting_file = mp3_filename
+                wav_to_mp3_logger.info(f'File: {converting_file} is downloaded')
+            else:
+                converting_errors.append({source_file: result})
+                wav_to_mp3_logger.error(f'Error convert file: {source_file}, result: {result}')
 
-                            # Получаем статус задачи
-                            job_status = (await check_status.json())['status']
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        wav_to_mp3_logger.error(f'{source_file}: Error request to api: {e!r}')
+        converting_errors.append({source_file: f'Error request to api: {e!r}'})
 
-                            # Проверяем статус
-                            if job_status == 'successful':
-                                file_id = (await check_status.json())['target_files'][0]['id']
-                                mp3_filename = source_file.replace('.wav', '.mp3')
-                                mp3_file_path = os.path.join(folder, mp3_filename)
+    return converting_file, converting_errors
 
-                                wav_to_mp3_logger.info(f'Task complete, file_id:{file_id}')
 
-                                # Пытаемся скачать файл
-                                result = await download_file(file_id, mp3_file_path, api_key)
+# Ожидаем окончания обработки файла: интервал опроса растет, общее время ограничено
+async def wait_job(job_id: str, source_file: str, converting_errors: list):
+    check_status_url = f'{settings.zamzar_url}/jobs/{job_id}'
+    deadline = time.monotonic() + settings.zamzar_timeout
+    delay = settings.zamzar_poll_interval
 
-                                if result == 'OK':
-                                    converting_file = mp3_filename
-                                    wav_to_mp3_logger.info(f'File: {converting_file} is downloaded')
-                                else:
-                                    converting_errors.append({source_file: result})
-                                    wav_to_mp3_logger.error(f'Error convert file: {source_file}, result: {result}')
-                                break
+    wav_to_mp3_logger.info('Starting waiting for completed task')
 
-                            elif job_status == 'failed':
-                                wav_to_mp3_logger.error(f'{source_file}: Conversion failed')
-                                converting_errors.append({source_file: 'Conversion failed'})
-                                break
+    while True:
+        await asyncio.sleep(min(delay, max(deadline - time.monotonic(), 0)))
 
-                        else:
-                            wav_to_mp3_logger.error(f'{source_file}: Error checking job status:'
-                                                    f'{check_status.status} {check_status.reason}')
-                            converting_errors.append(
-                                {source_file: f"Error checking job status: "
-                                              f"{check_status.status} {check_status.reason}"})
-                            break
-            else:
-                wav_to_mp3_logger.error(f'{source_file}: Error creating job:'
-                                        f'{create_response.status} {create_response.reason}')
+        zamzar_polls.inc()
+        check_status = await request('GET', check_status_url)
+        async with check_status:
+            if check_status.status != 200:
+                wav_to_mp3_logger.error(f'{source_file}: Error checking job status:'
+                                        f'{check_status.status} {check_status.reason}')
                 converting_errors.append(
-                    {source_file: f"Error creating job: {create_response.status} {create_response.reason}"})
+                    {source_file: f"Error checking job status: "
+                                  f"{check_status.status} {check_status.reason}"})
+                return None
 
-    return converting_file, converting_errors
+            job = await check_status.json()
 
+        # Проверяем статус
+        if job['status'] == 'successful':
+            return job
 
-async def download_file(file_id, mp3_file, api_key):
-    # Эндпоинт для скачивания
-    endpoint = f"https://sandbox.zamzar.com/v1/files/{file_id}/content"
-    wav_to_mp3_logger.info('Start downloading file')
+        if job['status'] == 'failed':
+            wav_to_mp3_logger.error(f'{source_file}: Conversion failed')
+            converting_errors.append({source_file: 'Conversion failed'})
+            return None
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(endpoint, auth=aiohttp.BasicAuth(login=api_key, password='')) as response:
-            try:
-                with open(mp3_file, 'wb') as f:
-                    async for chunk in response.content.iter_chunked(1024):
-                        if chunk:
-                            f.write(chunk)
-                            f.flush()
-                wav_to_mp3_logger.info('Download complete')
-                return "OK"
+        if time.monotonic() >= deadline:
+            wav_to_mp3_logger.error(f'{source_file}: Conversion timeout {settings.zamzar_timeout}s')
+            converting_errors.append({source_file: f'Conversion timeout {settings.zamzar_timeout}s'})
+            return None
 
-            except IOError as e:
-                wav_to_mp3_logger.exception(f'{str(e)}')
-                return str(e)
+        delay = min(delay * settings.zamzar_poll_backoff, settings.zamzar_poll_max_interval)
+
+
+async def download_file(file_id, mp3_file):
+    # Эндпоинт для скачивания
+    endpoint = f"{settings.zamzar_url}/files/{file_id}/content"
+    wav_to_mp3_logger.info('Start downloading file')
+    loop = asyncio.get_running_loop()
+
+    response = await request('GET', endpoint)
+    async with response:
+        if response.status != 200:
+            wav_to_mp3_logger.error(f'Error downloading file: {response.status} {response.reason}')
+            return f'Error downloading file: {response.status} {response.reason}'
+
+        # Скачиваем во временный файл: оборванная загрузка не оставляет MP3 под итоговым именем
+        part_file = temp_path(mp3_file)
+        try:
+            with open(part_file, 'wb') as f:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    await loop.run_in_executor(None, f.write, chunk)
+            os.replace(part_file, mp3_file)
+            wav_to_mp3_logger.info('Download complete')
+            return "OK"
+
+        except (IOError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            remove_file(part_file)
+            wav_to_mp3_logger.exception(f'{str(e)}')
+            return str(e)
+
+        except BaseException:
+            remove_file(part_file)
+            raise
 
 
 async def main():
     source_file = "sample-3s.wav"
     target_format = "mp3"
     folder_for_audio = '../audio/'
-    result, errors = await convert_file(source_file, target_format, folder_for_audio)
+    try:
+        result, errors = await convert_file(source_file, target_format, folder_for_audio)
+    finally:
+        await close_session()
     print(result, errors, sep='\n')
 
 
 if __name__ == "__main__":
-    loop = asyncio.new_event_loop()
     asyncio.run(main())
@@ -0,0 +1,62 @@
+import time
+from collections import OrderedDict
+
+from .config import settings
+
+
+# LRU кэш с ограничением времени жизни записей
+class TTLCache:
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+
+        value, expires = item
+        if expires < time.monotonic():
+            del self._items[key]
+            return None
+
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._items[key] = (value, time.monotonic() + self.ttl)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def delete(self, key):
+        self._items.pop(key, None)
+
+    def delete_matching(self, predicate):
+        for key in [key for key in self._items if predicate(key)]:
+            del self._items[key]
+
+    def clear(self):
+        self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+# Проверенные пары (id пользователя, токен)
+user_cache = TTLCache(settings.auth_cache_size, settings.auth_cache_ttl)
+
+# id записи или (id записи, вариант) -> (id пользователя, имя файла, ETag)
+record_cache = TTLCache(settings.record_cache_size, settings.auth_cache_ttl)
+
+
+# Пользователь изменился или удален: забываем все его токены
+def invalidate_user(user_id: int):
+    user_cache.delete_matching(lambda key: key[0] == user_id)
+
+
+# Запись изменилась или удалена
+def invalidate_record(record_id: str):
+    record_cache.delete_matching(lambda key: key == record_id or (isinstance(key, tuple) and key[0] == record_id))
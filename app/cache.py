@@ -0,0 +1,126 @@
+import datetime
+import hashlib
+import logging
+
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from .config import settings
+from .db import CachedFile
+from .storage import storage
+
+# Логгер модуля; обработчики настраиваются один раз при старте (logging_setup)
+cache_logger = logging.getLogger(__name__)
+
+
+# Ключ кэша: хэш содержимого WAV + настройки кодировщика
+def make_cache_key(wav_digest: str, encoder: str):
+    return hashlib.sha256(f'{wav_digest}:{encoder}'.encode()).hexdigest()
+
+
+# Ключ кэша варианта конвертации; основной MP3 остается под ключом файла, как до появления вариантов
+def rendition_key(cache_key: str, rendition: str, primary: str):
+    if rendition == primary:
+        return cache_key
+    return make_cache_key(cache_key, rendition)
+
+
+# INSERT ... ON CONFLICT есть в SQLite и PostgreSQL, но строится отдельно для каждого диалекта
+def dialect_insert(session):
+    return (postgresql if session.bind.dialect.name == 'postgresql' else sqlite).insert
+
+
+# Кэш результатов конвертации. Один MP3 на диске может принадлежать нескольким AudioRecord:
+# ref_count - число записей, ссылающихся на файл. Вытеснение убирает запись из кэша,
+# но удаляет файл, только если на него не ссылается ни одна аудиозапись.
+class ConversionCache:
+
+    def __init__(self, storage, max_bytes: int):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Ищем готовый MP3, возвращаем имя файла или None
+    async def lookup(self, session, key: str):
+        entry = await session.get(CachedFile, key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        # Файл пропал из хранилища - запись в кэше больше не годится
+        if not await self.storage.exists(entry.file_name):
+            cache_logger.error(f'Cached file is missing: {entry.file_name}')
+            await session.delete(entry)
+            await session.flush()
+            self.misses += 1
+            return None
+
+        entry.last_used = datetime.datetime.utcnow()
+        self.hits += 1
+        cache_logger.info(f'Cache hit {key}: {entry.file_name}')
+        return entry.file_name
+
+    # Запоминаем результат конвертации, refs - сколько записей сразу на него ссылаются.
+    # Одинаковые файлы, загруженные одновременно, конвертируются параллельно: запись добавляется
+    # одним INSERT ... ON CONFLICT DO NOTHING, и если тот же файл уже сохранил другой запрос,
+    # увеличиваем его счетчик и возвращаем его имя
+    async def store(self, session, key: str, file_name: str, refs: int = 1):
+        size = await self.storage.size(file_name)
+        inserted = (await session.execute(
+            dialect_insert(session)(CachedFile)
+            .values(key=key, file_name=file_name, size=size, ref_count=refs, last_used=datetime.datetime.utcnow())
+            .on_conflict_do_nothing(index_elements=[CachedFile.key])
+        )).rowcount
+        if inserted:
+            cache_logger.info(f'Cache store {key}: {file_name}, {size} bytes')
+            return file_name
+
+        stored = await self.add_reference(session, key, refs)
+        # Запись успели вытеснить - остаемся со своим файлом
+        return stored or file_name
+
+    # Еще одна аудиозапись ссылается на файл из кэша. Счетчик увеличивается на стороне базы,
+    # чтобы одновременные запросы не теряли ссылки; возвращаем имя файла или None, если записи нет
+    async def add_reference(self, session, key: str, refs: int = 1):
+        return await session.scalar(
+            update(CachedFile)
+            .where(CachedFile.key == key)
+            .values(ref_count=CachedFile.ref_count + refs, last_used=datetime.datetime.utcnow())
+            .returning(CachedFile.file_name)
+            .execution_options(synchronize_session=False)
+        )
+
+    # Вытесняем давно не использованные записи, пока кэш больше лимита
+    async def evict(self, session):
+        total = await session.scalar(select(func.coalesce(func.sum(CachedFile.size), 0)))
+        if total <= self.max_bytes:
+            return
+
+        entries = await session.stream_scalars(select(CachedFile).order_by(CachedFile.last_used))
+        async for entry in entries:
+            if total <= self.max_bytes:
+                break
+
+            total -= entry.size
+            await session.delete(entry)
+            self.evictions += 1
+
+            if entry.ref_count <= 0:
+                await self.storage.remove([entry.file_name])
+                cache_logger.info(f'Evict {entry.key}, delete {entry.file_name}')
+            else:
+                cache_logger.info(f'Evict {entry.key}, keep {entry.file_name}: {entry.ref_count} records')
+
+        await entries.close()
+        await session.commit()
+
+    async def stats(self, session):
+        entries, size = (await session.execute(
+            select(func.count(CachedFile.key), func.coalesce(func.sum(CachedFile.size), 0)))).one()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': entries, 'bytes': size, 'max_bytes': self.max_bytes}
+
+
+conversion_cache = ConversionCache(storage, settings.cache_max_bytes)
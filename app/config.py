@@ -1,9 +1,139 @@
+import os
+
 from pydantic import BaseSettings, Field
 
 
 class Settings(BaseSettings):
     db_url: str = Field(..., env='DATABASE_URL')
     host_url: str = Field(..., env='HOST_URL')
+    # Папка для хранения аудио файлов
+    audio_folder: str = Field('../audio/', env='AUDIO_FOLDER')
+
+    # Хранилище готовых файлов: local - папка на диске (STORAGE_FOLDER, по умолчанию audio_folder),
+    # s3 - S3-совместимое хранилище (нужен boto3); audio_folder остается рабочей папкой конвертации
+    storage: str = Field('local', env='STORAGE')
+    storage_folder: str = Field('', env='STORAGE_FOLDER')
+    s3_bucket: str = Field('', env='S3_BUCKET')
+    s3_prefix: str = Field('', env='S3_PREFIX')
+    s3_endpoint_url: str = Field('', env='S3_ENDPOINT_URL')
+    s3_region: str = Field('', env='S3_REGION')
+    s3_access_key: str = Field('', env='S3_ACCESS_KEY')
+    s3_secret_key: str = Field('', env='S3_SECRET_KEY')
+    s3_connections: int = Field(20, env='S3_CONNECTIONS')
+    # Размер части при загрузке multipart, байты (не меньше 5 MiB по правилам S3)
+    s3_multipart_bytes: int = Field(8 * 1024 ** 2, env='S3_MULTIPART_BYTES')
+    # Время жизни подписанной ссылки на скачивание, секунды
+    s3_presign_ttl: int = Field(3600, env='S3_PRESIGN_TTL')
+
+    # Пул соединений с базой данных
+    db_pool_size: int = Field(10, env='DB_POOL_SIZE')
+    db_max_overflow: int = Field(20, env='DB_MAX_OVERFLOW')
+    # Через сколько секунд пересоздавать соединение
+    db_pool_recycle: int = Field(1800, env='DB_POOL_RECYCLE')
+
+    # Логи: папка (файл app-<pid>.log на процесс), ротация по размеру, формат json или text
+    log_dir: str = Field('.', env='LOG_DIR')
+    log_level: str = Field('INFO', env='LOG_LEVEL')
+    log_format: str = Field('json', env='LOG_FORMAT')
+    log_max_bytes: int = Field(10 * 1024 ** 2, env='LOG_MAX_BYTES')
+    log_backup_count: int = Field(5, env='LOG_BACKUP_COUNT')
+    # Файлы логов завершившихся процессов удаляются, если в них не писали дольше, секунды (0 - не удалять)
+    log_retention: float = Field(7 * 24 * 3600, env='LOG_RETENTION')
+
+    # Кэш проверенных токенов и записей для скачивания
+    auth_cache_ttl: float = Field(300, env='AUTH_CACHE_TTL')
+    auth_cache_size: int = Field(10000, env='AUTH_CACHE_SIZE')
+    record_cache_size: int = Field(10000, env='RECORD_CACHE_SIZE')
+
+    # Cache-Control для скачивания MP3: содержимое записи не меняется
+    download_cache_control: str = Field('public, max-age=86400', env='DOWNLOAD_CACHE_CONTROL')
+
+    # Пул процессов для конвертации (по умолчанию - по числу ядер)
+    convert_pool_size: int = Field(os.cpu_count() or 1, env='CONVERT_POOL_SIZE')
+    # Сколько задач может ждать свободный процесс, сверх этого - 503
+    convert_queue_size: int = Field(32, env='CONVERT_QUEUE_SIZE')
+    # Таймаут на конвертацию одного файла, секунды
+    convert_timeout: float = Field(120, env='CONVERT_TIMEOUT')
+    # Сколько файлов одного запроса конвертируются одновременно
+    request_concurrency: int = Field(5, env='REQUEST_CONCURRENCY')
+    # Планировщик конвертаций: одновременных конвертаций всего (0 - по числу процессов пула, для внешнего
+    # api - по числу соединений) и у одного пользователя (0 - без ограничения), веса пользователей
+    # для справедливой очереди: "id:вес" через запятую, по умолчанию вес 1
+    scheduler_slots: int = Field(0, env='SCHEDULER_SLOTS')
+    user_conversion_limit: int = Field(0, env='USER_CONVERSION_LIMIT')
+    user_weights: str = Field('', env='USER_WEIGHTS')
+
+    # Ограничения на загрузку, байты
+    max_file_bytes: int = Field(100 * 1024 * 1024, env='MAX_FILE_BYTES')
+    max_request_bytes: int = Field(500 * 1024 * 1024, env='MAX_REQUEST_BYTES')
+    # Размер куска при потоковом сохранении загрузки
+    upload_chunk_size: int = Field(64 * 1024, env='UPLOAD_CHUNK_SIZE')
+
+    # Сколько дополнительных вариантов (кодек/битрейт) можно заказать на один файл
+    max_renditions: int = Field(4, env='MAX_RENDITIONS')
+
+    # yes - добавлять в ответ POST /audio время этапов обработки (timings), миллисекунды
+    debug_timings: str = Field('no', env='DEBUG_TIMINGS')
+
+    # Пакетная загрузка архивом (POST /audio/bulk): размер архива, число файлов
+    # и сколько файлов архива обрабатываются одновременно
+    bulk_max_bytes: int = Field(10 * 1024 ** 3, env='BULK_MAX_BYTES')
+    bulk_max_files: int = Field(1000, env='BULK_MAX_FILES')
+    bulk_concurrency: int = Field(5, env='BULK_CONCURRENCY')
+
+    # Кэш конвертации одинаковых файлов: yes/no и размер, байты
+    cache_enabled: str = Field('yes', env='CACHE_ENABLED')
+    cache_max_bytes: int = Field(1024 ** 3, env='CACHE_MAX_BYTES')
+
+    # Настройки встроенного кодировщика LAME (FFMPEG=lame)
+    lame_bitrate: int = Field(128, env='LAME_BITRATE')
+    # Качество: 0 - лучшее и самое медленное, 9 - худшее и самое быстрое. При 7 скорость близка к ffmpeg,
+    # при 2 конвертация примерно в 5 раз медленнее (см. Readme)
+    lame_quality: int = Field(7, env='LAME_QUALITY')
+    # Число каналов MP3: 0 - как в исходном файле, 1 - моно, 2 - стерео
+    lame_channels: int = Field(0, env='LAME_CHANNELS')
+
+    # Внешний сервис zamzar.com (FFMPEG=no)
+    api_key: str = Field('', env='API_KEY')
+    zamzar_url: str = Field('https://sandbox.zamzar.com/v1', env='ZAMZAR_URL')
+    # Пул соединений общей сессии
+    zamzar_connections: int = Field(20, env='ZAMZAR_CONNECTIONS')
+    zamzar_keepalive: float = Field(30, env='ZAMZAR_KEEPALIVE')
+    # Повторы при 429/5xx и сетевых ошибках: пауза удваивается от retry_delay до retry_max_delay
+    zamzar_retries: int = Field(3, env='ZAMZAR_RETRIES')
+    zamzar_retry_delay: float = Field(1, env='ZAMZAR_RETRY_DELAY')
+    zamzar_retry_max_delay: float = Field(30, env='ZAMZAR_RETRY_MAX_DELAY')
+    # Опрос статуса задачи: интервал растет в poll_backoff раз до poll_max_interval
+    zamzar_poll_interval: float = Field(0.5, env='ZAMZAR_POLL_INTERVAL')
+    zamzar_poll_backoff: float = Field(1.5, env='ZAMZAR_POLL_BACKOFF')
+    zamzar_poll_max_interval: float = Field(10, env='ZAMZAR_POLL_MAX_INTERVAL')
+    # Общее время ожидания конвертации одного файла, секунды
+    zamzar_timeout: float = Field(300, env='ZAMZAR_TIMEOUT')
+
+    # Фоновый режим: POST /audio сразу отвечает 202 и id задач
+    job_mode: str = Field('no', env='JOB_MODE')
+    # Запускать обработчик задач внутри приложения (или отдельно: python -m app.jobs)
+    job_worker: str = Field('yes', env='JOB_WORKER')
+    # Пауза между проверками очереди задач, секунды
+    job_poll_interval: float = Field(1, env='JOB_POLL_INTERVAL')
+    # Срок аренды задачи в статусе running, секунды: обработчик продлевает ее, пока задача выполняется;
+    # задачи с истекшей арендой (обработчик убит) возвращаются в очередь
+    job_lease: float = Field(300, env='JOB_LEASE')
+    # Максимум задач в одном запросе статуса
+    job_status_batch: int = Field(100, env='JOB_STATUS_BATCH')
+
+    # Уборка файлов, на которые нет ссылок в базе: период, секунды (0 - выключена),
+    # минимальный возраст файла, секунды, и сколько файлов проверять одним запросом к базе
+    janitor_interval: float = Field(3600, env='JANITOR_INTERVAL')
+    janitor_min_age: float = Field(6 * 3600, env='JANITOR_MIN_AGE')
+    janitor_batch: int = Field(500, env='JANITOR_BATCH')
+
+    # Список записей пользователя: размер страницы по умолчанию и максимальный
+    records_page_size: int = Field(50, env='RECORDS_PAGE_SIZE')
+    records_page_max: int = Field(500, env='RECORDS_PAGE_MAX')
+
+    class Config:
+        env_file = os.path.join(os.path.dirname(__file__), '..', '.env')
 
 
 settings = Settings()
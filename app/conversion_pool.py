@@ -0,0 +1,89 @@
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from .config import settings
+from .logging_setup import setup_worker_logging
+from .metrics import conversion_pool_in_flight, conversion_pool_queue_depth
+
+# Логгер модуля; обработчики настраиваются один раз при старте (logging_setup)
+conversion_pool_logger = logging.getLogger(__name__)
+
+
+class PoolBusyError(Exception):
+    pass
+
+
+class ConversionTimeoutError(Exception):
+    pass
+
+
+class ConversionPool:
+
+    def __init__(self, workers: int, max_queue: int, timeout: float):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = None
+        # Задачи, отправленные в пул и еще не завершенные в процессе-воркере
+        self._pending = 0
+
+    @property
+    def in_flight(self):
+        return min(self._pending, self.workers)
+
+    @property
+    def queue_depth(self):
+        return max(self._pending - self.workers, 0)
+
+    def start(self):
+        if self._executor is None:
+            # Процессы пула пишут лог в свои файлы app-<pid>.log
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=setup_worker_logging)
+            conversion_pool_logger.info(f'Start process pool: {self.workers} workers, queue {self.max_queue}')
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            conversion_pool_logger.info('Shutdown process pool')
+
+    def _release(self, loop):
+        loop.call_soon_threadsafe(self._decrement)
+
+    def _decrement(self):
+        self._set_pending(self._pending - 1)
+
+    def _set_pending(self, pending: int):
+        self._pending = pending
+        conversion_pool_in_flight.set(self.in_flight)
+        conversion_pool_queue_depth.set(self.queue_depth)
+
+    async def run(self, func, *args):
+
+        # Очередь заполнена - отказываем сразу, а не копим задачи в памяти
+        if self._pending >= self.workers + self.max_queue:
+            conversion_pool_logger.error(f'Pool is busy: {self._pending} pending tasks')
+            raise PoolBusyError('Conversion queue is full')
+
+        self.start()
+        loop = asyncio.get_running_loop()
+
+        # Счетчик уменьшаем только когда процесс реально освободился,
+        # а не когда обработчик перестал ждать (например, по таймауту)
+        self._set_pending(self._pending + 1)
+        task = self._executor.submit(partial(func, *args))
+        task.add_done_callback(lambda _: self._release(loop))
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(task), self.timeout)
+        except asyncio.TimeoutError:
+            # Задачу, которая еще не начала выполняться, можно снять с очереди;
+            # уже запущенная досчитается в своем процессе
+            task.cancel()
+            conversion_pool_logger.error(f'Conversion timeout {self.timeout}s: {args}')
+            raise ConversionTimeoutError(f'Conversion took longer than {self.timeout} seconds')
+
+
+conversion_pool = ConversionPool(settings.convert_pool_size, settings.convert_queue_size, settings.convert_timeout)
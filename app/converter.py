@@ -0,0 +1,160 @@
+import importlib
+import os
+import time
+
+from dotenv import load_dotenv
+
+from .config import settings
+from .conversion_pool import ConversionTimeoutError, conversion_pool
+from .metrics import conversion_seconds, conversions_in_flight
+from .renditions import CODECS, Rendition, rendition_file
+from .scheduler import ConversionScheduler, parse_weights
+from .storage import storage
+
+# Узнаем режим работы (самостоятельный или с помощью внешнего api)
+dotenv_path = os.path.join(os.path.dirname(__file__), '..', '.env')
+load_dotenv(dotenv_path)
+FFMPEG = os.getenv('FFMPEG')
+
+# Названия способов конвертации для метрик
+BACKENDS = {'yes': 'ffmpeg', 'lame': 'lame', 'no': 'zamzar'}
+
+# Модули способов конвертации импортируются только для выбранного режима:
+# pydub, lameenc и aiohttp не загружаются в процессы, которым они не нужны
+BACKEND_MODULES = {'yes': 'ffmpeg_convert', 'lame': 'lame_convert', 'no': 'async_wav_to_mp3'}
+
+# Все конвертации проходят через планировщик: по слоту на процесс пула (для внешнего api - на соединение),
+# очередь между пользователями справедливая, в ней те же CONVERT_QUEUE_SIZE мест, что были у пула
+conversion_scheduler = ConversionScheduler(
+    settings.scheduler_slots or (settings.zamzar_connections if FFMPEG == 'no' else settings.convert_pool_size),
+    settings.user_conversion_limit, settings.convert_queue_size, parse_weights(settings.user_weights))
+
+
+class UnknownModeError(Exception):
+    pass
+
+
+def backend_module():
+    if FFMPEG not in BACKEND_MODULES:
+        raise UnknownModeError('Need to choose the conversion mode: ffmpeg, lame or external api')
+    return importlib.import_module(f'.{BACKEND_MODULES[FFMPEG]}', __package__)
+
+
+# Подготовка выбранного способа при старте: модуль импортируется до запуска пула, чтобы процессы пула
+# получили его готовым; для внешнего api открывается сессия. Неизвестный режим - ошибка при конвертации
+async def start_backend():
+    if FFMPEG in ('yes', 'lame'):
+        backend_module()
+        conversion_pool.start()
+    elif FFMPEG == 'no':
+        await backend_module().start_session()
+
+
+async def stop_backend():
+    conversion_pool.shutdown()
+    if FFMPEG == 'no':
+        await backend_module().close_session()
+
+
+# Настройки кодировщика, от которых зависит результат - часть ключа кэша
+def encoder_signature():
+    if FFMPEG == 'lame':
+        return f'lame:{settings.lame_bitrate}:{settings.lame_quality}:{settings.lame_channels}'
+    if FFMPEG == 'yes':
+        return 'ffmpeg:mp3'
+    return 'zamzar:mp3'
+
+
+# Основной MP3 режима, на него ссылается AudioRecord.file_name
+def primary_rendition():
+    if FFMPEG == 'lame':
+        return Rendition('mp3', settings.lame_bitrate)
+    return Rendition('mp3')
+
+
+# Кодеки дополнительных вариантов, которые умеет выбранный способ конвертации
+def supported_codecs():
+    if FFMPEG == 'yes':
+        return tuple(CODECS)
+    if FFMPEG == 'lame':
+        return ('mp3',)
+    return ()
+
+
+# Основной MP3 называется как раньше, варианты - с суффиксом кодека и битрейта
+def target_file(wav_audio_file: str, rendition: Rendition):
+    if rendition == primary_rendition():
+        return wav_audio_file.replace('.wav', '.mp3')
+    return rendition_file(wav_audio_file, rendition)
+
+
+# Конвертация WAV в несколько вариантов выбранным способом, общая для запросов и фоновых задач.
+# WAV декодируется один раз на все варианты. Возвращает ({имя варианта: файл}, ошибки),
+# готовые файлы уже перенесены из рабочей папки в хранилище. user_id - чья это конвертация
+# для планировщика; PoolBusyError - очередь планировщика заполнена
+async def convert_renditions(wav_audio_file: str, folder: str, renditions, user_id: int = None):
+    backend = BACKENDS.get(FFMPEG)
+    if backend is None:
+        raise UnknownModeError('Need to choose the conversion mode: ffmpeg, lame or external api')
+
+    # Размер WAV - стоимость конвертации для планировщика: маленькие файлы проходят раньше
+    try:
+        size = os.path.getsize(os.path.join(folder, wav_audio_file))
+    except OSError:
+        size = 0
+
+    async with conversion_scheduler.slot(user_id, size):
+        # Время считаем только для принятых конвертаций: ожидание в очереди сюда не попадает
+        started = time.perf_counter()
+        with conversions_in_flight.labels(backend).track_inprogress():
+            converted, errors = await convert_with_backend(wav_audio_file, folder, renditions)
+        conversion_seconds.labels(backend).observe(time.perf_counter() - started)
+
+    stored = {}
+    for name, file_name in converted.items():
+        try:
+            await storage.put(file_name)
+            stored[name] = file_name
+        except Exception as e:
+            errors.append({wav_audio_file: f'Error store {file_name}: {e}'})
+            file_path = os.path.join(folder, file_name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+    return stored, errors
+
+
+async def convert_with_backend(wav_audio_file: str, folder: str, renditions):
+    targets = [(rendition, target_file(wav_audio_file, rendition)) for rendition in renditions]
+    module = backend_module()
+
+    if FFMPEG == 'yes':
+
+        # Все варианты одним запуском ffmpeg в пуле процессов
+        try:
+            return await conversion_pool.run(module.wav_to_renditions, wav_audio_file, folder, targets)
+        except ConversionTimeoutError as e:
+            return {}, [{wav_audio_file: str(e)}]
+
+    elif FFMPEG == 'lame':
+
+        # Встроенный кодировщик LAME без запуска ffmpeg: один проход по PCM на все битрейты
+        try:
+            return await conversion_pool.run(module.wav_to_renditions, wav_audio_file, folder, targets,
+                                             None, settings.lame_quality, settings.lame_channels)
+        except ConversionTimeoutError as e:
+            return {}, [{wav_audio_file: str(e)}]
+
+    elif FFMPEG == 'no':
+
+        # Внешний API конвертирует только в основной MP3
+        primary = primary_rendition()
+        errors = [{wav_audio_file: f'Rendition {rendition.name} is not supported by external api'}
+                  for rendition in renditions if rendition != primary]
+        if primary not in renditions:
+            return {}, errors
+
+        # Преобразуем WAV в MP3 с помощью стороннего API
+        converted_to_mp3, convert_errors = await module.convert_file(wav_audio_file, "mp3", folder)
+        return ({primary.name: converted_to_mp3} if converted_to_mp3 else {}), convert_errors + errors
+
+    raise UnknownModeError('Need to choose the conversion mode: ffmpeg, lame or external api')
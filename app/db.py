@@ -1,29 +1,144 @@
-import sqlalchemy
-from sqlalchemy import Column, ForeignKey, Integer, String
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+import datetime
+
+from sqlalchemy import BigInteger, Column, DateTime, Float, ForeignKey, Index, Integer, String
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base, relationship
 
 from .config import settings
+from .metrics import instrument_engine
 
 Base = declarative_base()
-metadata = sqlalchemy.MetaData()
+
+# Асинхронные драйверы для строк подключения без явного драйвера
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'postgres': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
 
 
 class User(Base):
     __tablename__ = 'users'
+    __table_args__ = (
+        # Проверка уникальности имени при регистрации
+        Index('ix_users_name', 'name', unique=True),
+        # Проверка X-User-ID + X-Token
+        Index('ix_users_id_token', 'id', 'token'),
+    )
     id = Column(Integer, primary_key=True)
     name = Column(String)
     token = Column(String)
     audio_record = relationship("AudioRecord", back_populates="user")
+    conversion_jobs = relationship("ConversionJob", back_populates="user")
 
 
 class AudioRecord(Base):
     __tablename__ = 'audio_records'
+    __table_args__ = (
+        # Список записей пользователя: постраничная выборка по (created_at, id)
+        Index('ix_audio_records_user_created', 'user_id', 'created_at', 'id'),
+    )
     id = Column(String, primary_key=True)
-    file_name = Column(String)
-    user_id = Column(Integer, ForeignKey('users.id'))
+    # Индекс - для проверки файлов на диске уборкой (janitor)
+    file_name = Column(String, index=True)
+    # Строгий ETag содержимого MP3 для условных запросов на скачивание
+    etag = Column(String, nullable=True)
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
+    # Сведения из заголовка WAV и о результате конвертации; у старых записей пустые
+    source_name = Column(String, nullable=True)
+    duration = Column(Float, nullable=True)
+    sample_rate = Column(Integer, nullable=True)
+    channels = Column(Integer, nullable=True)
+    bits_per_sample = Column(Integer, nullable=True)
+    wav_size = Column(BigInteger, nullable=True)
+    mp3_size = Column(BigInteger, nullable=True)
+    # Время конвертации всех вариантов файла, секунды; None - результат взят из кэша
+    conversion_seconds = Column(Float, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
     user = relationship("User", back_populates="audio_record")
+    renditions = relationship("AudioRendition", back_populates="record")
+
+
+# Дополнительный вариант аудиозаписи (другой кодек или битрейт), основной MP3 - AudioRecord.file_name
+class AudioRendition(Base):
+    __tablename__ = 'audio_renditions'
+    record_id = Column(String, ForeignKey('audio_records.id'), primary_key=True)
+    name = Column(String, primary_key=True)
+    file_name = Column(String, index=True)
+    etag = Column(String, nullable=True)
+    record = relationship("AudioRecord", back_populates="renditions")
+
+
+# Фоновая задача конвертации: queued -> running -> done/failed
+class ConversionJob(Base):
+    __tablename__ = 'conversion_jobs'
+    id = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    source_name = Column(String)
+    wav_file = Column(String)
+    cache_key = Column(String, nullable=True)
+    # Дополнительные варианты через запятую: mp3-320,opus-64
+    renditions = Column(String, nullable=True)
+    # Размер WAV: из очереди меньшие файлы забираются раньше
+    wav_size = Column(Integer, nullable=True)
+    status = Column(String, index=True)
+    record_id = Column(String, ForeignKey('audio_records.id'), nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    user = relationship("User", back_populates="conversion_jobs")
+
+
+# Кэш конвертации: ключ - хэш WAV и настроек кодировщика, file_name - готовый MP3
+class CachedFile(Base):
+    __tablename__ = 'conversion_cache'
+    key = Column(String, primary_key=True)
+    file_name = Column(String)
+    size = Column(Integer)
+    ref_count = Column(Integer, default=0)
+    last_used = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+
+# postgresql://... -> postgresql+asyncpg://..., sqlite://... -> sqlite+aiosqlite://...
+def async_db_url(db_url: str):
+    url = make_url(db_url)
+    if url.drivername in ASYNC_DRIVERS:
+        url = url.set(drivername=ASYNC_DRIVERS[url.drivername])
+    return url
+
+
+def create_engine(db_url: str):
+    url = async_db_url(db_url)
+
+    # У SQLite свой пул, настройки размера к нему не применяются
+    if url.get_backend_name() == 'sqlite':
+        return create_async_engine(url)
+
+    return create_async_engine(url, pool_size=settings.db_pool_size, max_overflow=settings.db_max_overflow,
+                               pool_recycle=settings.db_pool_recycle, pool_pre_ping=True)
+
+
+# Один движок и пул соединений на процесс. Создается при старте (start_engine), а не при импорте:
+# драйвер базы загружается, только когда процессу нужна база
+engine = None
+SessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False)
+
+
+# Повторный вызов возвращает уже созданный движок
+def start_engine():
+    global engine
+    if engine is None:
+        engine = create_engine(settings.db_url)
+        instrument_engine(engine)
+        SessionLocal.configure(bind=engine)
+    return engine
+
+
+async def dispose_engine():
+    global engine
+    if engine is not None:
+        await engine.dispose()
+        engine = None
 
 
-engine = sqlalchemy.create_engine(settings.db_url)
-metadata.create_all(engine)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Зависимость FastAPI: сессия на время запроса
+async def get_session():
+    async with SessionLocal() as session:
+        yield session
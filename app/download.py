@@ -0,0 +1,152 @@
+import hashlib
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+
+from .config import settings
+from .metrics import download_bytes
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+# Строгий ETag по содержимому файла, считается один раз при сохранении записи
+def file_etag(file_path: str):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+# Разбор заголовка Range: (начало, конец) включительно, None - отдавать файл целиком,
+# ValueError - диапазон не пересекается с файлом (416)
+def parse_range(range_header: str, size: int):
+    match = RANGE_PATTERN.match(range_header.strip())
+
+    # Несколько диапазонов и другие единицы не поддерживаем - по RFC 9110 можно отдать весь файл
+    if not match or match.groups() == ('', ''):
+        return None
+
+    start, end = match.groups()
+    if start == '':
+        # bytes=-N: последние N байт
+        length = int(end)
+        if length == 0:
+            raise ValueError('Empty suffix range')
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    # bytes=5-2 (конец раньше начала) синтаксически неверен - по RFC 9110 заголовок игнорируется
+    if end and int(end) < start:
+        return None
+    if start >= size:
+        raise ValueError('Range not satisfiable')
+    end = min(int(end), size - 1) if end else size - 1
+    return start, end
+
+
+# If-None-Match совпадает с ETag файла
+def etag_matches(request_headers: Headers, etag: str):
+    if_none_match = request_headers.get('if-none-match')
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags
+
+
+def not_modified(request_headers: Headers, etag: str, mtime: float):
+    if request_headers.get('if-none-match') is not None:
+        return etag_matches(request_headers, etag)
+
+    if_modified_since = request_headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+# If-Range: диапазон применяется, только если файл не изменился
+def range_applies(request_headers: Headers, etag: str, last_modified: str):
+    if_range = request_headers.get('if-range')
+    return if_range is None or if_range in (etag, last_modified)
+
+
+# Отдача аудиофайла с поддержкой Range (206), условных запросов (304) и кэширования.
+# Тело отправляется через расширение ASGI zerocopy (sendfile), если сервер его поддерживает
+class AudioFileResponse(FileResponse):
+
+    def __init__(self, path: str, request_headers: Headers, etag: str, filename: str, method: str = None,
+                 media_type: str = 'audio/mpeg'):
+        super().__init__(path, filename=filename, media_type=media_type, method=method)
+        self.request_headers = request_headers
+        self.etag = etag
+        self.range = None
+
+    async def __call__(self, scope, receive, send):
+        stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+        size = stat_result.st_size
+        last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+
+        self.headers['etag'] = self.etag
+        self.headers['last-modified'] = last_modified
+        self.headers['cache-control'] = settings.download_cache_control
+        self.headers['accept-ranges'] = 'bytes'
+
+        if not_modified(self.request_headers, self.etag, stat_result.st_mtime):
+            await Response(status_code=304, headers=self.not_modified_headers())(scope, receive, send)
+            download_bytes.labels('304').observe(0)
+            return
+
+        start, end = 0, size - 1
+        range_header = self.request_headers.get('range')
+        if range_header and range_applies(self.request_headers, self.etag, last_modified):
+            try:
+                self.range = parse_range(range_header, size)
+            except ValueError:
+                await Response(status_code=416, headers={'content-range': f'bytes */{size}'})(scope, receive, send)
+                return
+
+        if self.range is not None:
+            start, end = self.range
+            self.status_code = 206
+            self.headers['content-range'] = f'bytes {start}-{end}/{size}'
+        self.headers['content-length'] = str(end - start + 1)
+
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+
+        if self.send_header_only or size == 0:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        elif 'http.response.zerocopy' in scope.get('extensions', {}):
+            await self.send_zerocopy(send, start, end - start + 1)
+        else:
+            await self.send_chunks(send, start, end - start + 1)
+
+        download_bytes.labels(str(self.status_code)).observe(0 if self.send_header_only else end - start + 1)
+
+    def not_modified_headers(self):
+        return {key: self.headers[key]
+                for key in ('etag', 'last-modified', 'cache-control', 'accept-ranges') if key in self.headers}
+
+    async def send_zerocopy(self, send, offset: int, count: int):
+        with open(self.path, 'rb') as file:
+            await send({'type': 'http.response.zerocopy', 'file': file.fileno(),
+                        'offset': offset, 'count': count, 'more_body': False})
+
+    async def send_chunks(self, send, offset: int, count: int):
+        async with await anyio.open_file(self.path, mode='rb') as file:
+            await file.seek(offset)
+            while count > 0:
+                chunk = await file.read(min(self.chunk_size, count))
+                if not chunk:
+                    break
+                count -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': count > 0})
+            if count > 0:
+                # Файл укоротился во время отправки - закрываем тело ответа
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
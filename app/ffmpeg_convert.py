@@ -1,52 +1,63 @@
 import logging
 import os
+import subprocess
 
-from pydub import AudioSegment
+from pydub.utils import get_encoder_name
 
-# Получение пользовательского логгера и установка уровня логирования
-ffmpeg_convert_logger = logging.getLogger(__name__)
-ffmpeg_convert_logger.setLevel(logging.INFO)
-
-# Настройка обработчика и форматировщика
-ffmpeg_convert_handler = logging.FileHandler(f"{__name__}.log", mode='w')
-ffmpeg_convert_formatter = logging.Formatter("%(name)s %(asctime)s %(levelname)s %(message)s")
-
-# добавление форматировщика к обработчику
-ffmpeg_convert_handler.setFormatter(ffmpeg_convert_formatter)
+from .files import remove_file, temp_path
+from .renditions import CODECS, Rendition
 
-# добавление обработчика к логгеру
-ffmpeg_convert_logger.addHandler(ffmpeg_convert_handler)
+# Логгер модуля; обработчики настраиваются один раз при старте (logging_setup)
+ffmpeg_convert_logger = logging.getLogger(__name__)
 
 
-def wav_to_mp3(wav_file: str, audio_folder: str, converting_errors=None):
+# Несколько вариантов за один запуск ffmpeg: WAV читается и декодируется один раз,
+# каждый выход кодируется своим кодировщиком. targets - список (Rendition, имя файла)
+def wav_to_renditions(wav_file: str, audio_folder: str, targets, converting_errors=None):
 
-    ffmpeg_convert_logger.info(f'Start convert {wav_file}')
+    ffmpeg_convert_logger.info(f'Start convert {wav_file} to {[rendition.name for rendition, _ in targets]}')
 
-    # cписок для ошибок ошибок
+    # cписок для ошибок
     if converting_errors is None:
         converting_errors = []
     else:
         converting_errors[:] = []
 
     wav_file_path = os.path.join(audio_folder, wav_file)
-    mp3_filename = wav_file.replace('.wav', '.mp3')
-    mp3_file_path = os.path.join(audio_folder, mp3_filename)
-
-    # Конвертируем wav в mp3
+    command = [get_encoder_name(), '-nostdin', '-hide_banner', '-loglevel', 'error', '-y', '-i', wav_file_path]
+    for rendition, file_name in targets:
+        command += ['-map', '0:a', '-c:a', CODECS[rendition.codec].encoder]
+        if rendition.bitrate:
+            command += ['-b:a', f'{rendition.bitrate}k']
+        command.append(temp_path(os.path.join(audio_folder, file_name)))
+
+    converted = {}
     try:
-        AudioSegment.from_wav(wav_file_path).export(mp3_file_path, format="mp3")
-        ffmpeg_convert_logger.info(f'Convert complete: {mp3_filename}')
+        result = subprocess.run(command, capture_output=True)
+        if result.returncode != 0:
+            message = result.stderr.decode(errors='replace').strip()
+            raise RuntimeError(message or f'ffmpeg exit code {result.returncode}')
+        for _, file_name in targets:
+            file_path = os.path.join(audio_folder, file_name)
+            os.replace(temp_path(file_path), file_path)
+        converted = {rendition.name: file_name for rendition, file_name in targets}
+        ffmpeg_convert_logger.info(f'Convert complete: {list(converted.values())}')
     except Exception as e:
-        mp3_filename = ''
+        # Удаляем недописанные и уже переименованные файлы
+        for _, file_name in targets:
+            file_path = os.path.join(audio_folder, file_name)
+            remove_file(temp_path(file_path))
+            remove_file(file_path)
         ffmpeg_convert_logger.error(f'Error convert {wav_file}: {str(e)}')
         converting_errors.append({wav_file: f'Error convert: {str(e)}'})
 
-    return mp3_filename, converting_errors
+    return converted, converting_errors
 
 
 if __name__ == "__main__":
     # D:\projects\users_audio\audio\sample-3s.wav
     wav_audio_file = 'sample-3s.wav'
     folder_for_audio = 'D:/projects/users_audio/audio/'
-    converted_to_mp3, errors = wav_to_mp3(wav_audio_file, folder_for_audio)
+    converted_to_mp3, errors = wav_to_renditions(wav_audio_file, folder_for_audio,
+                                                 [(Rendition('mp3'), wav_audio_file.replace('.wav', '.mp3'))])
     print(converted_to_mp3, errors, sep='\n')
@@ -0,0 +1,27 @@
+import os
+
+# Файлы пишутся под временным именем и переименовываются, когда записаны целиком: оборванная запись
+# не оставляет файла под итоговым именем. Расширение сохраняется - по нему ffmpeg выбирает формат
+TEMP_MARKER = '.part'
+
+
+def temp_path(file_path: str):
+    root, extension = os.path.splitext(file_path)
+    return f'{root}{TEMP_MARKER}{extension}'
+
+
+# Недописанный файл: его можно удалять, когда он старше времени любой записи
+def is_temp(file_name: str):
+    return os.path.splitext(file_name)[0].endswith(TEMP_MARKER)
+
+
+# Имя сохраняемого WAV: имя загруженного файла без папок и расширения и id записи
+def upload_file_name(file_name: str, audio_id: str):
+    return f'{os.path.splitext(os.path.basename(file_name))[0]}-{audio_id}.wav'
+
+
+def remove_file(file_path: str):
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
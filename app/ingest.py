@@ -0,0 +1,117 @@
+import logging
+import os
+import time
+
+from .auth_cache import record_cache
+from .cache import conversion_cache, rendition_key
+from .config import settings
+from .conversion_pool import PoolBusyError
+from .converter import convert_renditions, primary_rendition
+from .db import AudioRecord, AudioRendition, SessionLocal
+from .storage import storage
+
+# Логгер модуля; обработчики настраиваются один раз при старте (logging_setup)
+ingest_logger = logging.getLogger(__name__)
+
+
+# Сохраняем запись и ее варианты отдельной транзакцией. cached и converted - {имя варианта: файл}
+# из кэша и после конвертации, metadata - сведения об аудио для AudioRecord;
+# возвращает итоговые {имя варианта: файл}
+async def save_record(audio_id: str, user_id: int, cache_key: str, cached: dict, converted: dict,
+                      metadata: dict):
+    use_cache = settings.cache_enabled == 'yes' and cache_key is not None
+    primary = primary_rendition().name
+    files = {**cached, **converted}
+
+    async with SessionLocal() as session:
+        for name, file_name in files.items():
+            if not use_cache:
+                continue
+            key = rendition_key(cache_key, name, primary)
+            if name in cached:
+                await conversion_cache.add_reference(session, key)
+                continue
+            stored = await conversion_cache.store(session, key, file_name)
+
+            # Тот же файл успел сохранить другой запрос - ссылаемся на его файл
+            if stored != file_name:
+                await storage.remove([file_name])
+                files[name] = stored
+
+        etags = {name: await storage.etag(file_name) for name, file_name in files.items()}
+        mp3_size = await storage.size(files[primary])
+        session.add(AudioRecord(id=audio_id, file_name=files[primary], user_id=user_id, etag=etags[primary],
+                                mp3_size=mp3_size, **metadata))
+        session.add_all(AudioRendition(record_id=audio_id, name=name, file_name=file_name, etag=etags[name])
+                        for name, file_name in files.items() if name != primary)
+        await session.commit()
+
+        # Запись уже сохранена: ошибка вытеснения не должна приводить к удалению ее файлов
+        if use_cache:
+            try:
+                await conversion_cache.evict(session)
+            except Exception as e:
+                ingest_logger.exception(f'Cache eviction failed: {e}')
+
+    for name, file_name in files.items():
+        record_cache.set(audio_id if name == primary else (audio_id, name), (user_id, file_name, etags[name]))
+    return files
+
+
+# Полная обработка одного сохраненного WAV: кэш, конвертация в основной MP3 и дополнительные варианты,
+# запись в базе, удаление WAV. metadata - имя и сведения о WAV (wav_metadata) для AudioRecord.
+# Возвращает ({имя варианта: файл} или {}, ошибки). PoolBusyError пробрасывается, WAV при этом остается на диске
+async def ingest_file(audio_id: str, wav_audio_file: str, user_id: int, cache_key: str, folder: str,
+                      renditions=(), metadata: dict = None):
+    use_cache = settings.cache_enabled == 'yes' and cache_key is not None
+    primary = primary_rendition()
+    targets = [primary, *renditions]
+
+    # Те же варианты могли быть сконвертированы, пока этот файл ждал своей очереди
+    cached = {}
+    if use_cache:
+        async with SessionLocal() as session:
+            for rendition in targets:
+                key = rendition_key(cache_key, rendition.name, primary.name)
+                file_name = await conversion_cache.lookup(session, key)
+                if file_name:
+                    cached[rendition.name] = file_name
+            await session.commit()
+
+    # Конвертируем за один проход только то, чего нет в кэше
+    missing = [rendition for rendition in targets if rendition.name not in cached]
+    converted, errors = {}, []
+    conversion_seconds = None
+    if missing:
+        started = time.perf_counter()
+        try:
+            converted, errors = await convert_renditions(wav_audio_file, folder, missing, user_id)
+            conversion_seconds = round(time.perf_counter() - started, 3)
+        except PoolBusyError:
+            raise
+        except Exception as e:
+            ingest_logger.exception(f'Convert {wav_audio_file} failed: {e}')
+            errors = [{wav_audio_file: str(e)}]
+
+    # Удаляем временный файл WAV
+    wav_file_path = os.path.join(folder, wav_audio_file)
+    if os.path.exists(wav_file_path):
+        os.remove(wav_file_path)
+        ingest_logger.info(f'Delete temp {wav_file_path}')
+
+    # Без основного MP3 записи нет, варианты тоже не нужны
+    if primary.name not in cached and primary.name not in converted:
+        await storage.remove(converted.values())
+        return {}, errors
+
+    try:
+        files = await save_record(audio_id, user_id, cache_key, cached, converted,
+                                  {**(metadata or {}), 'conversion_seconds': conversion_seconds})
+    except Exception as e:
+        # Запись не сохранена - сконвертированные файлы никому не нужны
+        await storage.remove(converted.values())
+        ingest_logger.exception(f'Invalid access to database {e}')
+        return {}, [{wav_audio_file: f'Invalid access to database {e}'}]
+
+    ingest_logger.info(f'Save {audio_id}: {files}')
+    return files, errors
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import os
+import time
+
+from sqlalchemy import select
+from starlette.concurrency import run_in_threadpool
+
+from .config import settings
+from .db import AudioRecord, AudioRendition, CachedFile, ConversionJob, SessionLocal
+from .files import is_temp, remove_file
+from .jobs import JOB_QUEUED, JOB_RUNNING
+from .logging_setup import setup_logging
+from .metrics import janitor_reclaimed_bytes, janitor_removed_files
+from .storage import storage
+
+# Логгер модуля; обработчики настраиваются один раз при старте (logging_setup)
+janitor_logger = logging.getLogger(__name__)
+
+
+# Какие из имен файлов упоминаются в базе: записи, варианты, кэш и WAV задач, которые еще не обработаны
+async def referenced_files(file_names):
+    statements = (
+        select(AudioRecord.file_name).where(AudioRecord.file_name.in_(file_names)),
+        select(AudioRendition.file_name).where(AudioRendition.file_name.in_(file_names)),
+        select(CachedFile.file_name).where(CachedFile.file_name.in_(file_names)),
+        select(ConversionJob.wav_file).where(ConversionJob.wav_file.in_(file_names),
+                                             ConversionJob.status.in_((JOB_QUEUED, JOB_RUNNING))),
+    )
+    found = set()
+    async with SessionLocal() as session:
+        for statement in statements:
+            found.update(await session.scalars(statement))
+    return found
+
+
+def file_kind(file_name: str):
+    if is_temp(file_name):
+        return 'temp'
+    if file_name.endswith('.wav'):
+        return 'wav'
+    return 'audio'
+
+
+# Файлы рабочей папки пачками [(имя, размер, время изменения)]: WAV, недописанные файлы
+# и результаты конвертации, еще не перенесенные в хранилище
+async def list_work_files(batch_size: int):
+    def scan():
+        found = []
+        with os.scandir(settings.audio_folder) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    stat_result = entry.stat()
+                    found.append((entry.name, stat_result.st_size, stat_result.st_mtime))
+        return found
+
+    if not os.path.isdir(settings.audio_folder):
+        return
+    files = await run_in_threadpool(scan)
+    for start in range(0, len(files), batch_size):
+        yield files[start:start + batch_size]
+
+
+# Удаляем из пачки файлы старше deadline, на которые нет ссылок; недописанные файлы - без проверки
+async def sweep_batch(files, deadline: float, remove, stats: dict):
+    old_files = [(file_name, size) for file_name, size, mtime in files if mtime < deadline]
+    if not old_files:
+        return
+
+    references = await referenced_files([file_name for file_name, _ in old_files if not is_temp(file_name)])
+    orphans = [(file_name, size) for file_name, size in old_files if file_name not in references]
+    if not orphans:
+        return
+
+    await remove([file_name for file_name, _ in orphans])
+    for file_name, size in orphans:
+        kind = file_kind(file_name)
+        janitor_removed_files.labels(kind).inc()
+        janitor_reclaimed_bytes.labels(kind).inc(size)
+        stats['files'] += 1
+        stats['bytes'] += size
+    janitor_logger.info(f'Remove {len(orphans)} orphaned files: {[file_name for file_name, _ in orphans]}')
+
+
+# Один проход уборки: рабочая папка и хранилище сверяются с базой пачками по batch_size файлов.
+# Файлы моложе min_age не трогаем: они могут принадлежать запросу, который еще не записан в базу
+async def sweep(min_age: float = None, batch_size: int = None):
+    min_age = settings.janitor_min_age if min_age is None else min_age
+    batch_size = batch_size or settings.janitor_batch
+    deadline = time.time() - min_age
+    stats = {'files': 0, 'bytes': 0}
+
+    async def remove_work_files(file_names):
+        for file_name in file_names:
+            remove_file(os.path.join(settings.audio_folder, file_name))
+
+    async for files in list_work_files(batch_size):
+        await sweep_batch(files, deadline, remove_work_files, stats)
+
+    async for files in storage.list_files(batch_size):
+        await sweep_batch(files, deadline, storage.remove, stats)
+
+    janitor_logger.info(f'Janitor: removed {stats["files"]} files, {stats["bytes"]} bytes')
+    return stats
+
+
+# Фоновая уборка внутри приложения
+async def run_janitor(interval: float):
+    janitor_logger.info(f'Start janitor, interval {interval}s, min age {settings.janitor_min_age}s')
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await sweep()
+        except Exception as e:
+            janitor_logger.exception(f'Janitor failed: {e}')
+
+
+if __name__ == "__main__":
+    from .db import dispose_engine
+    from .migrations import start_database
+
+    async def main():
+        setup_logging()
+        await start_database()
+        await storage.start()
+        try:
+            print(await sweep())
+        finally:
+            await dispose_engine()
+
+    asyncio.run(main())
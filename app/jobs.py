@@ -0,0 +1,202 @@
+import asyncio
+import datetime
+import logging
+import os
+import signal
+import time
+
+from sqlalchemy import func, select, update
+
+from .config import settings
+from .conversion_pool import PoolBusyError
+from .db import ConversionJob, SessionLocal
+from .ingest import ingest_file
+from .logging_setup import job_id_var, setup_logging
+from .renditions import parse_rendition
+from .upload import InvalidWavError, read_wav_metadata
+
+# Логгер модуля; обработчики настраиваются один раз при старте (logging_setup)
+jobs_logger = logging.getLogger(__name__)
+
+# Статусы задач
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+# Забираем следующую задачу из очереди. Очередь справедливая между пользователями: первым идет
+# пользователь с наименьшим числом выполняемых задач (во всех обработчиках), у него - меньший WAV,
+# затем более старая задача. Поэтому сотни задач одного пользователя не задерживают задачу другого:
+# она забирается, как только освободится слот
+async def claim_next_job():
+    running = (
+        select(ConversionJob.user_id, func.count().label('jobs'))
+        .where(ConversionJob.status == JOB_RUNNING)
+        .group_by(ConversionJob.user_id)
+        .subquery()
+    )
+    async with SessionLocal() as session:
+        job = await session.scalar(
+            select(ConversionJob)
+            .outerjoin(running, running.c.user_id == ConversionJob.user_id)
+            .where(ConversionJob.status == JOB_QUEUED)
+            .order_by(func.coalesce(running.c.jobs, 0), func.coalesce(ConversionJob.wav_size, 0),
+                      ConversionJob.created_at)
+            .limit(1))
+        if job is None:
+            return None
+
+        # Условный UPDATE: если задачу уже забрал другой процесс, строка не изменится.
+        # updated_at - начало аренды задачи, ее продлевает heartbeat обработчика
+        claimed = (await session.execute(
+            update(ConversionJob)
+            .where(ConversionJob.id == job.id, ConversionJob.status == JOB_QUEUED)
+            .values(status=JOB_RUNNING, updated_at=datetime.datetime.utcnow())
+        )).rowcount
+        await session.commit()
+        if not claimed:
+            return None
+        return job.id, job.wav_file, job.user_id, job.cache_key, job.renditions, job.source_name
+
+
+async def finish_job(job_id: str, status: str, record_id: str = None, error: str = None):
+    async with SessionLocal() as session:
+        await session.execute(
+            update(ConversionJob)
+            .where(ConversionJob.id == job_id)
+            .values(status=status, record_id=record_id, error=error)
+        )
+        await session.commit()
+
+
+# Возвращаем задачу в очередь (например, пул конвертации переполнен)
+async def requeue_job(job_id: str):
+    await finish_job(job_id, JOB_QUEUED)
+
+
+# Продлеваем аренду задачи, пока она выполняется
+async def heartbeat(job_id: str, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        async with SessionLocal() as session:
+            await session.execute(
+                update(ConversionJob)
+                .where(ConversionJob.id == job_id, ConversionJob.status == JOB_RUNNING)
+                .values(updated_at=datetime.datetime.utcnow())
+            )
+            await session.commit()
+
+
+# Задачи, аренду которых давно никто не продлевал (процесс обработчика убит), возвращаем в очередь
+async def requeue_stale_jobs():
+    deadline = datetime.datetime.utcnow() - datetime.timedelta(seconds=settings.job_lease)
+    async with SessionLocal() as session:
+        requeued = (await session.execute(
+            update(ConversionJob)
+            .where(ConversionJob.status == JOB_RUNNING, ConversionJob.updated_at < deadline)
+            .values(status=JOB_QUEUED)
+        )).rowcount
+        await session.commit()
+    if requeued:
+        jobs_logger.warning(f'Requeue {requeued} stale running jobs')
+    return requeued
+
+
+async def process_job(job_id: str, wav_audio_file: str, user_id: int, cache_key: str, renditions: str,
+                      source_name: str, folder: str):
+    # Задача выполняется в своем asyncio.Task, поэтому id виден только в ее записях лога
+    job_id_var.set(job_id)
+    jobs_logger.info(f'Start job {job_id}: {wav_audio_file}')
+    renditions = [parse_rendition(name) for name in renditions.split(',')] if renditions else []
+
+    # Сведения о WAV читаем из заголовка сохраненного файла
+    metadata = {'source_name': source_name}
+    try:
+        metadata.update(await read_wav_metadata(os.path.join(folder, wav_audio_file), settings.upload_chunk_size))
+    except (OSError, InvalidWavError) as e:
+        jobs_logger.error(f'Job {job_id}: can not read wav header: {e}')
+
+    lease = asyncio.create_task(heartbeat(job_id, settings.job_lease / 3))
+    try:
+        files, errors = await ingest_file(job_id, wav_audio_file, user_id, cache_key, folder, renditions, metadata)
+    except PoolBusyError:
+        jobs_logger.info(f'Pool is busy, requeue job {job_id}')
+        await requeue_job(job_id)
+        return
+    except asyncio.CancelledError:
+        # Остановка обработчика - задача достанется следующему запуску
+        await asyncio.shield(requeue_job(job_id))
+        raise
+    finally:
+        lease.cancel()
+
+    if files:
+        # Ошибки отдельных вариантов не мешают основному MP3
+        await finish_job(job_id, JOB_DONE, record_id=job_id, error=str(errors) if errors else None)
+        jobs_logger.info(f'Job {job_id} done: {files}')
+    else:
+        await finish_job(job_id, JOB_FAILED, error=str(errors))
+        jobs_logger.error(f'Job {job_id} failed: {errors}')
+
+
+# Цикл обработки очереди: берем задачи, пока есть свободные места
+async def run_worker(folder: str, concurrency: int = None):
+    concurrency = concurrency or settings.convert_pool_size
+    running = set()
+    jobs_logger.info(f'Start job worker, concurrency {concurrency}')
+    stale_checked = 0
+
+    try:
+        while True:
+            # Задачи упавших обработчиков - при старте и раз в половину срока аренды
+            if time.monotonic() - stale_checked > settings.job_lease / 2:
+                await requeue_stale_jobs()
+                stale_checked = time.monotonic()
+
+            claimed = None
+            if len(running) < concurrency:
+                claimed = await claim_next_job()
+
+            if claimed is None:
+                await asyncio.sleep(settings.job_poll_interval)
+                continue
+
+            task = asyncio.create_task(process_job(*claimed, folder))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+    except asyncio.CancelledError:
+        jobs_logger.info(f'Stop job worker, {len(running)} jobs in progress')
+        tasks = list(running)
+        for task in tasks:
+            task.cancel()
+        # Ждем, пока задачи вернутся в очередь: после выхода движок базы будет закрыт
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+if __name__ == "__main__":
+    from .converter import start_backend, stop_backend
+    from .db import dispose_engine
+    from .migrations import start_database
+
+    async def main():
+        setup_logging()
+        await start_database()
+        await start_backend()
+
+        # docker stop присылает SIGTERM: останавливаем обработчик, задачи возвращаются в очередь
+        worker = asyncio.create_task(run_worker(settings.audio_folder))
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signal_number, worker.cancel)
+        try:
+            await worker
+        except asyncio.CancelledError:
+            jobs_logger.info('Job worker stopped')
+        finally:
+            await stop_backend()
+            await dispose_engine()
+
+    asyncio.run(main())
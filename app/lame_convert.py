@@ -0,0 +1,157 @@
+import logging
+import mmap
+import os
+import sys
+import warnings
+import wave
+from array import array
+from contextlib import ExitStack
+
+import lameenc
+
+from .files import remove_file, temp_path
+from .renditions import Rendition
+
+# audioop сводит стерео в моно на C; в Python 3.13 модуль удален - тогда сводим массивом (медленнее)
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        import audioop
+except ImportError:
+    audioop = None
+
+# Логгер модуля; обработчики настраиваются один раз при старте (logging_setup)
+lame_convert_logger = logging.getLogger(__name__)
+
+# Сколько кадров отдаем кодировщику за раз (кратно размеру кадра MP3 - 1152 сэмпла)
+FRAMES_PER_CHUNK = 1152 * 64
+
+# 8-битный WAV беззнаковый: старший байт 16-битного сэмпла - значение со сдвигом на -128
+SIGNED_8BIT = bytes(value ^ 0x80 for value in range(256))
+
+
+# Приводим кусок PCM к 16 бит и нужному числу каналов - это все, что принимает lameenc.
+# Разрядность меняем срезами байтов (little-endian), без поэлементного цикла
+def to_lame_pcm(chunk: bytes, sample_width: int, source_channels: int, channels: int):
+    samples = len(chunk) // (sample_width * source_channels) * source_channels
+    chunk = chunk[:samples * sample_width]
+
+    if sample_width != 2:
+        pcm = bytearray(samples * 2)
+        if sample_width == 1:
+            pcm[1::2] = chunk.translate(SIGNED_8BIT)
+        else:
+            # 24 и 32 бит - оставляем два старших байта сэмпла
+            pcm[0::2] = chunk[sample_width - 2::sample_width]
+            pcm[1::2] = chunk[sample_width - 1::sample_width]
+        chunk = bytes(pcm)
+
+    if source_channels == 2 and channels == 1 and audioop is not None and sys.byteorder == 'little':
+        # Полусумма каналов с округлением вниз - как в запасном варианте ниже
+        chunk = audioop.tomono(chunk, 2, 0.5, 0.5)
+    elif source_channels == 2 and channels == 1:
+        stereo = array('h', chunk)
+        if sys.byteorder == 'big':
+            stereo.byteswap()
+        mono = array('h', [(left + right) >> 1 for left, right in zip(stereo[0::2], stereo[1::2])])
+        if sys.byteorder == 'big':
+            mono.byteswap()
+        chunk = mono.tobytes()
+    elif source_channels == 1 and channels == 2:
+        pcm = bytearray(samples * 4)
+        pcm[0::4] = pcm[2::4] = chunk[0::2]
+        pcm[1::4] = pcm[3::4] = chunk[1::2]
+        chunk = bytes(pcm)
+    return chunk
+
+
+def wav_to_mp3(wav_file: str, audio_folder: str, converting_errors=None,
+               bitrate: int = 128, quality: int = 7, channels: int = 0):
+    mp3_filename = wav_file.replace('.wav', '.mp3')
+    rendition = Rendition('mp3', bitrate)
+    converted, converting_errors = wav_to_renditions(wav_file, audio_folder, [(rendition, mp3_filename)],
+                                                     converting_errors, quality, channels)
+    return converted.get(rendition.name, ''), converting_errors
+
+
+# Несколько MP3 разного битрейта за один проход: PCM читается и приводится к 16 бит один раз,
+# каждый кусок отдается всем кодировщикам. targets - список (Rendition, имя файла)
+def wav_to_renditions(wav_file: str, audio_folder: str, targets, converting_errors=None,
+                      quality: int = 7, channels: int = 0):
+
+    lame_convert_logger.info(f'Start convert {wav_file} to {[rendition.name for rendition, _ in targets]}')
+
+    # cписок для ошибок
+    if converting_errors is None:
+        converting_errors = []
+    else:
+        converting_errors[:] = []
+
+    # LAME кодирует только MP3
+    for rendition, _ in targets:
+        if rendition.codec != 'mp3':
+            converting_errors.append({wav_file: f'Rendition {rendition.name} is not supported by LAME encoder'})
+    targets = [(rendition, file_name) for rendition, file_name in targets if rendition.codec == 'mp3']
+    if not targets:
+        return {}, converting_errors
+
+    wav_file_path = os.path.join(audio_folder, wav_file)
+    file_paths = [os.path.join(audio_folder, file_name) for _, file_name in targets]
+    outputs = []
+    converted = {}
+
+    try:
+        with open(wav_file_path, 'rb') as source, ExitStack() as files:
+            with wave.open(source) as wav:
+                source_channels = wav.getnchannels()
+                sample_width = wav.getsampwidth()
+                sample_rate = wav.getframerate()
+                frames = wav.getnframes()
+
+                # После разбора заголовка файл стоит на начале данных
+                data_offset = source.tell()
+
+            if source_channels not in (1, 2):
+                raise ValueError(f'Unsupported number of channels: {source_channels}')
+
+            out_channels = channels or source_channels
+
+            for (rendition, _), file_path in zip(targets, file_paths):
+                encoder = lameenc.Encoder()
+                encoder.set_bit_rate(rendition.bitrate)
+                encoder.set_in_sample_rate(sample_rate)
+                encoder.set_channels(out_channels)
+                encoder.set_quality(quality)
+                outputs.append((encoder, files.enter_context(open(temp_path(file_path), 'wb'))))
+
+            frame_size = sample_width * source_channels
+            data_end = data_offset + frames * frame_size
+            step = FRAMES_PER_CHUNK * frame_size
+
+            # Читаем PCM через mmap кусками: в памяти всегда не больше одного куска
+            with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as pcm:
+                data_end = min(data_end, len(pcm))
+                for start in range(data_offset, data_end, step):
+                    chunk = pcm[start:min(start + step, data_end)]
+                    if sample_width != 2 or source_channels != out_channels:
+                        chunk = to_lame_pcm(chunk, sample_width, source_channels, out_channels)
+                    for encoder, target in outputs:
+                        target.write(encoder.encode(chunk))
+
+            for encoder, target in outputs:
+                target.write(encoder.flush())
+
+        # Файлы закрыты - переименовываем в итоговые
+        for file_path in file_paths:
+            os.replace(temp_path(file_path), file_path)
+        converted = {rendition.name: file_name for rendition, file_name in targets}
+        lame_convert_logger.info(f'Convert complete: {list(converted.values())}')
+
+    except Exception as e:
+        for file_path in file_paths:
+            remove_file(temp_path(file_path))
+            remove_file(file_path)
+        lame_convert_logger.error(f'Error convert {wav_file}: {str(e)}')
+        converting_errors.append({wav_file: f'Error convert: {str(e)}'})
+
+    return converted, converting_errors
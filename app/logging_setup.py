@@ -0,0 +1,149 @@
+import atexit
+import copy
+import datetime
+import json
+import logging
+import os
+import queue
+import re
+import time
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from .config import settings
+from .files import remove_file
+
+# id запроса и фоновой задачи, попадают в каждую запись лога из этого контекста
+request_id_var = ContextVar('request_id', default=None)
+job_id_var = ContextVar('job_id', default=None)
+
+# Логгеры приложения; '__main__' - для запуска модулей через python -m
+APP_LOGGERS = ('app', '__main__')
+
+listener = None
+configured_pid = None
+
+# Файл лога процесса и его копии после ротации: app-<pid>.log, app-<pid>.log.1, ...
+LOG_FILE_PATTERN = re.compile(r'^app-(\d+)\.log(\.\d+)?$')
+
+
+# Запись готовится в потоке, который логирует: здесь доступны id запроса и задачи из контекста,
+# исключение превращается в текст, потому что объект traceback не передать в другой поток/процесс
+class ContextQueueHandler(QueueHandler):
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        # logger.exception вне обработчика исключения дает exc_info=(None, None, None)
+        if record.exc_info and record.exc_info[0] is not None:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        record.request_id = request_id_var.get()
+        record.job_id = job_id_var.get()
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+        }
+        for key in ('request_id', 'job_id'):
+            if getattr(record, key, None):
+                entry[key] = getattr(record, key)
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def process_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Процесс другого пользователя
+        return True
+    return True
+
+
+# Процессы пула и воркеры uvicorn получают новые pid при каждом перезапуске, поэтому файлы app-<pid>.log
+# копятся. Удаляем файлы завершившихся процессов, в которые не писали дольше LOG_RETENTION:
+# свежие логи упавшего процесса остаются для разбора
+def prune_logs(log_dir: str, retention: float):
+    if retention <= 0:
+        return
+    deadline = time.time() - retention
+    for entry in os.scandir(log_dir):
+        match = LOG_FILE_PATTERN.match(entry.name)
+        if not match or int(match.group(1)) == os.getpid():
+            continue
+        try:
+            if entry.stat().st_mtime < deadline and not process_alive(int(match.group(1))):
+                remove_file(entry.path)
+        except FileNotFoundError:
+            # Файл уже удалил другой процесс
+            continue
+
+
+# QueueHandler только кладет запись в очередь, запись в файл делает поток QueueListener,
+# поэтому логирование не блокирует цикл событий. У каждого процесса (воркер uvicorn, процесс пула
+# конвертации, обработчик задач) свой файл app-<pid>.log с ротацией по размеру; файлы завершившихся
+# процессов удаляются при старте (prune_logs)
+def setup_logging():
+    global listener, configured_pid
+
+    # Уже настроено в этом процессе; после fork (процессы пула) настраиваем заново
+    if configured_pid == os.getpid():
+        return
+    configured_pid = os.getpid()
+
+    os.makedirs(settings.log_dir, exist_ok=True)
+    prune_logs(settings.log_dir, settings.log_retention)
+    file_handler = RotatingFileHandler(os.path.join(settings.log_dir, f'app-{os.getpid()}.log'),
+                                       maxBytes=settings.log_max_bytes, backupCount=settings.log_backup_count,
+                                       encoding='utf-8')
+    if settings.log_format == 'json':
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(
+            '%(name)s %(asctime)s %(levelname)s [%(process)d %(request_id)s %(job_id)s] %(message)s'))
+
+    records = queue.SimpleQueue()
+    queue_handler = ContextQueueHandler(records)
+
+    for name in APP_LOGGERS:
+        logger = logging.getLogger(name)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
+        logger.setLevel(settings.log_level.upper())
+        logger.propagate = False
+
+    listener = QueueListener(records, file_handler, respect_handler_level=True)
+    listener.start()
+
+
+# Для процессов пула: процесс создается внутри запроса и наследует его контекст при fork
+def setup_worker_logging():
+    request_id_var.set(None)
+    job_id_var.set(None)
+    setup_logging()
+
+
+# Дописываем оставшиеся в очереди записи
+def stop_logging():
+    global listener
+    if listener is not None and configured_pid == os.getpid():
+        listener.stop()
+        listener = None
+
+
+atexit.register(stop_logging)
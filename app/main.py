@@ -1,49 +1,116 @@
+import asyncio
+import base64
+import datetime
+import json
 import logging
 import os
 import re
+import time
 import uuid
-from typing import List
+from typing import List, NamedTuple
 
 from dotenv import load_dotenv
-from fastapi import (Depends, FastAPI, File, Header, HTTPException, Response,
-                     UploadFile)
+from fastapi import (Depends, FastAPI, File, Header, HTTPException, Query,
+                     Request, Response, UploadFile)
 from pydantic import BaseModel, Field, validator
+from sqlalchemy import and_, select, tuple_, update
 from sqlalchemy.exc import DatabaseError, IntegrityError
-from starlette.responses import FileResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse, StreamingResponse
 
-from .async_wav_to_mp3 import convert_file
+from .auth_cache import invalidate_record, record_cache, user_cache
+from .cache import conversion_cache, make_cache_key, rendition_key
 from .config import settings
-from .db import AudioRecord, SessionLocal, User
-from .ffmpeg_convert import wav_to_mp3
-from .start_app import create_table
-
-# Получение пользовательского логгера и установка уровня логирования
+from .conversion_pool import PoolBusyError
+from .converter import (FFMPEG, UnknownModeError, convert_renditions, encoder_signature, primary_rendition,
+                        start_backend, stop_backend, supported_codecs)
+from .db import AudioRecord, AudioRendition, ConversionJob, User, dispose_engine, get_session
+from .files import upload_file_name
+from .ingest import ingest_file
+from .janitor import run_janitor
+from .jobs import JOB_DONE, JOB_QUEUED, run_worker
+from .logging_setup import request_id_var, setup_logging, stop_logging
+from .metrics import StageTimings, metrics_response
+from .migrations import start_database
+from .renditions import Rendition, parse_rendition
+from .storage import storage
+from .upload import (InvalidArchiveError, InvalidWavError, UploadTooLargeError, iter_archive, spool_upload,
+                     wav_metadata)
+
+# Логгер модуля; обработчики настраиваются один раз при старте (logging_setup)
 main_logger = logging.getLogger(__name__)
-main_logger.setLevel(logging.INFO)
-
-# Настройка обработчика и форматировщика
-main_handler = logging.FileHandler(f"{__name__}.log", mode='w')
-main_formatter = logging.Formatter("%(name)s %(asctime)s %(levelname)s %(message)s")
-
-# добавление форматировщика к обработчику
-main_handler.setFormatter(main_formatter)
-
-# добавление обработчика к логгеру
-main_logger.addHandler(main_handler)
 
 # Папка для хранения аудио файлов
-folder_for_audio = '../audio/'
+folder_for_audio = settings.audio_folder
 
-# Узнаем режим работы (самостоятельный или с помощью внешнего api)
 dotenv_path = os.path.join(os.path.dirname(__file__), '..', '.env')
 load_dotenv(dotenv_path)
-FFMPEG = os.getenv('FFMPEG')
 
 # Максимальное число принимаемых файлов
 MAX_FILES = int(os.getenv('MAX_FILES'))
 
 app = FastAPI()
 
+# Фоновый обработчик задач, если запущен внутри приложения
+job_worker_task = None
+# Фоновая уборка файлов без записей в базе
+janitor_task = None
+
+
+# id запроса для логов: из заголовка X-Request-ID (например, от прокси) или новый
+@app.middleware('http')
+async def request_id(request: Request, call_next):
+    value = request.headers.get('x-request-id') or uuid.uuid4().hex
+    token = request_id_var.set(value)
+    try:
+        response = await call_next(request)
+    finally:
+        request_id_var.reset(token)
+    response.headers['X-Request-ID'] = value
+    return response
+
+
+# Ограничение размера запроса на загрузку. Тело считается по мере получения (receive), до разбора формы:
+# запрос без Content-Length (chunked) или с неверным заголовком прерывается с 413, как только превысит лимит
+class LimitUploadSize:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'] not in ('/audio', '/audio/bulk'):
+            await self.app(scope, receive, send)
+            return
+
+        max_bytes = settings.bulk_max_bytes if scope['path'] == '/audio/bulk' else settings.max_request_bytes
+        detail = f'Request is too large. Maximum allowed is {max_bytes} bytes.'
+
+        # Заявленный размер больше лимита - отвечаем сразу, не читая тело
+        content_length = Headers(scope=scope).get('content-length')
+        if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+            main_logger.error(f'Request body is too large: {content_length}')
+            await JSONResponse(status_code=413, content={'detail': detail})(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            # Ошибка - один раз: после ответа сервер может еще отдать остаток тела
+            if message['type'] == 'http.request' and received <= max_bytes:
+                received += len(message.get('body', b''))
+                if received > max_bytes:
+                    main_logger.error(f'Request body is too large: more than {max_bytes} bytes received')
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+app.add_middleware(LimitUploadSize)
+
 
 # Проверка и валидация имени пользователя
 class UserCreateRequest(BaseModel):
@@ -90,36 +157,110 @@ def validator_token(token):
         raise HTTPException(status_code=401, detail='Token containing unacceptable characters')
 
 
+# Проверяем пользователя по id и токену
+async def check_user(session: AsyncSession, audio_request: AudioCreateRequest):
+    key = (audio_request.user_id, audio_request.token)
+    if user_cache.get(key):
+        return audio_request.user_id
+
+    user_id = await session.scalar(select(User.id).filter_by(id=audio_request.user_id, token=audio_request.token))
+    if user_id is None:
+        main_logger.exception(f'User: {audio_request.user_id} not found or wrong token')
+        raise HTTPException(status_code=401, detail='Invalid user ID or token')
+
+    user_cache.set(key, True)
+    return user_id
+
+
+# Удаляем временные файлы WAV из рабочей папки, если они есть
+def remove_files(file_names):
+    for file_name in file_names:
+        file_path = os.path.join(folder_for_audio, file_name)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def make_download_url(audio_id: str, user_id: int, rendition: str = None):
+    url = f'http://{settings.host_url}/record?id={audio_id}&user={user_id}'
+    if rendition:
+        url += f'&rendition={rendition}'
+    return url
+
+
+# Заказанные варианты: ?renditions=mp3-320&renditions=opus-64 или ?renditions=mp3-320,opus-64.
+# Основной MP3 создается всегда, поэтому в список не попадает
+def parse_renditions(values: List[str]):
+    primary = primary_rendition()
+    renditions = []
+    for value in (value for values_item in values for value in values_item.split(',') if value.strip()):
+        try:
+            rendition = parse_rendition(value)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if rendition.codec not in supported_codecs():
+            raise HTTPException(status_code=400, detail=f'Rendition {value} is not supported in this conversion mode')
+        if rendition != primary and rendition not in renditions:
+            renditions.append(rendition)
+
+    if len(renditions) > settings.max_renditions:
+        raise HTTPException(status_code=400,
+                            detail=f'Too many renditions. Maximum allowed is {settings.max_renditions}.')
+    return renditions
+
+
+# Варианты, которые действительно созданы для записей: {id записи: [имена]}. В задаче хранятся заказанные
+# варианты - неудачные и пропущенные (не поддерживаются способом конвертации) в записи не попадают
+async def record_renditions(session: AsyncSession, record_ids):
+    renditions = {}
+    record_ids = [record_id for record_id in record_ids if record_id]
+    if record_ids:
+        rows = await session.execute(select(AudioRendition.record_id, AudioRendition.name)
+                                     .where(AudioRendition.record_id.in_(record_ids)))
+        for record_id, name in rows:
+            renditions.setdefault(record_id, []).append(name)
+    return renditions
+
+
+def job_status(job: ConversionJob, renditions: List[str] = None):
+    status = {'id': job.id, 'file': job.source_name, 'status': job.status}
+    if job.status == JOB_DONE:
+        status['download_url'] = make_download_url(job.record_id, job.user_id)
+        if renditions:
+            status['rendition_urls'] = {name: make_download_url(job.record_id, job.user_id, name)
+                                        for name in renditions}
+    if job.error:
+        status['error'] = job.error
+    return status
+
+
 # Добавляем пользователя, принимаем имя, возвращаем id + token
 @app.post('/users')
-async def create_user(user_request: UserCreateRequest):
+async def create_user(user_request: UserCreateRequest, session: AsyncSession = Depends(get_session)):
 
     try:
-        with SessionLocal() as session:
-
-            # Проверяем имя пользователя на уникальность
-            user_check = session.query(User).filter_by(name=user_request.name).first()
+        # Проверяем имя пользователя на уникальность
+        user_check = await session.scalar(select(User).filter_by(name=user_request.name))
 
-            if user_check is not None:
-                raise HTTPException(status_code=409, detail=f'User: {user_request.name} already exists')
+        if user_check is not None:
+            raise HTTPException(status_code=409, detail=f'User: {user_request.name} already exists')
 
-            # Генерируем токен
-            token = str(uuid.uuid4())
-            main_logger.info(f'Generation uuid token for user: {user_request.name}')
+        # Генерируем токен
+        token = str(uuid.uuid4())
+        main_logger.info(f'Generation uuid token for user: {user_request.name}')
 
-            user = User(name=user_request.name, token=token)
+        user = User(name=user_request.name, token=token)
 
-            session.add(user)
-            session.commit()
-            user_id = user.id
-            main_logger.info(f'Save user: {user_id}')
+        session.add(user)
+        await session.commit()
+        user_id = user.id
+        main_logger.info(f'Save user: {user_id}')
 
-            # Добавляем токен и имя пользователя в headers
-            response = Response()
-            response.headers['X-Token'] = token
-            response.headers['X-User-ID'] = str(user_id)
+        # Добавляем токен и имя пользователя в headers
+        response = Response()
+        response.headers['X-Token'] = token
+        response.headers['X-User-ID'] = str(user_id)
 
-            return response
+        return response
 
     except IntegrityError:
         main_logger.exception(f'Try add already exists user: {user_request.name}')
@@ -130,153 +271,724 @@ async def create_user(user_request: UserCreateRequest):
         raise HTTPException(status_code=500, detail=f'Invalid access to database {str(e)}')
 
 
+# Сохраненный WAV файл из запроса
+class SavedUpload(NamedTuple):
+    filename: str
+    audio_id: str
+    wav_file: str
+    cache_key: str
+    # Имя и сведения о WAV для AudioRecord
+    metadata: dict
+
+
+# Конвертация одного файла с ограничением числа одновременных конвертаций в запросе.
+# Возвращает ({вариант: файл}, ошибки, время конвертации в секундах)
+async def convert_limited(semaphore: asyncio.Semaphore, wav_audio_file: str, renditions: List[Rendition],
+                          user_id: int):
+    async with semaphore:
+        started = time.perf_counter()
+        converted, errors = await convert_renditions(wav_audio_file, folder_for_audio, renditions, user_id)
+        return converted, errors, round(time.perf_counter() - started, 3)
+
+
+# Ищем готовые варианты в кэше: возвращаем найденные {ключ: {вариант: файл}} и файлы, у которых
+# не хватает хотя бы одного варианта. Одинаковые файлы одного запроса конвертируются один раз
+async def split_cached(session: AsyncSession, saved_files: List[SavedUpload], targets: List[Rendition]):
+    primary = targets[0].name
+    cached = {}
+    to_convert = {}
+    for saved in saved_files:
+        if saved.cache_key in cached:
+            continue
+        found = {}
+        if settings.cache_enabled == 'yes':
+            for rendition in targets:
+                key = rendition_key(saved.cache_key, rendition.name, primary)
+                file_name = await conversion_cache.lookup(session, key)
+                if file_name:
+                    found[rendition.name] = file_name
+        cached[saved.cache_key] = found
+        if len(found) < len(targets):
+            to_convert[saved.cache_key] = saved
+    return cached, to_convert
+
+
+# Строки базы для готовых файлов {вариант: файл}: AudioRecord основного MP3 и AudioRendition остальных
+def record_rows(audio_id: str, user_id: int, files: dict, primary: str, metadata: dict):
+    rows = [AudioRecord(id=audio_id, file_name=files[primary], user_id=user_id, **metadata)]
+    rows += [AudioRendition(record_id=audio_id, name=name, file_name=file_name)
+             for name, file_name in files.items() if name != primary]
+    return rows
+
+
+# Ключ кэша записей для скачивания
+def record_cache_key(row):
+    if isinstance(row, AudioRendition):
+        return row.record_id, row.name
+    return row.id
+
+
 # Обработка аудио файлов
 @app.post('/audio')
 async def add_audio(audio_request: AudioCreateRequest = Depends(get_audio_create_request),
-                    audio_files: List[UploadFile] = File(description="Audio files")):
+                    audio_files: List[UploadFile] = File(description="Audio files"),
+                    renditions: List[str] = Query([], description="Extra renditions: mp3-320, opus-64, aac-128"),
+                    session: AsyncSession = Depends(get_session)):
 
     # Ограничение числа отправляемых файлов
     if len(audio_files) > MAX_FILES:
         main_logger.exception(f'Two many files to upload: {len(audio_files)}')
-        raise HTTPException(status_code=400, detail='Too many audio files. Maximum allowed is 5.')
+        raise HTTPException(status_code=400, detail=f'Too many audio files. Maximum allowed is {MAX_FILES}.')
+
+    # Время этапов обработки для отладки
+    timings = StageTimings()
 
     # Валидация токена
     validator_token(audio_request.token)
 
-    with SessionLocal() as session:
-
-        # Проверяем пользователя
-        user = session.query(User).filter_by(id=audio_request.user_id, token=audio_request.token).first()
-        if not user:
-            main_logger.exception(f'User: {audio_request.user_id} not found or wrong token')
-            raise HTTPException(status_code=401, detail='Invalid user ID or token')
-        main_logger.info(f'User: {audio_request.user_id} add {len(audio_files)} files in convert')
-
-        # список успешных и безуспешных обработок файлов
-        successful_urls = []
-        failed_files = []
-
-        # Проверка наличия папки "audio"
-        if not os.path.exists(folder_for_audio):
-            os.makedirs(folder_for_audio)
-            main_logger.info('Create folder for audio files')
-
+    # Основной MP3 и заказанные дополнительные варианты
+    renditions = parse_renditions(renditions)
+    primary = primary_rendition()
+    targets = [primary, *renditions]
+
+    # Проверяем пользователя
+    with timings.stage('auth'):
+        user_id = await check_user(session, audio_request)
+    main_logger.info(f'User: {audio_request.user_id} add {len(audio_files)} files in convert')
+
+    # Не держим соединение с базой, пока принимаем и конвертируем файлы
+    await session.commit()
+
+    # список успешных и безуспешных обработок файлов
+    successful_urls = []
+    failed_files = []
+
+    # Сохраненные файлы
+    saved_files = []
+    # Сколько байт запроса уже сохранено
+    request_bytes = 0
+    encoder = encoder_signature()
+
+    # Проверка наличия папки "audio"
+    if not os.path.exists(folder_for_audio):
+        os.makedirs(folder_for_audio)
+        main_logger.info('Create folder for audio files')
+
+    # WAV файлы запроса удаляются при любом исходе (ошибка, отмена запроса клиентом),
+    # кроме переданных фоновым задачам
+    queued_files = set()
+    try:
         for audio_file in audio_files:
 
             # Валидация имени файла
             if validate_audiofile(audio_file.filename):
                 audio_id = str(uuid.uuid4())
-                wav_audio_file = f'{os.path.basename(audio_file.filename).rstrip(".wav")}-{audio_id}.wav'
+                wav_audio_file = upload_file_name(audio_file.filename, audio_id)
                 wav_file_path = os.path.join(folder_for_audio, wav_audio_file)
                 main_logger.info(f'Generation uuid for wav-audio: {wav_file_path}')
 
+                # Лимит файла не больше остатка лимита на весь запрос
+                max_bytes = min(settings.max_file_bytes, settings.max_request_bytes - request_bytes)
+
                 try:
-                    # Сохраняем полученный WAV файл
-                    with open(wav_file_path, 'wb') as wav_file:
-                        wav_file.write(await audio_file.read())
-                        main_logger.info('Save wav-audio')
+                    # Сохраняем полученный WAV файл потоково
+                    with timings.stage('spool'):
+                        size, header, wav_digest = await spool_upload(audio_file, wav_file_path, max_bytes,
+                                                                      settings.upload_chunk_size)
+                    request_bytes += size
+                    main_logger.info(f'Save wav-audio: {size} bytes')
+
+                except InvalidWavError as e:
+                    failed_files.append({audio_file.filename: f'Invalid wav audiofile: {e}'})
+                    main_logger.error(f'{audio_file.filename}: invalid wav audiofile: {e}')
+                    continue
+
+                except UploadTooLargeError:
+                    main_logger.error(f'{audio_file.filename}: upload is too large')
+                    raise HTTPException(status_code=413,
+                                        detail=f'File {audio_file.filename} is too large. Maximum allowed is '
+                                               f'{settings.max_file_bytes} bytes per file and '
+                                               f'{settings.max_request_bytes} bytes per request.')
 
                 except Exception as e:
-
-                    # Удаляем временный файл WAV
-                    os.remove(wav_file_path)
                     main_logger.exception(f'Error save {wav_file_path}, delete temp wav file')
                     raise HTTPException(status_code=500, detail=str(e))
 
-                # Выбираем способ конвертации
-                if FFMPEG == 'yes':
+                saved_files.append(SavedUpload(audio_file.filename, audio_id, wav_audio_file,
+                                               make_cache_key(wav_digest, encoder),
+                                               {'source_name': audio_file.filename, **wav_metadata(header, size)}))
 
-                    # Преобразование WAV в MP3 с помощью ffmpeg
-                    converted_to_mp3, errors = wav_to_mp3(wav_audio_file, folder_for_audio)
-                elif FFMPEG == 'no':
+            else:
+                failed_files.append({audio_file.filename: "No .wav audiofile"})
+                main_logger.error(f'{audio_file.filename}: No .wav audiofile')
 
-                    # Преобразуем WAV в MP3 с помощью стороннего API
-                    converted_to_mp3, errors = await convert_file(wav_audio_file, "mp3", folder_for_audio)
+        with timings.stage('cache_lookup'):
+            cached, to_convert = await split_cached(session, saved_files, targets)
+            await session.commit()
+
+        # Фоновый режим: файлы, все варианты которых есть в кэше, сразу готовы, остальные ставим в очередь
+        if settings.job_mode == 'yes' and saved_files:
+            jobs = []
+            rendition_names = ','.join(rendition.name for rendition in renditions) or None
+            for saved in saved_files:
+                if saved.cache_key not in to_convert:
+                    files = cached[saved.cache_key]
+                    for row in record_rows(saved.audio_id, user_id, files, primary.name, saved.metadata):
+                        row.etag = await storage.etag(row.file_name)
+                        if isinstance(row, AudioRecord):
+                            row.mp3_size = await storage.size(row.file_name)
+                        session.add(row)
+                    for name in files:
+                        await conversion_cache.add_reference(
+                            session, rendition_key(saved.cache_key, name, primary.name))
+                    jobs.append(ConversionJob(id=saved.audio_id, user_id=user_id, source_name=saved.filename,
+                                              cache_key=saved.cache_key, renditions=rendition_names,
+                                              status=JOB_DONE, record_id=saved.audio_id))
                 else:
-                    raise HTTPException(status_code=404,
-                                        detail='Need to choose the conversion mode: ffmpeg or external api')
+                    jobs.append(ConversionJob(id=saved.audio_id, user_id=user_id, source_name=saved.filename,
+                                              wav_file=saved.wav_file, cache_key=saved.cache_key,
+                                              renditions=rendition_names, wav_size=saved.metadata['wav_size'],
+                                              status=JOB_QUEUED))
+            try:
+                session.add_all(jobs)
+                await session.commit()
+            except Exception as e:
+                main_logger.exception(f'Invalid access to database {e}', exc_info=True)
+                raise HTTPException(status_code=500, detail=f'Invalid access to database {e}')
+
+            # WAV файлы задач остаются обработчику, найденные в кэше удаляются в finally
+            queued_files = {saved.wav_file for saved in saved_files if saved.cache_key in to_convert}
+            main_logger.info(f'Queue {len(jobs)} jobs, {len(saved_files) - len(to_convert)} from cache')
+
+            renditions = await record_renditions(session, [job.record_id for job in jobs])
+            content = {'jobs': [job_status(job, renditions.get(job.record_id)) for job in jobs],
+                       'failed_files': failed_files}
+            if settings.debug_timings == 'yes':
+                content['timings'] = timings.as_dict()
+            return JSONResponse(status_code=202, content=content)
+
+        # Конвертируем все файлы запроса, которых нет в кэше, одновременно: каждый WAV декодируется
+        # один раз на все недостающие варианты
+        semaphore = asyncio.Semaphore(settings.request_concurrency)
+        with timings.stage('convert'):
+            results = await asyncio.gather(
+                *(convert_limited(semaphore, saved.wav_file,
+                                  [rendition for rendition in targets if rendition.name not in cached[key]],
+                                  user_id)
+                  for key, saved in to_convert.items()),
+                return_exceptions=True)
+        results = dict(zip(to_convert, results))
+
+        # Удаляем временные файлы WAV
+        remove_files(saved.wav_file for saved in saved_files)
+        main_logger.info(f'Delete {len(saved_files)} temp wav files')
+
+        converted_files = [file_name for result in results.values() if isinstance(result, tuple)
+                           for file_name in result[0].values()]
+
+        for result in results.values():
+            if isinstance(result, UnknownModeError):
+                raise HTTPException(status_code=404, detail=str(result))
+            if isinstance(result, PoolBusyError):
+                await storage.remove(converted_files)
+                main_logger.error('Conversion pool is busy, reject request')
+                raise HTTPException(status_code=503, detail=str(result), headers={'Retry-After': '5'})
+
+        # AudioRecord и AudioRendition всех файлов запроса
+        audio_recordings = []
+        rendition_urls = []
+        # Сколько записей ссылается на каждый файл кэша
+        references = {}
+        # Ключ кэша -> файл, сконвертированный в этом запросе
+        produced = {}
+
+        for saved in saved_files:
+
+            files = dict(cached[saved.cache_key])
+            errors = []
+            conversion_seconds = None
+            result = results.get(saved.cache_key)
+            if isinstance(result, Exception):
+                main_logger.error(f'{saved.filename}: error convert {result}')
+                errors = [{saved.wav_file: f'Error convert: {result}'}]
+            elif result is not None:
+                converted, errors, conversion_seconds = result
+                files.update(converted)
+
+            # Сохраняем ошибку при обработке конкретного файла
+            if errors:
+                failed_files.append({f'{saved.filename} fail in request to api zamzar.com': f'{errors}'})
+                main_logger.error(f'{saved.filename} fail in request to api zamzar.com: {errors}')
+
+            # если есть сконвериторованный основной файл
+            if primary.name in files:
+                main_logger.info(f'Convert {files}')
+                audio_recordings += record_rows(saved.audio_id, user_id, files, primary.name,
+                                                {**saved.metadata, 'conversion_seconds': conversion_seconds})
+                for name, file_name in files.items():
+                    key = rendition_key(saved.cache_key, name, primary.name)
+                    references[key] = references.get(key, 0) + 1
+                    if name not in cached[saved.cache_key]:
+                        produced[key] = file_name
+                    if name != primary.name:
+                        rendition_urls.append(make_download_url(saved.audio_id, audio_request.user_id, name))
+                successful_urls.append(make_download_url(saved.audio_id, audio_request.user_id))
+
+        # Варианты файлов без основного MP3 не нужны
+        await storage.remove(set(converted_files) - {row.file_name for row in audio_recordings})
+
+        # Сохраняем информацию об аудиозаписях в базе данных одним коммитом
+        if audio_recordings:
+            try:
+                if settings.cache_enabled == 'yes':
+                    with timings.stage('db'):
+                        for key, refs in references.items():
+                            if key not in produced:
+                                await conversion_cache.add_reference(session, key, refs)
+                                continue
+
+                            file_name = await conversion_cache.store(session, key, produced[key], refs)
+
+                            # Тот же файл успел сохранить другой запрос - ссылаемся на его файл
+                            if file_name != produced[key]:
+                                for row in audio_recordings:
+                                    if row.file_name == produced[key]:
+                                        row.file_name = file_name
+                                await storage.remove([produced[key]])
+
+                # ETag и размер считаем один раз на файл, даже если на него ссылаются несколько записей
+                with timings.stage('etag'):
+                    etags = {}
+                    sizes = {}
+                    for row in audio_recordings:
+                        if row.file_name not in etags:
+                            etags[row.file_name] = await storage.etag(row.file_name)
+                        row.etag = etags[row.file_name]
+                        if isinstance(row, AudioRecord):
+                            if row.file_name not in sizes:
+                                sizes[row.file_name] = await storage.size(row.file_name)
+                            row.mp3_size = sizes[row.file_name]
+
+                with timings.stage('db'):
+                    session.add_all(audio_recordings)
+                    await session.commit()
+                record_ids = [row.id for row in audio_recordings if isinstance(row, AudioRecord)]
+                main_logger.info(f'Mp3 save with ids: {record_ids}')
+                for row in audio_recordings:
+                    record_cache.set(record_cache_key(row), (user_id, row.file_name, row.etag))
+            except Exception as e:
+                await storage.remove(converted_files)
+                main_logger.exception(f'Invalid access to database {e}', exc_info=True)
+                raise HTTPException(status_code=500, detail=f'Invalid access to database {e}')
+
+            # Записи уже сохранены: ошибка вытеснения не должна превращать ответ в 500
+            if settings.cache_enabled == 'yes':
+                with timings.stage('cache_evict'):
+                    try:
+                        await conversion_cache.evict(session)
+                    except Exception as e:
+                        main_logger.exception(f'Cache eviction failed: {e}')
 
-                # Сохраняем ошибку при обработке конкретного файла
-                if errors:
-                    failed_files.append({f'{audio_file.filename} fail in request to api zamzar.com': f'{errors}'})
-                    main_logger.error(f'{audio_file.filename} fail in request to api zamzar.com: {errors}')
+        response = {'successful_urls': successful_urls, 'failed_files': failed_files}
+        if renditions:
+            response['rendition_urls'] = rendition_urls
+        if settings.debug_timings == 'yes':
+            response['timings'] = timings.as_dict()
+        return response
 
-                # если есть сконвериторованный файл
-                if converted_to_mp3:
-                    main_logger.info(f'Convert {converted_to_mp3}')
+    finally:
+        remove_files(saved.wav_file for saved in saved_files if saved.wav_file not in queued_files)
 
-                    # Сохраняем информацию об аудиозаписи в базе данных
-                    audio_recording = AudioRecord(id=audio_id, file_name=converted_to_mp3, user=user)
 
-                    try:
-                        session.add(audio_recording)
-                        session.commit()
-                        main_logger.info(f'Mp3 save with id: {audio_id}')
-                    except Exception as e:
-                        main_logger.exception(f'Invalid access to database {e}', exc_info=True)
-                        raise HTTPException(status_code=500, detail=f'Invalid access to database {e}')
+# Обработка одного файла архива. Слот семафора занят от сохранения WAV до записи в базу,
+# поэтому на диске одновременно не больше bulk_concurrency несконвертированных файлов
+async def bulk_convert(semaphore: asyncio.Semaphore, saved: SavedUpload, user_id: int,
+                       renditions: List[Rendition], results: asyncio.Queue):
+    try:
+        while True:
+            try:
+                files, errors = await ingest_file(saved.audio_id, saved.wav_file, user_id, saved.cache_key,
+                                                  folder_for_audio, renditions, saved.metadata)
+                break
+            except PoolBusyError:
+                # Архив обрабатывается долго - ждем свободный процесс, а не отвечаем 503
+                await asyncio.sleep(settings.job_poll_interval)
+
+        if files:
+            result = {'file': saved.filename, 'successful_url': make_download_url(saved.audio_id, user_id)}
+            if renditions:
+                result['rendition_urls'] = {name: make_download_url(saved.audio_id, user_id, name)
+                                            for name in files if name != primary_rendition().name}
+            if errors:
+                result['errors'] = f'{errors}'
+            await results.put(result)
+        else:
+            main_logger.error(f'{saved.filename}: error convert {errors}')
+            await results.put({'file': saved.filename, 'failed': f'{errors}'})
+
+    except asyncio.CancelledError:
+        remove_files([saved.wav_file])
+        raise
+
+    except Exception as e:
+        main_logger.exception(f'{saved.filename}: error convert {e}')
+        await results.put({'file': saved.filename, 'failed': f'Error convert: {e}'})
+
+    finally:
+        semaphore.release()
+
+
+# Читаем архив по одному файлу и отправляем каждый на конвертацию, не дожидаясь остальных.
+# Результаты по мере готовности складываются в очередь, None - конец обработки
+async def bulk_ingest(archive: UploadFile, user_id: int, renditions: List[Rendition], results: asyncio.Queue):
+    semaphore = asyncio.Semaphore(settings.bulk_concurrency)
+    encoder = encoder_signature()
+    running = set()
+    files = 0
 
-                    download_url = f'http://{settings.host_url}/record?id={audio_id}&user={audio_request.user_id}'
-                    successful_urls.append(download_url)
-                    main_logger.info(
-                        f'Add http://{settings.host_url}/record?id={audio_id}&user={audio_request.user_id}'
-                    )
+    try:
+        async for member in iter_archive(archive.file):
+            files += 1
+            if files > settings.bulk_max_files:
+                main_logger.error(f'Too many files in archive {archive.filename}')
+                await results.put({'error': f'Too many files in archive. Maximum allowed is '
+                                            f'{settings.bulk_max_files}, the rest are skipped.'})
+                break
 
-                # Удаляем временный файл WAV
-                os.remove(wav_file_path)
-                main_logger.info(f'Delete temp {wav_file_path}')
+            # Валидация имени файла
+            if not validate_audiofile(member.filename):
+                await results.put({'file': member.filename, 'failed': 'No .wav audiofile'})
+                continue
+
+            if member.error:
+                main_logger.error(f'{member.filename}: {member.error}')
+                await results.put({'file': member.filename, 'failed': member.error})
+                continue
+
+            # Не сохраняем больше файлов, чем обрабатываем одновременно
+            await semaphore.acquire()
+
+            audio_id = str(uuid.uuid4())
+            wav_audio_file = upload_file_name(member.filename, audio_id)
+            wav_file_path = os.path.join(folder_for_audio, wav_audio_file)
+
+            try:
+                size, header, wav_digest = await spool_upload(member, wav_file_path, settings.max_file_bytes,
+                                                              settings.upload_chunk_size)
+            except Exception as e:
+                semaphore.release()
+                remove_files([wav_audio_file])
+                if isinstance(e, InvalidWavError):
+                    error = f'Invalid wav audiofile: {e}'
+                elif isinstance(e, UploadTooLargeError):
+                    error = f'File is too large. Maximum allowed is {settings.max_file_bytes} bytes.'
+                else:
+                    error = f'Error save file: {e}'
+                main_logger.error(f'{member.filename}: {error}')
+                await results.put({'file': member.filename, 'failed': error})
+                continue
+
+            saved = SavedUpload(member.filename, audio_id, wav_audio_file, make_cache_key(wav_digest, encoder),
+                                {'source_name': member.filename, **wav_metadata(header, size)})
+            task = asyncio.create_task(bulk_convert(semaphore, saved, user_id, renditions, results))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+    except InvalidArchiveError as e:
+        main_logger.error(f'{archive.filename}: {e}')
+        await results.put({'error': str(e)})
+
+    except asyncio.CancelledError:
+        # Клиент отключился - останавливаем конвертации
+        for task in running:
+            task.cancel()
+        raise
+
+    except Exception as e:
+        main_logger.exception(f'{archive.filename}: error read archive {e}')
+        await results.put({'error': f'Error read archive: {e}'})
+
+    finally:
+        # Поток результатов завершается при любой ошибке: иначе bulk_results ждет конец обработки вечно
+        await asyncio.gather(*running, return_exceptions=True)
+        main_logger.info(f'Bulk upload {archive.filename}: {files} files')
+        await results.put(None)
+
+
+# Отдаем результаты строками NDJSON по мере готовности, последняя строка - итог
+async def bulk_results(archive: UploadFile, user_id: int, renditions: List[Rendition]):
+    results = asyncio.Queue()
+    producer = asyncio.create_task(bulk_ingest(archive, user_id, renditions, results))
+    successful = failed = 0
 
-            else:
-                failed_files.append({audio_file.filename: "No .wav audiofile"})
-                main_logger.error(f'{audio_file.filename}: No .wav audiofile')
+    try:
+        while True:
+            result = await results.get()
+            if result is None:
+                break
+            if 'successful_url' in result:
+                successful += 1
+            elif 'failed' in result:
+                failed += 1
+            yield json.dumps(result, ensure_ascii=False) + '\n'
+
+        yield json.dumps({'successful': successful, 'failed': failed}) + '\n'
 
-    return {'successful_urls': successful_urls, 'failed_files': failed_files}
+    finally:
+        if not producer.done():
+            producer.cancel()
+
+
+# Пакетная загрузка: zip или tar архив с любым числом WAV файлов (до bulk_max_files)
+@app.post('/audio/bulk')
+async def add_audio_bulk(audio_request: AudioCreateRequest = Depends(get_audio_create_request),
+                         archive: UploadFile = File(description="Zip or tar archive with audio files"),
+                         renditions: List[str] = Query([], description="Extra renditions: mp3-320, opus-64"),
+                         session: AsyncSession = Depends(get_session)):
+
+    if FFMPEG not in ('yes', 'lame', 'no'):
+        raise HTTPException(status_code=404, detail='Need to choose the conversion mode: ffmpeg, lame or external api')
+
+    # Валидация токена
+    validator_token(audio_request.token)
+
+    renditions = parse_renditions(renditions)
+
+    # Проверяем пользователя
+    user_id = await check_user(session, audio_request)
+    await session.commit()
+    main_logger.info(f'User: {audio_request.user_id} add archive {archive.filename} in convert')
+
+    # Проверка наличия папки "audio"
+    if not os.path.exists(folder_for_audio):
+        os.makedirs(folder_for_audio)
+        main_logger.info('Create folder for audio files')
+
+    return StreamingResponse(bulk_results(archive, user_id, renditions), media_type='application/x-ndjson')
 
 
 @app.get('/record')
-async def get_audio_record(id: str, user: str):
+async def get_audio_record(request: Request, id: str, user: str, rendition: str = None,
+                           session: AsyncSession = Depends(get_session)):
 
     # Валидация id файла
     validator_token(id)
 
     # Валидация user
-    if not user.isalnum():
+    if not user.isdigit():
         main_logger.exception('Wrong user id with try to download mp3')
         raise HTTPException(status_code=404, detail='Audio recording not found')
 
-    with SessionLocal() as session:
+    # Основной MP3 или дополнительный вариант
+    if rendition == primary_rendition().name:
+        rendition = None
+    if rendition is not None:
+        try:
+            parse_rendition(rendition)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        model = AudioRendition
+        join_on = and_(AudioRendition.record_id == AudioRecord.id, AudioRendition.name == rendition)
+    else:
+        model = AudioRecord
+
+    user_id = int(user)
+    cache_key = id if rendition is None else (id, rendition)
+    cached = record_cache.get(cache_key)
 
-        user = session.query(User).filter_by(id=user).first()
-        if not user:
+    if cached is not None:
+        record_user_id, file_name, etag = cached
+        if record_user_id != user_id:
+            main_logger.exception(f'Audio record {id} not found')
+            raise HTTPException(status_code=404, detail='Audio recording not found')
+    else:
+        # Пользователь и запись (вариант записи) одним запросом
+        query = (
+            select(User.id, model.file_name, model.etag)
+            .outerjoin(AudioRecord, and_(AudioRecord.user_id == User.id, AudioRecord.id == id))
+        )
+        if rendition is not None:
+            query = query.outerjoin(AudioRendition, join_on)
+        row = (await session.execute(query.where(User.id == user_id))).first()
+
+        if row is None:
             main_logger.exception(f'User: {user} not found')
             raise HTTPException(status_code=404, detail='User not found')
 
-        audio_recording = session.query(AudioRecord).filter_by(id=id, user_id=user.id).first()
-        if not audio_recording:
-            main_logger.exception(f'Audio record {id} not found')
+        file_name = row.file_name
+        if file_name is None:
+            main_logger.exception(f'Audio record {id} ({rendition or "mp3"}) not found')
             raise HTTPException(status_code=404, detail='Audio recording not found')
 
-        # Получаем абсолютный путь до папки с аудиофайлами
-        audio_file_path = os.path.join(folder_for_audio, audio_recording.file_name)
+        etag = row.etag
+
+    # Локальный файл отдает приложение, из S3 - перенаправление на подписанную ссылку
+    try:
+        # Записи, созданные до появления ETag: считаем и сохраняем при первом скачивании
+        if etag is None:
+            etag = await storage.etag(file_name)
+            if rendition is None:
+                await session.execute(update(AudioRecord).where(AudioRecord.id == id).values(etag=etag))
+            else:
+                await session.execute(
+                    update(AudioRendition).filter_by(record_id=id, name=rendition).values(etag=etag))
+            await session.commit()
+
+        response = await storage.response(request.headers, file_name, etag)
+
+    except FileNotFoundError:
+        invalidate_record(id)
+        main_logger.exception('Path not found')
+        raise HTTPException(status_code=404, detail=f'Audio file not found {file_name}')
+
+    record_cache.set(cache_key, (user_id, file_name, etag))
+
+    return response
+
+
+# Курсор страницы списка записей: время создания и id последней записи
+def encode_cursor(record: AudioRecord):
+    value = json.dumps([record.created_at.isoformat(), record.id])
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    try:
+        created_at, record_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return datetime.datetime.fromisoformat(created_at), str(record_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+def record_info(record: AudioRecord, renditions: List[str]):
+    info = {'id': record.id, 'file': record.source_name,
+            'download_url': make_download_url(record.id, record.user_id),
+            'duration': record.duration, 'sample_rate': record.sample_rate, 'channels': record.channels,
+            'bits_per_sample': record.bits_per_sample, 'wav_size': record.wav_size, 'mp3_size': record.mp3_size,
+            'conversion_seconds': record.conversion_seconds,
+            'created_at': record.created_at.isoformat() if record.created_at else None}
+    if renditions:
+        info['rendition_urls'] = {name: make_download_url(record.id, record.user_id, name) for name in renditions}
+    return info
+
+
+# Записи пользователя, новые первыми. Постраничная выборка по ключу (created_at, id) с индексом
+# ix_audio_records_user_created: следующая страница - ?cursor=<next_cursor>, без OFFSET
+@app.get('/users/{id}/records')
+async def get_user_records(id: int, limit: int = Query(None, ge=1), cursor: str = None,
+                           audio_request: AudioCreateRequest = Depends(get_audio_create_request),
+                           session: AsyncSession = Depends(get_session)):
+
+    validator_token(audio_request.token)
+
+    if audio_request.user_id != id:
+        main_logger.error(f'User: {audio_request.user_id} try to list records of user {id}')
+        raise HTTPException(status_code=403, detail='Records of another user')
+
+    await check_user(session, audio_request)
+
+    limit = min(limit or settings.records_page_size, settings.records_page_max)
+    query = (
+        select(AudioRecord)
+        .where(AudioRecord.user_id == id)
+        .order_by(AudioRecord.created_at.desc(), AudioRecord.id.desc())
+        .limit(limit + 1)
+    )
+    if cursor:
+        query = query.where(tuple_(AudioRecord.created_at, AudioRecord.id) < decode_cursor(cursor))
+
+    records = (await session.scalars(query)).all()
+    next_cursor = encode_cursor(records[limit - 1]) if len(records) > limit else None
+    records = records[:limit]
+
+    # Варианты записей страницы одним запросом
+    renditions = await record_renditions(session, [record.id for record in records])
+
+    return {'records': [record_info(record, renditions.get(record.id)) for record in records],
+            'next_cursor': next_cursor}
+
+
+# Статус одной фоновой задачи
+@app.get('/jobs/{job_id}')
+async def get_job(job_id: str, audio_request: AudioCreateRequest = Depends(get_audio_create_request),
+                  session: AsyncSession = Depends(get_session)):
+
+    validator_token(audio_request.token)
+
+    await check_user(session, audio_request)
+
+    job = await session.scalar(select(ConversionJob).filter_by(id=job_id, user_id=audio_request.user_id))
+    if not job:
+        main_logger.error(f'Job {job_id} not found')
+        raise HTTPException(status_code=404, detail='Job not found')
+
+    renditions = await record_renditions(session, [job.record_id])
+    return job_status(job, renditions.get(job.record_id))
+
+
+# Статусы нескольких задач: /jobs?id=...&id=...
+@app.get('/jobs')
+async def get_jobs(id: List[str] = Query(..., description='Job IDs'),
+                   audio_request: AudioCreateRequest = Depends(get_audio_create_request),
+                   session: AsyncSession = Depends(get_session)):
+
+    if len(id) > settings.job_status_batch:
+        raise HTTPException(status_code=400,
+                            detail=f'Too many job IDs. Maximum allowed is {settings.job_status_batch}.')
+
+    validator_token(audio_request.token)
+
+    await check_user(session, audio_request)
+
+    jobs = (await session.scalars(select(ConversionJob).filter(
+        ConversionJob.id.in_(id), ConversionJob.user_id == audio_request.user_id))).all()
+    renditions = await record_renditions(session, [job.record_id for job in jobs if job.status == JOB_DONE])
+    found = {job.id: job_status(job, renditions.get(job.record_id)) for job in jobs}
+
+    return {'jobs': [found.get(job_id, {'id': job_id, 'status': 'not found'}) for job_id in id]}
+
+
+# Метрики в формате Prometheus
+@app.get('/metrics')
+async def get_metrics():
+    content, content_type = metrics_response()
+    return Response(content=content, headers={'Content-Type': content_type})
 
-        if not os.path.exists(audio_file_path):
-            main_logger.exception('Path not found')
-            raise HTTPException(status_code=404,
-                                detail=f'Audio file not found {audio_file_path, audio_recording.file_name}')
 
-        return FileResponse(audio_file_path, filename=audio_recording.file_name)
+# Счетчики кэша конвертации
+@app.get('/cache/stats')
+async def get_cache_stats(session: AsyncSession = Depends(get_session)):
+    return await conversion_cache.stats(session)
 
 
 @app.on_event("startup")
 async def startup():
+    global job_worker_task, janitor_task
+    setup_logging()
     main_logger.info("Start app")
-    # Создаем таблицы
-    create_table()
-    main_logger.info("Create tables")
+    # Создаем движок базы, таблицы и применяем миграции схемы
+    await start_database()
+    main_logger.info("Migrate database")
+    await storage.start()
+    await start_backend()
+    if settings.job_mode == 'yes' and settings.job_worker == 'yes':
+        job_worker_task = asyncio.create_task(run_worker(folder_for_audio))
+        main_logger.info("Start job worker")
+    if settings.janitor_interval > 0:
+        janitor_task = asyncio.create_task(run_janitor(settings.janitor_interval))
 
 
 @app.on_event("shutdown")
 async def shutdown():
     main_logger.info("Shutdown")
-    SessionLocal.close_all()
-    main_logger.info("Close all sessions")
+    for task in (job_worker_task, janitor_task):
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    await dispose_engine()
+    main_logger.info("Close all connections")
+    await stop_backend()
+    stop_logging()
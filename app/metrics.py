@@ -0,0 +1,99 @@
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+from sqlalchemy import event
+
+# Метрики Prometheus для GET /metrics. При нескольких процессах uvicorn задайте PROMETHEUS_MULTIPROC_DIR -
+# метрики процессов будут собираться из общей папки
+
+# Границы для длительных операций: от миллисекунд до минут конвертации
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+BYTES_BUCKETS = (1024, 16 * 1024, 128 * 1024, 512 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2,
+                 64 * 1024 ** 2, 256 * 1024 ** 2)
+
+upload_spool_seconds = Histogram(
+    'audio_upload_spool_seconds', 'Time to spool one uploaded WAV to disk', buckets=STAGE_BUCKETS)
+upload_bytes = Histogram(
+    'audio_upload_bytes', 'Size of spooled WAV files', buckets=BYTES_BUCKETS)
+conversion_seconds = Histogram(
+    'audio_conversion_seconds', 'Conversion of one WAV to all requested renditions, after the scheduler queue',
+    ['backend'], buckets=STAGE_BUCKETS)
+conversions_in_flight = Gauge(
+    'audio_conversions_in_flight', 'Conversions started and not finished yet', ['backend'],
+    multiprocess_mode='livesum')
+conversion_pool_in_flight = Gauge(
+    'conversion_pool_in_flight', 'Busy conversion processes', multiprocess_mode='livesum')
+conversion_pool_queue_depth = Gauge(
+    'conversion_pool_queue_depth', 'Conversions waiting for a free process', multiprocess_mode='livesum')
+conversion_queue_wait_seconds = Histogram(
+    'conversion_queue_wait_seconds', 'Time a WAV waited in the conversion scheduler for a free slot',
+    buckets=STAGE_BUCKETS)
+scheduler_waiting = Gauge(
+    'conversion_scheduler_waiting', 'Conversions waiting in the scheduler', multiprocess_mode='livesum')
+scheduler_running = Gauge(
+    'conversion_scheduler_running', 'Conversions holding a scheduler slot', multiprocess_mode='livesum')
+scheduler_rejected = Counter(
+    'conversion_scheduler_rejected', 'Conversions rejected because the scheduler queue was full')
+zamzar_stage_seconds = Histogram(
+    'zamzar_stage_seconds', 'External api stages: create job, wait (poll) for result, download',
+    ['stage'], buckets=STAGE_BUCKETS)
+zamzar_polls = Counter(
+    'zamzar_polls', 'Job status requests to the external api')
+db_query_seconds = Histogram(
+    'db_query_seconds', 'Database statement execution time', ['operation'], buckets=DB_BUCKETS)
+download_bytes = Histogram(
+    'audio_download_bytes', 'Bytes sent per GET /record response', ['status'], buckets=BYTES_BUCKETS)
+janitor_removed_files = Counter(
+    'janitor_removed_files', 'Orphaned files removed by the janitor', ['kind'])
+janitor_reclaimed_bytes = Counter(
+    'janitor_reclaimed_bytes', 'Bytes freed by removing orphaned files', ['kind'])
+
+
+# Время каждого запроса к базе по типу: select/insert/update/delete
+def instrument_engine(engine):
+
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_started'].pop()
+        operation = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else 'other'
+        if operation not in ('select', 'insert', 'update', 'delete'):
+            operation = 'other'
+        db_query_seconds.labels(operation).observe(time.perf_counter() - started)
+
+
+# Время этапов одного запроса для отладочного ответа, миллисекунды
+class StageTimings:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - started
+
+    def as_dict(self):
+        timings = {name: round(seconds * 1000, 3) for name, seconds in self.stages.items()}
+        timings['total'] = round((time.perf_counter() - self.started) * 1000, 3)
+        return timings
+
+
+def metrics_response():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,142 @@
+import datetime
+import logging
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select, text, update
+
+from .db import AudioRecord, AudioRendition, Base, ConversionJob, User, start_engine
+
+# Логгер модуля; обработчики настраиваются один раз при старте (logging_setup)
+migrations_logger = logging.getLogger(__name__)
+
+# Версия схемы хранится в отдельной таблице, вне моделей приложения
+schema_metadata = MetaData()
+schema_version = Table(
+    'schema_version', schema_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String),
+    Column('applied_at', DateTime, server_default=func.now()),
+)
+
+# Ключ блокировки, чтобы несколько процессов не применяли миграции одновременно (PostgreSQL)
+MIGRATION_LOCK_ID = 7_301_245
+
+# Схема уже проверена в этом процессе
+schema_checked = False
+
+
+class MigrationError(Exception):
+    pass
+
+
+# 1: все таблицы, которых еще нет в базе
+def create_tables(connection):
+    Base.metadata.create_all(connection)
+
+
+# Создаем индексы модели по именам. Список индексов каждого шага фиксирован: индексы, добавленные
+# в модель позже, могут ссылаться на колонки, которых на этом шаге еще нет
+def create_indexes(connection, table, names):
+    indexes = {index.name: index for index in table.indexes}
+    for name in names:
+        indexes[name].create(connection, checkfirst=True)
+
+
+# 2: индексы для проверки имени, токена и поиска записей пользователя
+def add_lookup_indexes(connection):
+    duplicates = connection.execute(
+        select(User.name).group_by(User.name).having(func.count() > 1).limit(10)).scalars().all()
+    if duplicates:
+        raise MigrationError(f'Duplicate user names, resolve them before adding unique index: {duplicates}')
+
+    create_indexes(connection, User.__table__, ('ix_users_name', 'ix_users_id_token'))
+    create_indexes(connection, AudioRecord.__table__, ('ix_audio_records_user_id',))
+
+
+# Добавляем колонку модели в существующую таблицу, если ее там еще нет
+def add_column(connection, column):
+    table = column.table
+    if column.name in {existing['name'] for existing in inspect(connection).get_columns(table.name)}:
+        return
+    column_type = column.type.compile(dialect=connection.dialect)
+    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+
+# 3: ETag записи для условных запросов; для старых записей считается при первом скачивании
+def add_record_etag(connection):
+    add_column(connection, AudioRecord.__table__.c.etag)
+
+
+# 4: таблица вариантов аудиозаписей и список вариантов у фоновых задач
+def add_renditions(connection):
+    AudioRendition.__table__.create(connection, checkfirst=True)
+    add_column(connection, ConversionJob.__table__.c.renditions)
+
+
+# 5: сведения об аудио и индекс для списка записей пользователя; старые записи получают время миграции
+def add_record_metadata(connection):
+    columns = AudioRecord.__table__.c
+    for column in (columns.source_name, columns.duration, columns.sample_rate, columns.channels,
+                   columns.bits_per_sample, columns.wav_size, columns.mp3_size, columns.conversion_seconds,
+                   columns.created_at):
+        add_column(connection, column)
+    connection.execute(update(AudioRecord).where(AudioRecord.created_at.is_(None))
+                       .values(created_at=datetime.datetime.utcnow()))
+    create_indexes(connection, AudioRecord.__table__, ('ix_audio_records_user_created',))
+
+
+# 6: индексы по именам файлов для уборки файлов без записей
+def add_file_name_indexes(connection):
+    create_indexes(connection, AudioRecord.__table__, ('ix_audio_records_file_name',))
+    create_indexes(connection, AudioRendition.__table__, ('ix_audio_renditions_file_name',))
+
+
+# 7: размер WAV у фоновых задач для справедливой выборки из очереди
+def add_job_wav_size(connection):
+    add_column(connection, ConversionJob.__table__.c.wav_size)
+
+
+# Шаги миграции применяются по порядку и только один раз; каждый шаг должен
+# быть идемпотентным, так как новая база сразу создается по текущим моделям в шаге 1
+MIGRATIONS = [
+    (1, 'create tables', create_tables),
+    (2, 'lookup indexes on users and audio_records', add_lookup_indexes),
+    (3, 'etag column on audio_records', add_record_etag),
+    (4, 'audio_renditions table, renditions column on conversion_jobs', add_renditions),
+    (5, 'audio metadata columns and user listing index on audio_records', add_record_metadata),
+    (6, 'file name indexes on audio_records and audio_renditions', add_file_name_indexes),
+    (7, 'wav_size column on conversion_jobs', add_job_wav_size),
+]
+
+
+def apply_migrations(connection):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('SELECT pg_advisory_xact_lock(:id)'), {'id': MIGRATION_LOCK_ID})
+
+    schema_metadata.create_all(connection)
+    current = connection.execute(select(func.coalesce(func.max(schema_version.c.version), 0))).scalar()
+
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        migrations_logger.info(f'Apply migration {version}: {description}')
+        step(connection)
+        connection.execute(schema_version.insert().values(version=version, description=description))
+
+    return current
+
+
+# Приводим схему базы к текущей версии
+async def migrate():
+    async with start_engine().begin() as connection:
+        current = await connection.run_sync(apply_migrations)
+    migrations_logger.info(f'Schema version: {current} -> {MIGRATIONS[-1][0]}')
+
+
+# Единственный шаг подготовки базы при старте процесса (приложение, обработчик задач, janitor):
+# движок создается и схема проверяется один раз, повторный вызов ничего не делает
+async def start_database():
+    global schema_checked
+    start_engine()
+    if not schema_checked:
+        await migrate()
+        schema_checked = True
@@ -0,0 +1,58 @@
+import re
+from typing import NamedTuple
+
+
+class Codec(NamedTuple):
+    extension: str
+    media_type: str
+    # Кодировщик ffmpeg
+    encoder: str
+    # Допустимый битрейт, кбит/с
+    min_bitrate: int
+    max_bitrate: int
+
+
+CODECS = {
+    'mp3': Codec('.mp3', 'audio/mpeg', 'libmp3lame', 8, 320),
+    'opus': Codec('.opus', 'audio/ogg', 'libopus', 6, 510),
+    'aac': Codec('.m4a', 'audio/mp4', 'aac', 16, 512),
+}
+
+RENDITION_PATTERN = re.compile(r'^([a-z0-9]+)-(\d{1,3})$')
+
+
+# Вариант результата конвертации: кодек и битрейт (None - по умолчанию кодировщика)
+class Rendition(NamedTuple):
+    codec: str
+    bitrate: int = None
+
+    @property
+    def name(self):
+        return f'{self.codec}-{self.bitrate}' if self.bitrate else self.codec
+
+    @property
+    def extension(self):
+        return CODECS[self.codec].extension
+
+    @property
+    def media_type(self):
+        return CODECS[self.codec].media_type
+
+
+# 'mp3-320' -> Rendition('mp3', 320)
+def parse_rendition(value: str):
+    match = RENDITION_PATTERN.match(value.strip().lower())
+    if not match or match.group(1) not in CODECS:
+        raise ValueError(f'Unknown rendition {value}, expected <codec>-<kbps> with codec one of: '
+                         f'{", ".join(CODECS)}')
+
+    codec = CODECS[match.group(1)]
+    bitrate = int(match.group(2))
+    if not codec.min_bitrate <= bitrate <= codec.max_bitrate:
+        raise ValueError(f'Bitrate of {value} must be from {codec.min_bitrate} to {codec.max_bitrate} kbps')
+    return Rendition(match.group(1), bitrate)
+
+
+# Имя файла варианта рядом с исходным WAV
+def rendition_file(wav_file: str, rendition: Rendition):
+    return wav_file.replace('.wav', f'-{rendition.name}{rendition.extension}')
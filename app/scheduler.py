@@ -0,0 +1,137 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+
+from .conversion_pool import PoolBusyError
+from .metrics import conversion_queue_wait_seconds, scheduler_rejected, scheduler_running, scheduler_waiting
+
+# Логгер модуля; обработчики настраиваются один раз при старте (logging_setup)
+scheduler_logger = logging.getLogger(__name__)
+
+
+# USER_WEIGHTS: "1:2,42:0.5" -> {1: 2.0, 42: 0.5}
+def parse_weights(value: str):
+    weights = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        user_id, weight = item.split(':', 1)
+        if float(weight) <= 0:
+            raise ValueError(f'User weight must be positive: {item}')
+        weights[int(user_id)] = float(weight)
+    return weights
+
+
+# Очередь одного пользователя: ждущие файлы по размеру (меньшие первыми), сколько его файлов
+# конвертируется сейчас и виртуальное время окончания последнего запущенного файла
+class UserQueue:
+
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.waiting = []
+        self.running = 0
+        self.finish = 0.0
+
+
+# Планировщик конвертаций перед пулом процессов и внешним api. Одновременно выполняется не больше slots
+# конвертаций, у одного пользователя - не больше user_limit (0 - без ограничения). Свободный слот получает
+# пользователь с наименьшим виртуальным временем окончания (weighted fair queuing): стоимость файла -
+# его размер, деленный на вес пользователя. Поэтому пользователь с множеством больших файлов не занимает
+# все процессы: файл другого пользователя встает перед его очередью, а маленькие файлы проходят раньше
+class ConversionScheduler:
+
+    def __init__(self, slots: int, user_limit: int, max_queue: int, weights: dict):
+        self.slots = max(slots, 1)
+        self.user_limit = user_limit
+        self.max_queue = max_queue
+        self.weights = weights
+        self._users = {}
+        self._running = 0
+        self._waiting = 0
+        self._virtual_time = 0.0
+        self._sequence = itertools.count()
+
+    @asynccontextmanager
+    async def slot(self, user_id, size: int):
+        await self.acquire(user_id, size)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+    async def acquire(self, user_id, size: int):
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = UserQueue(self.weights.get(user_id, 1.0))
+
+        # Очередь заполнена - отказываем тому, у кого уже есть ждущие файлы: первый файл пользователя
+        # принимается всегда, чтобы один пользователь не мог занять всю очередь
+        if self._waiting >= self.max_queue and user.waiting:
+            scheduler_rejected.inc()
+            scheduler_logger.error(f'Conversion queue is full: {self._waiting} waiting, user {user_id}')
+            raise PoolBusyError('Conversion queue is full')
+
+        started = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(user.waiting, (size, next(self._sequence), future))
+        self._set_waiting(self._waiting + 1)
+        self._dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Запрос отменен: слот уже выдан - освобождаем, иначе убираем файл из очереди
+            if future.done() and not future.cancelled():
+                self.release(user_id)
+            else:
+                waiting = [entry for entry in user.waiting if entry[2] is not future]
+                if len(waiting) < len(user.waiting):
+                    user.waiting = waiting
+                    heapq.heapify(user.waiting)
+                    self._set_waiting(self._waiting - 1)
+            raise
+
+        conversion_queue_wait_seconds.observe(time.perf_counter() - started)
+
+    def release(self, user_id):
+        self._users[user_id].running -= 1
+        self._running -= 1
+        scheduler_running.set(self._running)
+        self._dispatch()
+
+    def _set_waiting(self, waiting: int):
+        self._waiting = waiting
+        scheduler_waiting.set(waiting)
+
+    # Раздаем свободные слоты по наименьшему виртуальному времени окончания
+    def _dispatch(self):
+        while self._running < self.slots:
+            best = None
+            for user in self._users.values():
+                if not user.waiting or (self.user_limit and user.running >= self.user_limit):
+                    continue
+                start = max(self._virtual_time, user.finish)
+                finish = start + max(user.waiting[0][0], 1) / user.weight
+                if best is None or finish < best[0]:
+                    best = (finish, start, user)
+            if best is None:
+                break
+
+            finish, start, user = best
+            _, _, future = heapq.heappop(user.waiting)
+            self._set_waiting(self._waiting - 1)
+            # Ожидание уже отменено: файл снят с очереди, слот достается следующему
+            if future.done():
+                continue
+            self._virtual_time = start
+            user.finish = finish
+            user.running += 1
+            self._running += 1
+            scheduler_running.set(self._running)
+            future.set_result(None)
+
+        # Забываем пользователей без файлов, у которых не осталось непотраченной очереди
+        for user_id, user in list(self._users.items()):
+            if not user.waiting and not user.running and user.finish <= self._virtual_time:
+                del self._users[user_id]
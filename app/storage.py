@@ -0,0 +1,252 @@
+import errno
+import hashlib
+import logging
+import os
+import shutil
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import RedirectResponse, Response
+
+from .config import settings
+from .download import AudioFileResponse, etag_matches, file_etag
+from .files import remove_file, temp_path
+from .renditions import CODECS
+
+# Логгер модуля; обработчики настраиваются один раз при старте (logging_setup)
+storage_logger = logging.getLogger(__name__)
+
+# Тип содержимого по расширению файла
+MEDIA_TYPES = {codec.extension: codec.media_type for codec in CODECS.values()}
+
+
+# Файлы раскладываются по папкам по хэшу имени (ab/cd/имя), чтобы в одной папке не было миллионов файлов
+def shard_path(file_name: str):
+    digest = hashlib.sha1(file_name.encode()).hexdigest()
+    return f'{digest[:2]}/{digest[2:4]}/{file_name}'
+
+
+def media_type(file_name: str):
+    return MEDIA_TYPES.get(os.path.splitext(file_name)[1], 'application/octet-stream')
+
+
+# Хранилище готовых аудиофайлов. Конвертация идет в рабочей папке audio_folder, затем put переносит
+# результат в хранилище; в базе хранится только имя файла, его расположение знает хранилище
+class LocalStorage:
+
+    def __init__(self, folder: str, work_folder: str):
+        self.folder = folder
+        self.work_folder = work_folder
+
+    async def start(self):
+        os.makedirs(self.folder, exist_ok=True)
+
+    # Путь файла; файлы, сохраненные до разбиения на папки, лежат прямо в folder
+    def path(self, file_name: str):
+        file_path = os.path.join(self.folder, shard_path(file_name))
+        if not os.path.exists(file_path):
+            flat_path = os.path.join(self.folder, file_name)
+            if os.path.exists(flat_path):
+                return flat_path
+        return file_path
+
+    # Переносим готовый файл из рабочей папки в хранилище: в пределах одного диска - переименованием,
+    # на другой диск - копией во временный файл и переименованием
+    async def put(self, file_name: str):
+        source_path = os.path.join(self.work_folder, file_name)
+        file_path = os.path.join(self.folder, shard_path(file_name))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        try:
+            os.replace(source_path, file_path)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+        try:
+            await run_in_threadpool(shutil.copyfile, source_path, temp_path(file_path))
+            os.replace(temp_path(file_path), file_path)
+        except BaseException:
+            remove_file(temp_path(file_path))
+            raise
+        os.remove(source_path)
+
+    async def exists(self, file_name: str):
+        return os.path.exists(self.path(file_name))
+
+    async def size(self, file_name: str):
+        return os.path.getsize(self.path(file_name))
+
+    async def etag(self, file_name: str):
+        return await run_in_threadpool(file_etag, self.path(file_name))
+
+    async def remove(self, file_names):
+        for file_name in file_names:
+            file_path = self.path(file_name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    # Файлы хранилища пачками [(имя, размер, время изменения)]. Папки разбиения читаются по одной;
+    # файлы в корне - только если это не рабочая папка (ее janitor проверяет отдельно)
+    async def list_files(self, batch_size: int):
+        def scan(folder: str, depth: int):
+            found = []
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if depth and entry.is_dir(follow_symlinks=False):
+                        found += scan(entry.path, depth - 1)
+                    elif not depth and entry.is_file(follow_symlinks=False):
+                        stat_result = entry.stat()
+                        found.append((entry.name, stat_result.st_size, stat_result.st_mtime))
+            return found
+
+        if not os.path.isdir(self.folder):
+            return
+        shards = await run_in_threadpool(lambda: sorted(
+            entry.path for entry in os.scandir(self.folder)
+            if len(entry.name) == 2 and entry.is_dir(follow_symlinks=False)))
+        if os.path.realpath(self.folder) != os.path.realpath(self.work_folder):
+            shards.insert(0, None)
+
+        batch = []
+        for shard in shards:
+            if shard is None:
+                files = await run_in_threadpool(scan, self.folder, 0)
+            else:
+                files = await run_in_threadpool(scan, shard, 1)
+            batch += files
+            while len(batch) >= batch_size:
+                yield batch[:batch_size]
+                batch = batch[batch_size:]
+        if batch:
+            yield batch
+
+    # Отдаем файл сами: Range, условные запросы, sendfile. FileNotFoundError - файла нет
+    async def response(self, request_headers, file_name: str, etag: str):
+        file_path = self.path(file_name)
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(file_path)
+        return AudioFileResponse(file_path, request_headers, etag, filename=file_name,
+                                 media_type=media_type(file_name))
+
+
+# S3-совместимое хранилище (AWS S3, MinIO и т.п.). boto3 нужен только в этом режиме и импортируется
+# при старте приложения. Загрузка идет частями (multipart), скачивание - перенаправлением
+# на подписанную ссылку, файл не проходит через приложение
+class S3Storage:
+
+    def __init__(self, bucket: str, prefix: str, work_folder: str):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.work_folder = work_folder
+        self.client = None
+        self.transfer_config = None
+
+    async def start(self):
+        if self.client is not None:
+            return
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config
+        except ImportError:
+            raise RuntimeError('STORAGE=s3 requires boto3: pip install boto3')
+
+        # Клиент boto3 потокобезопасен: один на процесс, вызовы идут из пула потоков
+        self.client = boto3.client(
+            's3', endpoint_url=settings.s3_endpoint_url or None, region_name=settings.s3_region or None,
+            aws_access_key_id=settings.s3_access_key or None, aws_secret_access_key=settings.s3_secret_key or None,
+            config=Config(max_pool_connections=settings.s3_connections))
+        self.transfer_config = TransferConfig(multipart_threshold=settings.s3_multipart_bytes,
+                                              multipart_chunksize=settings.s3_multipart_bytes)
+        await run_in_threadpool(self.client.head_bucket, Bucket=self.bucket)
+        storage_logger.info(f'S3 storage: bucket {self.bucket}, prefix {self.prefix!r}')
+
+    def key(self, file_name: str):
+        key = shard_path(file_name)
+        return f'{self.prefix}/{key}' if self.prefix else key
+
+    async def head(self, file_name: str):
+        from botocore.exceptions import ClientError
+        try:
+            return await run_in_threadpool(self.client.head_object, Bucket=self.bucket, Key=self.key(file_name))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    # ETag содержимого сохраняем в метаданных объекта: ETag самого S3 для multipart - не хэш файла
+    async def put(self, file_name: str):
+        file_path = os.path.join(self.work_folder, file_name)
+        etag = await run_in_threadpool(file_etag, file_path)
+        await run_in_threadpool(
+            self.client.upload_file, file_path, self.bucket, self.key(file_name),
+            ExtraArgs={'ContentType': media_type(file_name), 'Metadata': {'etag': etag.strip('"')}},
+            Config=self.transfer_config)
+        os.remove(file_path)
+        storage_logger.info(f'Upload {file_name} to s3://{self.bucket}/{self.key(file_name)}')
+
+    async def exists(self, file_name: str):
+        return await self.head(file_name) is not None
+
+    async def size(self, file_name: str):
+        return (await self.head(file_name))['ContentLength']
+
+    async def etag(self, file_name: str):
+        head = await self.head(file_name)
+        if head is None:
+            raise FileNotFoundError(file_name)
+        if head.get('Metadata', {}).get('etag'):
+            return f'"{head["Metadata"]["etag"]}"'
+
+        # Объект загружен не приложением - считаем хэш, читая его потоком
+        def stream_etag():
+            body = self.client.get_object(Bucket=self.bucket, Key=self.key(file_name))['Body']
+            digest = hashlib.sha256()
+            for chunk in body.iter_chunks(1024 * 1024):
+                digest.update(chunk)
+            return f'"{digest.hexdigest()[:32]}"'
+
+        return await run_in_threadpool(stream_etag)
+
+    async def remove(self, file_names):
+        for file_name in file_names:
+            await run_in_threadpool(self.client.delete_object, Bucket=self.bucket, Key=self.key(file_name))
+
+    # Объекты под префиксом пачками [(имя, размер, время изменения)], по странице списка за запрос
+    async def list_files(self, batch_size: int):
+        pages = iter(self.client.get_paginator('list_objects_v2').paginate(
+            Bucket=self.bucket, Prefix=f'{self.prefix}/' if self.prefix else '',
+            PaginationConfig={'PageSize': batch_size}))
+        while True:
+            page = await run_in_threadpool(next, pages, None)
+            if page is None:
+                break
+            files = [(os.path.basename(item['Key']), item['Size'], item['LastModified'].timestamp())
+                     for item in page.get('Contents', [])]
+            if files:
+                yield files
+
+    # Повторный запрос с тем же ETag получает 304 без перехода в хранилище. Наличие объекта не проверяем,
+    # чтобы не делать лишний запрос к S3: отсутствующий объект вернет 404 само хранилище
+    async def response(self, request_headers, file_name: str, etag: str):
+        headers = {'etag': etag, 'cache-control': settings.download_cache_control}
+        if etag_matches(request_headers, etag):
+            return Response(status_code=304, headers=headers)
+
+        url = await run_in_threadpool(
+            self.client.generate_presigned_url, 'get_object',
+            Params={'Bucket': self.bucket, 'Key': self.key(file_name),
+                    'ResponseContentType': media_type(file_name),
+                    'ResponseContentDisposition': f'attachment; filename="{file_name}"'},
+            ExpiresIn=settings.s3_presign_ttl)
+        # Ссылка живет ограниченное время - сам переход не кэшируем
+        return RedirectResponse(url, status_code=307, headers={'etag': etag, 'cache-control': 'no-store'})
+
+
+def make_storage():
+    if settings.storage == 's3':
+        return S3Storage(settings.s3_bucket, settings.s3_prefix, settings.audio_folder)
+    return LocalStorage(settings.storage_folder or settings.audio_folder, settings.audio_folder)
+
+
+storage = make_storage()
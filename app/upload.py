@@ -0,0 +1,200 @@
+import hashlib
+import os
+import struct
+import tarfile
+import zipfile
+from typing import NamedTuple
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from .files import remove_file, temp_path
+from .metrics import upload_bytes, upload_spool_seconds
+
+# Поддерживаемые форматы данных WAV: PCM, IEEE float, WAVE_FORMAT_EXTENSIBLE
+WAV_FORMATS = (0x0001, 0x0003, 0xFFFE)
+
+
+class InvalidWavError(Exception):
+    pass
+
+
+class UploadTooLargeError(Exception):
+    pass
+
+
+class InvalidArchiveError(Exception):
+    pass
+
+
+class WavHeader(NamedTuple):
+    channels: int
+    sample_rate: int
+    bits_per_sample: int
+    # Размер и начало аудиоданных, если чанк data попал в начало файла, иначе None
+    data_size: int = None
+    data_offset: int = None
+
+    # Длительность в секундах по размеру данных, без декодирования. Размер в заголовке может быть
+    # неверным (запись потоком пишет 0 или 0xFFFFFFFF), поэтому ограничиваем его размером файла
+    def duration(self, file_size: int):
+        if self.data_offset is None:
+            return None
+        data_size = max(file_size - self.data_offset, 0)
+        if self.data_size:
+            data_size = min(self.data_size, data_size)
+        frame_size = self.channels * ((self.bits_per_sample + 7) // 8)
+        return round(data_size // frame_size / self.sample_rate, 3)
+
+
+# Разбор заголовка WAV по первому прочитанному куску файла
+def parse_wav_header(head: bytes) -> WavHeader:
+    if len(head) < 12 or head[:4] != b'RIFF' or head[8:12] != b'WAVE':
+        raise InvalidWavError('No RIFF/WAVE header')
+
+    fmt = None
+    data_size = None
+    data_offset = None
+    offset = 12
+
+    # Идем по чанкам: fmt обязателен и должен быть до data
+    while offset + 8 <= len(head):
+        chunk_id = head[offset:offset + 4]
+        chunk_size = struct.unpack_from('<I', head, offset + 4)[0]
+        body = offset + 8
+
+        if chunk_id == b'fmt ':
+            if chunk_size < 16 or body + 16 > len(head):
+                raise InvalidWavError('Broken fmt chunk')
+            audio_format, channels, sample_rate, _, _, bits_per_sample = struct.unpack_from('<HHIIHH', head, body)
+            if audio_format not in WAV_FORMATS:
+                raise InvalidWavError(f'Unsupported wav format: {audio_format}')
+            if not channels or not sample_rate or not bits_per_sample:
+                raise InvalidWavError('Broken fmt chunk')
+            fmt = (channels, sample_rate, bits_per_sample)
+
+        elif chunk_id == b'data':
+            data_size = chunk_size
+            data_offset = body
+            break
+
+        # Чанки выравниваются по четной границе
+        offset = body + chunk_size + (chunk_size & 1)
+
+    if fmt is None:
+        raise InvalidWavError('No fmt chunk in wav header')
+
+    return WavHeader(*fmt, data_size, data_offset)
+
+
+# Сведения о WAV для AudioRecord
+def wav_metadata(header: WavHeader, size: int):
+    return {'duration': header.duration(size), 'sample_rate': header.sample_rate, 'channels': header.channels,
+            'bits_per_sample': header.bits_per_sample, 'wav_size': size}
+
+
+# То же для уже сохраненного файла (фоновые задачи): читаем только начало файла
+async def read_wav_metadata(file_path: str, chunk_size: int):
+    def read_head():
+        with open(file_path, 'rb') as wav_file:
+            return wav_file.read(chunk_size), os.fstat(wav_file.fileno()).st_size
+
+    head, size = await run_in_threadpool(read_head)
+    return wav_metadata(parse_wav_header(head), size)
+
+
+# Сохраняем загруженный файл на диск кусками, не читая его целиком в память.
+# Попутно считаем sha256 содержимого для кэша конвертации. Файл появляется под именем file_path,
+# только когда записан целиком; при любой ошибке (и отмене запроса) временный файл удаляется
+async def spool_upload(audio_file: UploadFile, file_path: str, max_bytes: int, chunk_size: int):
+    size = 0
+    header = None
+    digest = hashlib.sha256()
+    part_path = temp_path(file_path)
+
+    try:
+        with upload_spool_seconds.time(), open(part_path, 'wb') as wav_file:
+            while True:
+                chunk = await audio_file.read(chunk_size)
+                if not chunk:
+                    break
+
+                # Проверяем заголовок по первому куску, до копирования остального файла в папку аудио.
+                # Тело запроса к этому моменту уже получено: его размер ограничивает LimitUploadSize
+                if header is None:
+                    header = parse_wav_header(chunk)
+
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLargeError(f'File is larger than {max_bytes} bytes')
+
+                digest.update(chunk)
+                await run_in_threadpool(wav_file.write, chunk)
+
+        if header is None:
+            raise InvalidWavError('Empty file')
+
+        os.replace(part_path, file_path)
+    except BaseException:
+        remove_file(part_path)
+        raise
+
+    upload_bytes.observe(size)
+    return size, header, digest.hexdigest()
+
+
+# Файл внутри архива с тем же асинхронным read, что и у UploadFile.
+# error - файл не удалось открыть, его нужно пропустить с ошибкой
+class ArchiveMember:
+
+    def __init__(self, filename: str, file, error: str = None):
+        self.filename = filename
+        self.file = file
+        self.error = error
+
+    async def read(self, size: int = -1):
+        return await run_in_threadpool(self.file.read, size)
+
+
+# Перебираем файлы архива по одному, не распаковывая его целиком.
+# zip читается по оглавлению из сохраненной загрузки, tar (в том числе .gz/.bz2/.xz) - потоком.
+# Каждый файл нужно дочитать (или пропустить) до перехода к следующему
+async def iter_archive(archive_file):
+    if await run_in_threadpool(zipfile.is_zipfile, archive_file):
+        try:
+            archive = await run_in_threadpool(zipfile.ZipFile, archive_file)
+        except zipfile.BadZipFile as e:
+            raise InvalidArchiveError(f'Broken zip archive: {e}')
+
+        with archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                try:
+                    member_file = await run_in_threadpool(archive.open, info)
+                except (zipfile.BadZipFile, NotImplementedError, RuntimeError) as e:
+                    # Неподдерживаемое сжатие, шифрование или поврежденный заголовок - пропускаем только этот файл
+                    yield ArchiveMember(os.path.basename(info.filename), None, f'Broken archive member: {e}')
+                    continue
+                with member_file:
+                    yield ArchiveMember(os.path.basename(info.filename), member_file)
+        return
+
+    await run_in_threadpool(archive_file.seek, 0)
+    try:
+        archive = await run_in_threadpool(tarfile.open, fileobj=archive_file, mode='r|*')
+    except tarfile.TarError as e:
+        raise InvalidArchiveError(f'Unsupported archive, expected zip or tar: {e}')
+
+    with archive:
+        while True:
+            try:
+                info = await run_in_threadpool(archive.next)
+            except tarfile.TarError as e:
+                raise InvalidArchiveError(f'Broken tar archive: {e}')
+            if info is None:
+                break
+            # Каталоги, ссылки и устройства пропускаем
+            if not info.isfile():
+                continue
+            yield ArchiveMember(os.path.basename(info.name), archive.extractfile(info))
@@ -0,0 +1,125 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Пропускная способность и пиковая память кодировщиков на синтетических WAV.
+# Каждый прогон идет в отдельном процессе, чтобы пиковая память (ru_maxrss) не смешивалась между кодировщиками;
+# память ffmpeg считается отдельно как память дочерних процессов.
+# Запуск: python -m benchmarks.convert --seconds 60 --channels 2 --rate 44100 --runs 3 [--backends lame,ffmpeg]
+# Результат - JSON в stdout (или в файл --output), удобно сравнивать между релизами.
+
+# Кодировщик -> варианты для wav_to_renditions (None - только основной MP3). Основной MP3 приложение
+# тоже конвертирует через wav_to_renditions, поэтому замер идет по тому же коду
+BACKENDS = {
+    'ffmpeg': None,
+    'ffmpeg-renditions': ['mp3-128', 'mp3-320', 'opus-64', 'aac-128'],
+    'lame': None,
+    'lame-renditions': ['mp3-64', 'mp3-128', 'mp3-320'],
+}
+
+
+# Один прогон кодировщика, вызывается в дочернем процессе
+def run_backend(backend: str, wav_file: str, folder: str, bitrate: int):
+    from app import ffmpeg_convert, lame_convert
+    from app.renditions import Rendition, parse_rendition, rendition_file
+
+    ffmpeg = backend.startswith('ffmpeg')
+    if BACKENDS[backend]:
+        renditions = [parse_rendition(name) for name in BACKENDS[backend]]
+    else:
+        # Основной MP3 как в приложении: ffmpeg - с битрейтом по умолчанию, lame - LAME_BITRATE
+        renditions = [Rendition('mp3') if ffmpeg else Rendition('mp3', bitrate)]
+    targets = [(rendition, rendition_file(wav_file, rendition)) for rendition in renditions]
+
+    started = time.perf_counter()
+    if ffmpeg:
+        converted, errors = ffmpeg_convert.wav_to_renditions(wav_file, folder, targets)
+    else:
+        converted, errors = lame_convert.wav_to_renditions(wav_file, folder, targets)
+    elapsed = time.perf_counter() - started
+
+    files = list(converted.values())
+    output_bytes = sum(os.path.getsize(os.path.join(folder, file_name)) for file_name in files)
+    for file_name in files:
+        os.remove(os.path.join(folder, file_name))
+
+    # ru_maxrss в Linux - килобайты
+    return {'seconds': elapsed, 'errors': errors, 'output_bytes': output_bytes,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'children_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+
+def measure(backend: str, wav_file: str, folder: str, runs: int, bitrate: int, audio_seconds: float):
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.convert', '--worker', backend, wav_file, folder, str(bitrate)],
+            capture_output=True, text=True, cwd=folder,
+            env={**os.environ, 'PYTHONPATH': os.path.dirname(os.path.dirname(os.path.abspath(__file__)))})
+        if output.returncode != 0:
+            return {'error': output.stderr.strip().splitlines()[-1:]}
+        results.append(json.loads(output.stdout))
+
+    if any(result['errors'] for result in results):
+        return {'error': results[0]['errors']}
+
+    seconds = sorted(result['seconds'] for result in results)
+    best = seconds[0]
+    return {'runs': runs,
+            'best_seconds': round(best, 4),
+            'median_seconds': round(seconds[len(seconds) // 2], 4),
+            'realtime_factor': round(audio_seconds / best, 2),
+            'input_mb_per_second': round(os.path.getsize(os.path.join(folder, wav_file)) / 1024 ** 2 / best, 2),
+            'output_bytes': results[0]['output_bytes'],
+            'peak_rss_mb': round(max(result['peak_rss_mb'] for result in results), 1),
+            'children_peak_rss_mb': round(max(result['children_peak_rss_mb'] for result in results), 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark WAV -> MP3 encoder backends')
+    parser.add_argument('--backends', default=','.join(BACKENDS), help=f'comma separated: {", ".join(BACKENDS)}')
+    parser.add_argument('--seconds', type=float, default=60, help='duration of the synthetic WAV')
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--rate', type=int, default=44100)
+    parser.add_argument('--width', type=int, default=2, choices=(1, 2, 3, 4), help='bytes per sample')
+    parser.add_argument('--bitrate', type=int, default=128, help='LAME bitrate for the lame backend')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--output', help='write JSON to this file')
+    args = parser.parse_args()
+
+    from benchmarks.wavgen import make_wav
+
+    folder = tempfile.mkdtemp(prefix='convert_bench_')
+    try:
+        wav_file = 'bench.wav'
+        make_wav(os.path.join(folder, wav_file), args.seconds, args.channels, args.rate, args.width)
+
+        report = {'wav': {'seconds': args.seconds, 'channels': args.channels, 'sample_rate': args.rate,
+                          'sample_width': args.width, 'bytes': os.path.getsize(os.path.join(folder, wav_file))},
+                  'backends': {}}
+        for backend in args.backends.split(','):
+            if backend not in BACKENDS:
+                parser.error(f'Unknown backend {backend}')
+            report['backends'][backend] = measure(backend, wav_file, folder, args.runs, args.bitrate, args.seconds)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--worker':
+        backend, wav_file, folder, bitrate = sys.argv[2:6]
+        print(json.dumps(run_backend(backend, wav_file, folder, int(bitrate))))
+    else:
+        main()
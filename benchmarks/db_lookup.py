@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import tempfile
+import time
+import uuid
+
+# Задержка запросов проверки имени, токена и поиска записей пользователя до и после индексов,
+# и страницы списка записей пользователя с большим числом записей: по ключу (created_at, id) и через OFFSET.
+# Запуск: python -m benchmarks.db_lookup --users 100000 --records 5 --heavy-records 50000 [--db-url ...]
+# По умолчанию база - временный файл SQLite. Результат - JSON в stdout.
+
+parser = argparse.ArgumentParser(description='Benchmark hot lookup queries before/after indexes')
+parser.add_argument('--db-url', default=None, help='database URL, default: temporary SQLite file')
+parser.add_argument('--users', type=int, default=100_000)
+parser.add_argument('--records', type=int, default=5, help='audio records per user')
+parser.add_argument('--heavy-records', type=int, default=20_000, help='audio records of user 1')
+parser.add_argument('--page', type=int, default=50, help='records per listing page')
+parser.add_argument('--queries', type=int, default=200, help='queries of each kind per phase')
+args = parser.parse_args()
+
+db_url = args.db_url or f'sqlite:///{tempfile.mkdtemp()}/bench.sqlite'
+os.environ.setdefault('DATABASE_URL', db_url)
+os.environ.setdefault('HOST_URL', 'localhost')
+
+from sqlalchemy import func, insert, select, tuple_  # noqa: E402
+
+from app.db import AudioRecord, Base, User, create_engine  # noqa: E402
+from benchmarks.stats import latency_stats  # noqa: E402
+
+BATCH = 10_000
+INDEXES = (*User.__table__.indexes, *AudioRecord.__table__.indexes)
+
+
+async def seed(engine):
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.drop_all)
+        await connection.run_sync(Base.metadata.create_all)
+
+        for start in range(0, args.users, BATCH):
+            users = [{'id': user_id, 'name': f'user_{user_id}', 'token': str(uuid.uuid4())}
+                     for user_id in range(start + 1, min(start + BATCH, args.users) + 1)]
+            await connection.execute(insert(User), users)
+
+            records = [{'id': str(uuid.uuid4()), 'file_name': f'{uuid.uuid4()}.mp3', 'user_id': user['id']}
+                       for user in users for _ in range(args.records)]
+            await connection.execute(insert(AudioRecord), records)
+
+        # Пользователь с большим числом записей для списка
+        created_at = datetime.datetime(2023, 1, 1)
+        for start in range(0, args.heavy_records, BATCH):
+            records = [{'id': str(uuid.uuid4()), 'file_name': f'{uuid.uuid4()}.mp3', 'user_id': 1,
+                        'created_at': created_at + datetime.timedelta(seconds=number)}
+                       for number in range(start, min(start + BATCH, args.heavy_records))]
+            await connection.execute(insert(AudioRecord), records)
+
+        # Курсоры страниц в глубине списка
+        cursors = (await connection.execute(
+            select(AudioRecord.created_at, AudioRecord.id).filter_by(user_id=1)
+            .order_by(func.random()).limit(args.queries))).all()
+
+        tokens = (await connection.execute(
+            select(User.id, User.token).order_by(func.random()).limit(args.queries))).all()
+    return tokens, cursors
+
+
+async def set_indexes(engine, enabled: bool):
+    async with engine.begin() as connection:
+        for index in INDEXES:
+            if enabled:
+                await connection.run_sync(index.create, checkfirst=True)
+            else:
+                await connection.run_sync(index.drop, checkfirst=True)
+
+
+async def timed(connection, statements):
+    latencies = []
+    for statement in statements:
+        started = time.perf_counter()
+        (await connection.execute(statement)).all()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latency_stats(latencies)
+
+
+def records_page():
+    return (select(AudioRecord).filter_by(user_id=1)
+            .order_by(AudioRecord.created_at.desc(), AudioRecord.id.desc()).limit(args.page))
+
+
+async def measure(engine, tokens, cursors):
+    user_ids = [random.randint(1, args.users) for _ in range(args.queries)]
+    offsets = [random.randint(0, args.heavy_records) for _ in range(args.queries)]
+    async with engine.connect() as connection:
+        return {
+            'user_name_exists': await timed(
+                connection, [select(User.id).filter_by(name=f'user_{user_id}') for user_id in user_ids]),
+            'token_auth': await timed(
+                connection, [select(User.id).filter_by(id=user_id, token=token) for user_id, token in tokens]),
+            'records_by_user': await timed(
+                connection, [select(AudioRecord.id).filter_by(user_id=user_id) for user_id in user_ids]),
+            'records_page_keyset': await timed(
+                connection, [records_page().where(tuple_(AudioRecord.created_at, AudioRecord.id) < tuple(cursor))
+                             for cursor in cursors]),
+            'records_page_offset': await timed(
+                connection, [records_page().offset(offset) for offset in offsets]),
+        }
+
+
+async def main():
+    engine = create_engine(db_url)
+    started = time.perf_counter()
+    tokens, cursors = await seed(engine)
+    seed_seconds = round(time.perf_counter() - started, 2)
+
+    await set_indexes(engine, False)
+    before = await measure(engine, tokens, cursors)
+    await set_indexes(engine, True)
+    after = await measure(engine, tokens, cursors)
+    await engine.dispose()
+
+    print(json.dumps({'db': engine.url.get_backend_name(), 'users': args.users, 'records_per_user': args.records,
+                      'heavy_user_records': args.heavy_records, 'seed_seconds': seed_seconds,
+                      'before_indexes': before, 'after_indexes': after}, indent=2))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+
+import aiohttp
+
+from benchmarks.stats import latency_stats
+from benchmarks.wavgen import make_wavs
+
+# Нагрузочный тест POST /audio и GET /record на локальном приложении: uvicorn + SQLite во временной папке,
+# для FFMPEG=no - локальная заглушка zamzar (benchmarks.zamzar_stub). Фазы: загрузка, скачивание и смешанная -
+# загрузка и скачивание одновременно: ее задержки в сравнении с отдельными фазами показывают конкуренцию
+# конвертации и скачивания за процесс приложения и базу.
+# Запуск: python -m benchmarks.load --mode lame --requests 100 --concurrency 10 --files 2 --seconds 5
+# Результат - JSON с p50/p95/p99 и запросами в секунду по каждой фазе.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_ready(session: aiohttp.ClientSession, url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{process.args} exited with code {process.returncode}')
+        try:
+            async with session.get(url) as response:
+                if response.status < 500:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f'{url} is not ready after {timeout}s')
+
+
+# Запросы фазы с ограничением одновременных; request возвращает (статус, результат)
+async def run_phase(count: int, concurrency: int, request):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = Counter()
+    results = []
+
+    async def one(index):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                status, result = await request(index)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, result = type(e).__name__, None
+            latencies.append((time.perf_counter() - started) * 1000)
+            statuses[str(status)] += 1
+            if result is not None:
+                results.append(result)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(count)))
+    elapsed = time.perf_counter() - started
+
+    stats = {**latency_stats(latencies), 'rps': round(count / elapsed, 2), 'seconds': round(elapsed, 3),
+             'statuses': dict(statuses)}
+    return stats, results
+
+
+def read_payloads(wav_files):
+    return [(os.path.basename(file_path), open(file_path, 'rb').read()) for file_path in wav_files]
+
+
+async def create_user(session: aiohttp.ClientSession, base_url: str):
+    async with session.post(f'{base_url}/users', json={'name': f'bench_{uuid.uuid4().hex[:12]}'}) as response:
+        response.raise_for_status()
+        return {'X-User-ID': response.headers['X-User-ID'], 'X-Token': response.headers['X-Token']}
+
+
+# POST /audio от имени пользователя: files файлов запроса по кругу из payloads
+def make_upload(session: aiohttp.ClientSession, base_url: str, headers: dict, payloads, files: int):
+    async def upload(index):
+        form = aiohttp.FormData()
+        for offset in range(files):
+            name, data = payloads[(index * files + offset) % len(payloads)]
+            form.add_field('audio_files', data, filename=name, content_type='audio/wav')
+        async with session.post(f'{base_url}/audio', data=form, headers=headers) as response:
+            body = await response.json(content_type=None)
+            urls = body.get('successful_urls', []) if response.status == 200 else None
+            return response.status, urls
+    return upload
+
+
+def download_report(stats: dict, sizes):
+    return {**stats, 'mb_per_second': round(sum(sizes) / 1024 ** 2 / stats['seconds'], 2)}
+
+
+async def benchmark(args, base_url: str, wav_files, light_files):
+    payloads = read_payloads(wav_files)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+
+    # Соединений хватает на загрузку и скачивание смешанной фазы
+    async with aiohttp.ClientSession(timeout=timeout,
+                                     connector=aiohttp.TCPConnector(limit=args.concurrency * 2 + 1)) as session:
+        upload = make_upload(session, base_url, await create_user(session, base_url), payloads, args.files)
+
+        async def download(index):
+            url = urls[index % len(urls)]
+            async with session.get(url) as response:
+                size = 0
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    size += len(chunk)
+                return response.status, size
+
+        # Смешанная нагрузка: пока основной пользователь загружает свои файлы, другой пользователь
+        # по одному загружает короткие WAV - его задержки показывают справедливость очереди конвертации
+        if light_files:
+            light_upload = make_upload(session, base_url, await create_user(session, base_url),
+                                       read_payloads(light_files), 1)
+            (upload_stats, uploaded), (light_stats, _) = await asyncio.gather(
+                run_phase(args.requests, args.concurrency, upload),
+                run_phase(args.light_requests, 1, light_upload))
+        else:
+            upload_stats, uploaded = await run_phase(args.requests, args.concurrency, upload)
+        urls = [url.replace(f'http://{args.host_url}', base_url) for result in uploaded for url in result]
+
+        report = {'upload': upload_stats}
+        if light_files:
+            report['light_upload'] = light_stats
+        if urls:
+            downloads = args.downloads or len(urls) * 4
+            report['download'] = download_report(*await run_phase(downloads, args.concurrency, download))
+
+            # Смешанная фаза: новые загрузки идут одновременно со скачиванием уже готовых файлов
+            if args.mixed_requests:
+                (mixed_upload, _), (mixed_download, sizes) = await asyncio.gather(
+                    run_phase(args.mixed_requests, args.concurrency, upload),
+                    run_phase(downloads, args.concurrency, download))
+                report['mixed'] = {'upload': mixed_upload, 'download': download_report(mixed_download, sizes)}
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test POST /audio and GET /record against a local app')
+    parser.add_argument('--mode', default='lame', choices=('yes', 'lame', 'no'), help='FFMPEG conversion mode')
+    parser.add_argument('--requests', type=int, default=50, help='POST /audio requests')
+    parser.add_argument('--downloads', type=int, default=0, help='GET /record requests, default: 4 per file')
+    parser.add_argument('--mixed-requests', type=int, default=50,
+                        help='POST /audio requests of the mixed phase, run together with downloads; 0 - skip')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--files', type=int, default=1, help='WAV files per request')
+    parser.add_argument('--distinct', type=int, default=10, help='distinct WAV files to upload')
+    parser.add_argument('--seconds', type=float, default=5, help='duration of each WAV')
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--rate', type=int, default=44100)
+    parser.add_argument('--light-requests', type=int, default=0,
+                        help='POST /audio requests of a second user with one short WAV each, during the upload phase')
+    parser.add_argument('--light-seconds', type=float, default=1, help='duration of the second user WAVs')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn workers')
+    parser.add_argument('--cache', action='store_true', help='keep the conversion cache on')
+    parser.add_argument('--timeout', type=float, default=300, help='per request timeout, seconds')
+    parser.add_argument('--env', action='append', default=[], help='extra app settings: KEY=VALUE')
+    parser.add_argument('--output', help='write JSON to this file')
+    args = parser.parse_args()
+    args.host_url = 'localhost:8000'
+
+    folder = tempfile.mkdtemp(prefix='load_bench_')
+    app_port = free_port()
+    processes = []
+    try:
+        wav_files = make_wavs(os.path.join(folder, 'wav'), args.distinct, args.seconds, args.channels, args.rate)
+        light_files = []
+        if args.light_requests:
+            light_files = make_wavs(os.path.join(folder, 'wav'), args.distinct, args.light_seconds, args.channels,
+                                    args.rate, prefix='light')
+
+        env = {**os.environ, 'PYTHONPATH': ROOT,
+               'DATABASE_URL': f'sqlite:///{folder}/bench.sqlite', 'HOST_URL': args.host_url,
+               'AUDIO_FOLDER': os.path.join(folder, 'audio'), 'FFMPEG': args.mode,
+               'MAX_FILES': str(max(args.files, 5)), 'CACHE_ENABLED': 'yes' if args.cache else 'no'}
+
+        if args.mode == 'no':
+            stub_port = free_port()
+            env.update({'ZAMZAR_URL': f'http://127.0.0.1:{stub_port}/v1', 'API_KEY': env.get('API_KEY', 'bench')})
+            processes.append(subprocess.Popen(
+                [sys.executable, '-m', 'benchmarks.zamzar_stub', '--port', str(stub_port)],
+                cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+        env.update(item.split('=', 1) for item in args.env)
+
+        # Логи приложения пишутся в текущую папку - запускаем во временной
+        processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'app.main:app', '--port', str(app_port), '--workers',
+             str(args.workers), '--log-level', 'warning'],
+            cwd=folder, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+        base_url = f'http://127.0.0.1:{app_port}'
+
+        async def run():
+            async with aiohttp.ClientSession() as session:
+                await wait_ready(session, f'{base_url}/docs', processes[-1])
+            return await benchmark(args, base_url, wav_files, light_files)
+
+        report = asyncio.run(run())
+        report = {'config': {key: value for key, value in vars(args).items() if key not in ('output', 'host_url')},
+                  **report}
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(folder, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from benchmarks.load import free_port
+from benchmarks.stats import latency_stats
+
+# Время холодного старта процесса приложения: импорт app.main и время до первого обслуженного запроса
+# (запуск uvicorn, подключение к базе, проверка схемы, подготовка способа конвертации).
+# Каждый прогон - новый процесс; первый прогон создает базу и не учитывается.
+# Запуск: python -m benchmarks.startup --mode lame --runs 5 --import-budget-ms 1500 --first-request-budget-ms 5000
+# Результат - JSON; если медиана превышает бюджет или при импорте загружены модули способов конвертации,
+# скрипт завершается с кодом 1 - его можно запускать в CI как проверку регрессии.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Модули, которые нужны только отдельным режимам (FFMPEG, STORAGE=s3) и не должны загружаться при импорте
+LAZY_MODULES = ('pydub', 'lameenc', 'aiohttp', 'boto3')
+
+IMPORT_SCRIPT = f'''
+import json, sys, time
+started = time.perf_counter()
+import app.main
+elapsed = time.perf_counter() - started
+print(json.dumps({{'ms': elapsed * 1000, 'loaded': [name for name in {LAZY_MODULES!r} if name in sys.modules]}}))
+'''
+
+
+# Импорт app.main в отдельном процессе: (миллисекунды, загруженные модули из LAZY_MODULES)
+def measure_import(env: dict, folder: str):
+    result = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=folder, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'import app.main failed:\n{result.stderr}')
+    measured = json.loads(result.stdout.strip().splitlines()[-1])
+    return measured['ms'], measured['loaded']
+
+
+# От запуска uvicorn до первого ответа приложения, миллисекунды
+def measure_first_request(env: dict, folder: str, timeout: float):
+    port = free_port()
+    url = f'http://127.0.0.1:{port}/cache/stats'
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'app.main:app', '--port', str(port), '--log-level', 'warning'],
+        cwd=folder, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f'{process.args} exited with code {process.returncode}')
+            try:
+                with urllib.request.urlopen(url, timeout=timeout) as response:
+                    response.read()
+                    return (time.perf_counter() - started) * 1000
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        raise RuntimeError(f'{url} is not ready after {timeout}s')
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure app import time and time to the first served request')
+    parser.add_argument('--mode', default='lame', choices=('yes', 'lame', 'no'), help='FFMPEG conversion mode')
+    parser.add_argument('--runs', type=int, default=5, help='measured runs, one new process each')
+    parser.add_argument('--import-budget-ms', type=float, default=1500, help='budget for p50 import time')
+    parser.add_argument('--first-request-budget-ms', type=float, default=5000,
+                        help='budget for p50 time to the first served request')
+    parser.add_argument('--timeout', type=float, default=60, help='startup timeout, seconds')
+    parser.add_argument('--env', action='append', default=[], help='extra app settings: KEY=VALUE')
+    parser.add_argument('--output', help='write JSON to this file')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='startup_bench_')
+    try:
+        env = {**os.environ, 'PYTHONPATH': ROOT,
+               'DATABASE_URL': f'sqlite:///{folder}/bench.sqlite', 'HOST_URL': 'localhost:8000',
+               'AUDIO_FOLDER': os.path.join(folder, 'audio'), 'FFMPEG': args.mode,
+               'MAX_FILES': '5', 'JANITOR_INTERVAL': '0', 'API_KEY': os.environ.get('API_KEY', 'bench')}
+        env.update(item.split('=', 1) for item in args.env)
+
+        # Прогрев: создание базы и кэш файлов ОС
+        measure_import(env, folder)
+        measure_first_request(env, folder, args.timeout)
+
+        import_ms, first_request_ms, loaded = [], [], set()
+        for _ in range(args.runs):
+            elapsed, modules = measure_import(env, folder)
+            import_ms.append(elapsed)
+            loaded.update(modules)
+            first_request_ms.append(measure_first_request(env, folder, args.timeout))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    report = {'config': {key: value for key, value in vars(args).items() if key != 'output'},
+              'import': latency_stats(import_ms),
+              'first_request': latency_stats(first_request_ms),
+              'loaded_on_import': sorted(loaded)}
+
+    failures = []
+    if report['import']['p50_ms'] > args.import_budget_ms:
+        failures.append(f'import p50 {report["import"]["p50_ms"]} ms > {args.import_budget_ms} ms')
+    if report['first_request']['p50_ms'] > args.first_request_budget_ms:
+        failures.append(f'first request p50 {report["first_request"]["p50_ms"]} ms '
+                        f'> {args.first_request_budget_ms} ms')
+    if loaded:
+        failures.append(f'modules loaded on import: {sorted(loaded)}')
+    report['failures'] = failures
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+import math
+import statistics
+
+
+# Перцентиль по отсортированному списку (nearest-rank)
+def percentile(values, q: float):
+    if not values:
+        return None
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+# Сводка задержек в миллисекундах для сравнения между релизами
+def latency_stats(latencies_ms):
+    values = sorted(latencies_ms)
+    if not values:
+        return {'count': 0}
+    return {'count': len(values),
+            'p50_ms': round(percentile(values, 50), 3),
+            'p95_ms': round(percentile(values, 95), 3),
+            'p99_ms': round(percentile(values, 99), 3),
+            'mean_ms': round(statistics.fmean(values), 3),
+            'max_ms': round(values[-1], 3)}
@@ -0,0 +1,73 @@
+import argparse
+import math
+import os
+import random
+import struct
+import wave
+
+# Синтетические WAV заданной длительности и формата для бенчмарков: тон с шумом,
+# у каждого файла свой шум, поэтому кэш конвертации не склеивает разные файлы.
+# Запуск: python -m benchmarks.wavgen out_dir --count 10 --seconds 30 --channels 2 --rate 44100 --width 2
+
+# Формат сэмпла по ширине в байтах: 8 бит беззнаковые, остальные - со знаком
+SAMPLE_FORMATS = {1: 'B', 2: 'h', 4: 'i'}
+
+
+def pack_samples(samples, sample_width: int):
+    if sample_width == 1:
+        return struct.pack(f'<{len(samples)}B', *(sample + 128 for sample in samples))
+    if sample_width == 3:
+        return b''.join(struct.pack('<i', sample)[:3] for sample in samples)
+    return struct.pack(f'<{len(samples)}{SAMPLE_FORMATS[sample_width]}', *samples)
+
+
+# Одна секунда звука; дальше она повторяется, так что генерация не зависит от длительности
+def make_second(channels: int, sample_rate: int, sample_width: int, seed: int):
+    rnd = random.Random(seed)
+    amplitude = (1 << (8 * sample_width - 1)) - 1
+    frequency = 220 + seed % 660
+    samples = []
+    for frame in range(sample_rate):
+        tone = 0.5 * math.sin(2 * math.pi * frequency * frame / sample_rate)
+        for _ in range(channels):
+            samples.append(int(amplitude * (tone + 0.1 * (rnd.random() - 0.5))))
+    return pack_samples(samples, sample_width)
+
+
+def make_wav(path: str, seconds: float, channels: int = 2, sample_rate: int = 44100, sample_width: int = 2,
+             seed: int = 0):
+    second = make_second(channels, sample_rate, sample_width, seed)
+    frames = int(seconds * sample_rate)
+    frame_size = channels * sample_width
+
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(sample_width)
+        wav.setframerate(sample_rate)
+        while frames > 0:
+            chunk = min(frames, sample_rate)
+            wav.writeframes(second[:chunk * frame_size])
+            frames -= chunk
+    return path
+
+
+def make_wavs(folder: str, count: int, seconds: float, channels: int = 2, sample_rate: int = 44100,
+              sample_width: int = 2, prefix: str = 'bench'):
+    os.makedirs(folder, exist_ok=True)
+    return [make_wav(os.path.join(folder, f'{prefix}_{index}.wav'), seconds, channels, sample_rate, sample_width,
+                     seed=index)
+            for index in range(count)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic WAV files')
+    parser.add_argument('folder')
+    parser.add_argument('--count', type=int, default=1)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--rate', type=int, default=44100)
+    parser.add_argument('--width', type=int, default=2, choices=(1, 2, 3, 4), help='bytes per sample')
+    args = parser.parse_args()
+
+    for file_path in make_wavs(args.folder, args.count, args.seconds, args.channels, args.rate, args.width):
+        print(file_path)
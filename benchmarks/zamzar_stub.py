@@ -0,0 +1,69 @@
+import argparse
+import itertools
+import random
+
+from aiohttp import web
+
+# Локальная замена sandbox.zamzar.com: те же эндпоинты /v1/jobs и /v1/files/{id}/content.
+# Запуск: python -m benchmarks.zamzar_stub --port 8081, в .env: ZAMZAR_URL=http://localhost:8081/v1
+# "Конвертация" возвращает загруженный файл как есть, задача готова через --polls проверок статуса.
+
+job_ids = itertools.count(1)
+
+
+def make_app(polls: int = 1, error_rate: float = 0.0):
+    app = web.Application(client_max_size=1024 ** 3)
+    app['jobs'] = {}
+    app['files'] = {}
+
+    # Случайные 503 для проверки повторов на стороне клиента
+    @web.middleware
+    async def flaky(request, handler):
+        if error_rate and random.random() < error_rate:
+            # Тело дочитываем, иначе соединение keep-alive останется в неопределенном состоянии
+            await request.read()
+            return web.Response(status=503, headers={'Retry-After': '0'})
+        return await handler(request)
+
+    app.middlewares.append(flaky)
+
+    async def create_job(request):
+        form = await request.post()
+        source = form['source_file']
+        job_id = next(job_ids)
+        app['files'][job_id] = source.file.read()
+        app['jobs'][job_id] = {'id': job_id, 'status': 'initialising', 'polls': 0,
+                               'target_format': form['target_format'], 'target_files': []}
+        return web.json_response({'id': job_id, 'status': 'initialising'}, status=201)
+
+    async def get_job(request):
+        job = app['jobs'].get(int(request.match_info['job_id']))
+        if job is None:
+            return web.json_response({'errors': [{'message': 'not found'}]}, status=404)
+        job['polls'] += 1
+        if job['polls'] >= polls:
+            job['status'] = 'successful'
+            job['target_files'] = [{'id': job['id'], 'name': f"{job['id']}.{job['target_format']}"}]
+        else:
+            job['status'] = 'converting'
+        return web.json_response({key: value for key, value in job.items() if key != 'polls'})
+
+    async def get_content(request):
+        content = app['files'].pop(int(request.match_info['file_id']), None)
+        if content is None:
+            return web.json_response({'errors': [{'message': 'not found'}]}, status=404)
+        return web.Response(body=content, content_type='application/octet-stream')
+
+    app.router.add_post('/v1/jobs', create_job)
+    app.router.add_get('/v1/jobs/{job_id}', get_job)
+    app.router.add_get('/v1/files/{file_id}/content', get_content)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local zamzar.com stand-in')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--polls', type=int, default=1, help='status checks before a job is successful')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 503')
+    args = parser.parse_args()
+    web.run_app(make_app(args.polls, args.error_rate), port=args.port)
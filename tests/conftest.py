@@ -0,0 +1,46 @@
+import io
+import os
+import tempfile
+import uuid
+import wave
+
+import pytest
+
+# Настройки приложения читаются при импорте app.config - задаем их до импорта модулей приложения
+TEST_FOLDER = tempfile.mkdtemp(prefix='audio_tests_')
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{TEST_FOLDER}/app.sqlite')
+os.environ.setdefault('HOST_URL', 'localhost:8000')
+os.environ.setdefault('MAX_FILES', '5')
+os.environ.setdefault('FFMPEG', 'lame')
+os.environ.setdefault('AUDIO_FOLDER', os.path.join(TEST_FOLDER, 'audio'))
+os.environ.setdefault('LOG_DIR', os.path.join(TEST_FOLDER, 'logs'))
+os.environ.setdefault('JANITOR_INTERVAL', '0')
+
+
+def wav_bytes(seconds: float = 0.5, rate: int = 8000, channels: int = 1):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(bytes(int(seconds * rate) * channels * 2))
+    return buffer.getvalue()
+
+
+# Приложение с запуском и остановкой (база, способ конвертации) на время теста
+@pytest.fixture
+def client():
+    from starlette.testclient import TestClient
+
+    from app.main import app
+
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+# Заголовки нового пользователя
+@pytest.fixture
+def user(client):
+    response = client.post('/users', json={'name': f'test_{uuid.uuid4().hex[:12]}'})
+    assert response.status_code == 200
+    return {'X-User-ID': response.headers['X-User-ID'], 'X-Token': response.headers['X-Token']}
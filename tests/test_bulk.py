@@ -0,0 +1,30 @@
+import io
+import json
+import zipfile
+
+from tests.conftest import wav_bytes
+
+
+# zip, у первого файла которого в оглавлении неизвестный метод сжатия: ZipFile.open падает с NotImplementedError
+def broken_zip():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('broken.wav', wav_bytes())
+        archive.writestr('good.wav', wav_bytes())
+    data = bytearray(buffer.getvalue())
+    central = data.index(b'PK\x01\x02')
+    data[central + 10:central + 12] = (99).to_bytes(2, 'little')
+    return bytes(data)
+
+
+# Файл, который не открывается, - ошибка этого файла; остальные обрабатываются, поток результатов завершается
+def test_bulk_broken_member(client, user):
+    response = client.post('/audio/bulk', headers=user,
+                           files={'archive': ('a.zip', broken_zip(), 'application/zip')})
+    assert response.status_code == 200
+
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    results = {line['file']: line for line in lines if 'file' in line}
+    assert 'Broken archive member' in results['broken.wav']['failed']
+    assert 'successful_url' in results['good.wav']
+    assert lines[-1] == {'successful': 1, 'failed': 1}
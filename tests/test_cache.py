@@ -0,0 +1,44 @@
+import io
+import os
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, select
+
+from app.config import settings
+from app.db import CachedFile
+
+
+def random_wav():
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(8000)
+        wav.writeframes(os.urandom(8000))
+    return buffer.getvalue()
+
+
+# Одновременные загрузки одного WAV: обе ветки кэша (новая запись и ссылка на чужую) без ошибок
+# уникальности, счетчик ссылок учитывает каждую запись
+def test_concurrent_identical_uploads(client, user):
+    data = random_wav()
+
+    def upload(_):
+        return client.post('/audio', headers=user, files={'audio_files': ('same.wav', data, 'audio/wav')})
+
+    with ThreadPoolExecutor(6) as pool:
+        responses = list(pool.map(upload, range(6)))
+
+    assert [response.status_code for response in responses] == [200] * 6
+    for response in responses:
+        assert len(response.json()['successful_urls']) == 1
+        download = client.get(response.json()['successful_urls'][0].replace(f'http://{settings.host_url}', ''))
+        assert download.status_code == 200
+
+    engine = create_engine(settings.db_url)
+    with engine.connect() as connection:
+        ref_counts = connection.execute(select(CachedFile.ref_count)).scalars().all()
+    engine.dispose()
+    # Файл, который сохранил кэш, - одна запись на все 6 загрузок
+    assert 6 in ref_counts
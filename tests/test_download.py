@@ -0,0 +1,29 @@
+import pytest
+
+from app.download import parse_range
+
+
+def test_parse_range():
+    assert parse_range('bytes=0-99', 1000) == (0, 99)
+    assert parse_range('bytes=900-', 1000) == (900, 999)
+    assert parse_range('bytes=-100', 1000) == (900, 999)
+    # Конец за пределами файла обрезается по размеру
+    assert parse_range('bytes=990-5000', 1000) == (990, 999)
+
+
+# Неверный синтаксис или неподдерживаемая форма - заголовок игнорируется, файл отдается целиком (200)
+def test_parse_range_ignored():
+    assert parse_range('bytes=5-2', 1000) is None
+    assert parse_range('bytes=5000-2', 1000) is None
+    assert parse_range('bytes=0-1,5-6', 1000) is None
+    assert parse_range('items=0-1', 1000) is None
+
+
+# Диапазон не пересекается с файлом - 416
+def test_parse_range_not_satisfiable():
+    with pytest.raises(ValueError):
+        parse_range('bytes=1000-', 1000)
+    with pytest.raises(ValueError):
+        parse_range('bytes=1000-1200', 1000)
+    with pytest.raises(ValueError):
+        parse_range('bytes=-0', 1000)
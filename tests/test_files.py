@@ -0,0 +1,9 @@
+from app.files import upload_file_name
+
+
+# Расширение отрезается целиком: rstrip('.wav') срезал бы и буквы имени (a.wav -> '', java.wav -> 'j')
+def test_upload_file_name():
+    assert upload_file_name('a.wav', 'id') == 'a-id.wav'
+    assert upload_file_name('java.wav', 'id') == 'java-id.wav'
+    assert upload_file_name('wave.WAV', 'id') == 'wave-id.wav'
+    assert upload_file_name('music/set.v2.wav', 'id') == 'set.v2-id.wav'
@@ -0,0 +1,95 @@
+import asyncio
+import datetime
+import uuid
+
+from sqlalchemy import select, update
+
+from app.config import settings
+from app.db import AudioRecord, AudioRendition, ConversionJob, SessionLocal, dispose_engine
+from app.jobs import JOB_DONE, JOB_FAILED, JOB_QUEUED, JOB_RUNNING, claim_next_job, requeue_stale_jobs
+from app.main import job_status, record_renditions
+from app.migrations import start_database
+
+
+async def add_job(status, updated_at=None, user_id=None, wav_size=None):
+    job = ConversionJob(id=str(uuid.uuid4()), source_name='a.wav', wav_file='a.wav', status=status,
+                        updated_at=updated_at or datetime.datetime.utcnow(), user_id=user_id, wav_size=wav_size)
+    async with SessionLocal() as session:
+        session.add(job)
+        await session.commit()
+    return job.id
+
+
+async def stored_status(job_id):
+    async with SessionLocal() as session:
+        return (await session.execute(select(ConversionJob.status).where(ConversionJob.id == job_id))).scalar()
+
+
+# Задача упавшего обработчика (аренда истекла) возвращается в очередь, выполняемая - остается в работе
+def test_stale_running_job_is_requeued():
+    async def scenario():
+        await start_database()
+        try:
+            now = datetime.datetime.utcnow()
+            stale = await add_job(JOB_RUNNING, now - datetime.timedelta(seconds=settings.job_lease + 60))
+            alive = await add_job(JOB_RUNNING, now)
+
+            assert await requeue_stale_jobs() == 1
+            assert await stored_status(stale) == JOB_QUEUED
+            assert await stored_status(alive) == JOB_RUNNING
+
+            # Возвращенную задачу снова забирает обработчик, аренда начинается заново
+            claimed = await claim_next_job()
+            assert claimed[0] == stale
+            assert await stored_status(stale) == JOB_RUNNING
+            assert await requeue_stale_jobs() == 0
+        finally:
+            await dispose_engine()
+
+    asyncio.run(scenario())
+
+
+# Ссылки в статусе задачи - только на созданные варианты, а не на все заказанные
+def test_job_status_lists_produced_renditions():
+    async def scenario():
+        await start_database()
+        try:
+            record_id = str(uuid.uuid4())
+            job = ConversionJob(id=record_id, user_id=1, source_name='a.wav', renditions='mp3-320,opus-64',
+                                status=JOB_DONE, record_id=record_id)
+            async with SessionLocal() as session:
+                session.add_all([AudioRecord(id=record_id, user_id=1, file_name='a.mp3'),
+                                 AudioRendition(record_id=record_id, name='mp3-320', file_name='a-mp3-320.mp3'),
+                                 job])
+                await session.commit()
+                renditions = await record_renditions(session, [job.record_id])
+            return job_status(job, renditions.get(job.record_id))
+        finally:
+            await dispose_engine()
+
+    status = asyncio.run(scenario())
+    assert list(status['rendition_urls']) == ['mp3-320']
+
+
+# Задача второго пользователя не ждет очередь первого, у одного пользователя меньший WAV идет раньше
+def test_claim_is_fair_between_users():
+    async def scenario():
+        await start_database()
+        try:
+            async with SessionLocal() as session:
+                await session.execute(update(ConversionJob).where(ConversionJob.status.in_([JOB_QUEUED, JOB_RUNNING]))
+                                      .values(status=JOB_FAILED))
+                await session.commit()
+
+            heavy = [await add_job(JOB_QUEUED, user_id=1, wav_size=size) for size in [5000] * 50 + [100]]
+            light = await add_job(JOB_QUEUED, user_id=2, wav_size=9000)
+
+            claimed = [(await claim_next_job())[0] for _ in range(3)]
+            return heavy, light, claimed
+        finally:
+            await dispose_engine()
+
+    heavy, light, claimed = asyncio.run(scenario())
+    # Меньший файл первого пользователя, затем задача второго, хотя она поставлена последней
+    assert claimed[:2] == [heavy[-1], light]
+    assert claimed[2] == heavy[0]
@@ -0,0 +1,45 @@
+import struct
+import wave
+
+from app import lame_convert
+from app.lame_convert import to_lame_pcm, wav_to_mp3
+
+
+def pcm16(*samples):
+    return struct.pack(f'<{len(samples)}h', *samples)
+
+
+def test_to_lame_pcm_sample_width():
+    # 8 бит беззнаковые: 0 -> -32768, 128 -> 0, 255 -> 32512
+    assert to_lame_pcm(bytes([0, 128, 255]), 1, 1, 1) == pcm16(-32768, 0, 32512)
+    # 24 и 32 бит - два старших байта сэмпла
+    assert to_lame_pcm(bytes.fromhex('563412' 'ffffff'), 3, 1, 1) == pcm16(0x1234, -1)
+    assert to_lame_pcm(struct.pack('<2i', 0x12345678, -0x80000000), 4, 1, 1) == pcm16(0x1234, -32768)
+
+
+def test_to_lame_pcm_channels():
+    assert to_lame_pcm(pcm16(100, 300, -5, -6), 2, 2, 1) == pcm16(200, -6)
+    assert to_lame_pcm(pcm16(7, -8), 2, 1, 2) == pcm16(7, 7, -8, -8)
+    # Неполный кадр в конце данных отбрасывается
+    assert to_lame_pcm(pcm16(1, 2, 3), 2, 2, 1) == pcm16(1)
+
+
+# Сведение в моно через audioop и запасной вариант массивом дают одинаковые сэмплы, в том числе на краях диапазона
+def test_to_lame_pcm_downmix_fallback(monkeypatch):
+    stereo = pcm16(32767, 32767, -32768, -32768, 32767, -32768, -1, 0, 1, 2, -3, 0)
+    fast = to_lame_pcm(stereo, 2, 2, 1)
+    monkeypatch.setattr(lame_convert, 'audioop', None)
+    assert to_lame_pcm(stereo, 2, 2, 1) == fast == pcm16(32767, -32768, -1, -1, 1, -2)
+
+
+def test_wav_to_mp3_8bit_mono_to_stereo(tmp_path):
+    with wave.open(str(tmp_path / 'a.wav'), 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(1)
+        wav.setframerate(22050)
+        wav.writeframes(bytes(range(256)) * 100)
+
+    mp3_file, errors = wav_to_mp3('a.wav', str(tmp_path), channels=2)
+    assert errors == []
+    assert mp3_file == 'a.mp3'
+    assert (tmp_path / 'a.mp3').stat().st_size > 0
@@ -0,0 +1,26 @@
+import os
+import subprocess
+import sys
+import time
+
+from app.logging_setup import prune_logs
+
+
+def test_prune_logs(tmp_path):
+    # pid завершившегося процесса
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    old = time.time() - 3600
+
+    files = {'dead': f'app-{dead.pid}.log', 'dead_rotated': f'app-{dead.pid}.log.1',
+             'alive': f'app-{os.getppid()}.log', 'other': 'other.log'}
+    for name in files.values():
+        (tmp_path / name).write_text('log')
+        os.utime(tmp_path / name, (old, old))
+
+    # Файлы моложе срока хранения не трогаем
+    prune_logs(str(tmp_path), 7200)
+    assert sorted(os.listdir(tmp_path)) == sorted(files.values())
+
+    prune_logs(str(tmp_path), 600)
+    assert sorted(os.listdir(tmp_path)) == sorted([files['alive'], files['other']])
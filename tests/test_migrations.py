@@ -0,0 +1,68 @@
+import sqlalchemy
+from sqlalchemy import inspect, text
+
+from app.migrations import MIGRATIONS, apply_migrations
+
+# Схема базы до версионных миграций: таблицы из исходной версии приложения
+BASELINE_SCHEMA = (
+    'CREATE TABLE users (id INTEGER PRIMARY KEY, name VARCHAR, token VARCHAR)',
+    'CREATE TABLE audio_records (id VARCHAR PRIMARY KEY, file_name VARCHAR, '
+    'user_id INTEGER REFERENCES users (id))',
+    "INSERT INTO users (id, name, token) VALUES (1, 'user', 'token')",
+    "INSERT INTO audio_records (id, file_name, user_id) VALUES ('a', 'a.mp3', 1)",
+)
+
+
+def test_upgrade_baseline_database(tmp_path):
+    path = tmp_path / 'baseline.sqlite'
+    engine = sqlalchemy.create_engine(f'sqlite:///{path}')
+    with engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.execute(text(statement))
+    engine.dispose()
+
+    engine = sqlalchemy.create_engine(f'sqlite:///{path}')
+    with engine.begin() as connection:
+        apply_migrations(connection)
+    with engine.connect() as connection:
+        version = connection.execute(text('SELECT max(version) FROM schema_version')).scalar()
+        created_at = connection.execute(text("SELECT created_at FROM audio_records WHERE id = 'a'")).scalar()
+        schema = inspect(connection)
+        record_columns = {column['name'] for column in schema.get_columns('audio_records')}
+        record_indexes = {index['name'] for index in schema.get_indexes('audio_records')}
+        tables = set(schema.get_table_names())
+    engine.dispose()
+
+    assert version == MIGRATIONS[-1][0]
+    assert {'etag', 'duration', 'created_at', 'mp3_size'} <= record_columns
+    assert {'ix_audio_records_user_id', 'ix_audio_records_user_created', 'ix_audio_records_file_name'} <= record_indexes
+    assert {'audio_renditions', 'conversion_jobs', 'conversion_cache'} <= tables
+    assert created_at is not None
+
+
+def test_migrations_are_applied_once(tmp_path):
+    engine = sqlalchemy.create_engine(f'sqlite:///{tmp_path / "new.sqlite"}')
+    for _ in range(2):
+        with engine.begin() as connection:
+            apply_migrations(connection)
+    with engine.connect() as connection:
+        versions = connection.execute(text('SELECT version FROM schema_version')).scalars().all()
+    engine.dispose()
+
+    assert versions == [version for version, _, _ in MIGRATIONS]
+
+
+# База версии 6: у задач еще нет колонки wav_size
+def test_job_wav_size_migration(tmp_path):
+    engine = sqlalchemy.create_engine(f'sqlite:///{tmp_path / "v6.sqlite"}')
+    with engine.begin() as connection:
+        apply_migrations(connection)
+        connection.execute(text('ALTER TABLE conversion_jobs DROP COLUMN wav_size'))
+        connection.execute(text('DELETE FROM schema_version WHERE version > 6'))
+    with engine.begin() as connection:
+        assert apply_migrations(connection) == 6
+    with engine.connect() as connection:
+        columns = {column['name'] for column in inspect(connection).get_columns('conversion_jobs')}
+    engine.dispose()
+
+    assert 'wav_size' in columns
@@ -0,0 +1,24 @@
+import os
+import statistics
+
+from benchmarks.startup import ROOT, measure_import
+
+# Бюджет медианы импорта app.main, миллисекунды; на медленной машине CI его можно поднять
+IMPORT_BUDGET_MS = float(os.environ.get('IMPORT_BUDGET_MS', 1500))
+
+
+# Импорт приложения в новом процессе укладывается в бюджет и не загружает модули способов конвертации
+# и boto3 (LAZY_MODULES) - они импортируются при старте только для выбранного режима
+def test_import_budget_and_lazy_modules(tmp_path):
+    env = {**os.environ, 'PYTHONPATH': ROOT, 'LOG_DIR': str(tmp_path)}
+    # Первый импорт прогревает кэш файлов и байткод
+    measure_import(env, str(tmp_path))
+
+    import_ms, loaded = [], set()
+    for _ in range(3):
+        elapsed, modules = measure_import(env, str(tmp_path))
+        import_ms.append(elapsed)
+        loaded.update(modules)
+
+    assert not loaded
+    assert statistics.median(import_ms) < IMPORT_BUDGET_MS
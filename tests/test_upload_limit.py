@@ -0,0 +1,51 @@
+import asyncio
+
+from starlette.testclient import TestClient
+
+from app.config import settings
+from app.main import app
+
+HEADERS = {'X-User-ID': '1', 'X-Token': 'token'}
+
+
+def multipart_chunks(chunks: int, chunk_size: int):
+    yield b'--limit\r\nContent-Disposition: form-data; name="audio_files"; filename="a.wav"\r\n\r\n'
+    for _ in range(chunks):
+        yield b'\0' * chunk_size
+    yield b'\r\n--limit--\r\n'
+
+
+# Запрос без Content-Length (chunked) прерывается по мере получения тела, а не после разбора всей формы
+def test_chunked_upload_over_limit(monkeypatch):
+    monkeypatch.setattr(settings, 'max_request_bytes', 64 * 1024)
+    chunks = list(multipart_chunks(100, 16 * 1024))
+    received = []
+    sent = []
+
+    async def receive():
+        # Как uvicorn: после начала ответа остаток тела приложению не отдается
+        await asyncio.sleep(0)
+        if sent:
+            return {'type': 'http.disconnect'}
+        chunk = chunks[len(received)]
+        received.append(chunk)
+        return {'type': 'http.request', 'body': chunk, 'more_body': len(received) < len(chunks)}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+             'scheme': 'http', 'path': '/audio', 'raw_path': b'/audio', 'root_path': '', 'query_string': b'',
+             'server': ('testserver', 80), 'client': ('testclient', 50000),
+             'headers': [(b'x-user-id', b'1'), (b'x-token', b'token'), (b'transfer-encoding', b'chunked'),
+                         (b'content-type', b'multipart/form-data; boundary=limit')]}
+    asyncio.run(app(scope, receive, send))
+
+    assert sent[0]['status'] == 413
+    assert len(received) < 10
+
+
+def test_content_length_over_limit(monkeypatch):
+    monkeypatch.setattr(settings, 'max_request_bytes', 64 * 1024)
+    response = TestClient(app).post('/audio', files={'audio_files': ('a.wav', b'\0' * 100 * 1024)}, headers=HEADERS)
+    assert response.status_code == 413
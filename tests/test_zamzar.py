@@ -0,0 +1,100 @@
+import asyncio
+import os
+import random
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from prometheus_client import REGISTRY
+
+from app.async_wav_to_mp3 import close_session, convert_file, download_file, retry_delay
+from app.config import settings
+from benchmarks.zamzar_stub import make_app
+from tests.conftest import wav_bytes
+
+
+# Клиент zamzar против локальной заглушки; url заглушки подставляется после запуска сервера
+async def with_server(app, monkeypatch, scenario):
+    server = TestServer(app)
+    await server.start_server()
+    monkeypatch.setattr(settings, 'zamzar_url', str(server.make_url('/v1')))
+    try:
+        return await scenario()
+    finally:
+        await close_session()
+        await server.close()
+
+
+def fast_settings(monkeypatch, **values):
+    monkeypatch.setattr(settings, 'api_key', 'test')
+    monkeypatch.setattr(settings, 'zamzar_retry_delay', 0.01)
+    monkeypatch.setattr(settings, 'zamzar_poll_interval', 0.01)
+    monkeypatch.setattr(settings, 'zamzar_poll_max_interval', 0.05)
+    for key, value in values.items():
+        monkeypatch.setattr(settings, key, value)
+
+
+# Задача готова через 3 проверки статуса, часть запросов получает 503 - клиент повторяет их
+def test_convert_file_with_retries(tmp_path, monkeypatch):
+    fast_settings(monkeypatch, zamzar_retries=10)
+    random.seed(1)
+    data = wav_bytes()
+    (tmp_path / 'a.wav').write_bytes(data)
+    polls = REGISTRY.get_sample_value('zamzar_polls_total') or 0
+
+    result, errors = asyncio.run(with_server(
+        make_app(polls=3, error_rate=0.3), monkeypatch, lambda: convert_file('a.wav', 'mp3', str(tmp_path))))
+
+    assert errors == []
+    assert result == 'a.mp3'
+    # Заглушка возвращает загруженный файл как есть
+    assert (tmp_path / 'a.mp3').read_bytes() == data
+    assert REGISTRY.get_sample_value('zamzar_polls_total') - polls >= 3
+
+
+# Задача не готова до дедлайна: ошибка таймаута, опросы с растущим интервалом ограничены по времени
+def test_convert_file_timeout(tmp_path, monkeypatch):
+    fast_settings(monkeypatch, zamzar_timeout=0.3)
+    (tmp_path / 'a.wav').write_bytes(wav_bytes())
+
+    result, errors = asyncio.run(with_server(
+        make_app(polls=1000), monkeypatch, lambda: convert_file('a.wav', 'mp3', str(tmp_path))))
+
+    assert result == ''
+    assert errors == [{'a.wav': 'Conversion timeout 0.3s'}]
+    assert not (tmp_path / 'a.mp3').exists()
+
+
+def test_retry_delay(monkeypatch):
+    monkeypatch.setattr(settings, 'zamzar_retry_delay', 1)
+    monkeypatch.setattr(settings, 'zamzar_retry_max_delay', 30)
+    response = type('Response', (), {})()
+
+    response.headers = {'Retry-After': '7'}
+    assert retry_delay(0, response) == 7
+    response.headers = {'Retry-After': '600'}
+    assert retry_delay(0, response) == 30
+    # Без Retry-After (или с датой вместо секунд) - экспоненциальная пауза
+    response.headers = {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+    assert retry_delay(2, response) == 4
+    assert retry_delay(10) == 30
+
+
+# Соединение оборвалось посреди скачивания: ни MP3, ни временного файла не остается
+def test_download_file_partial(tmp_path, monkeypatch):
+    fast_settings(monkeypatch, zamzar_retries=0)
+
+    async def content(request):
+        response = web.StreamResponse(headers={'Content-Length': str(1024 ** 2)})
+        await response.prepare(request)
+        await response.write(b'\0' * 1024)
+        request.transport.close()
+        return response
+
+    app = web.Application()
+    app.router.add_get('/v1/files/{file_id}/content', content)
+    mp3_file = str(tmp_path / 'a.mp3')
+
+    result = asyncio.run(with_server(app, monkeypatch, lambda: download_file(1, mp3_file)))
+
+    assert result != 'OK'
+    assert os.listdir(tmp_path) == []